@@ -0,0 +1,219 @@
+"""
+Benchmarks for FileQueue, LifoFileQueue, PriorityFileQueue and
+ShardedFileQueue, run next to the stdlib queue they replace.
+
+    python benchmarks/bench_queue.py [--quick] [--filter TEXT]
+                                     [--output results.json]
+                                     [--compare earlier.json]
+
+Each case puts a number of items of one size and gets them all back, either
+filling the queue first and then draining it from a single thread, or with
+producer and consumer threads running at once. Results are printed as a
+table and, with --output, written as JSON (with details of the machine and
+python version) so runs can be compared later with --compare.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import filequeue
+
+try:
+    import queue as std_queue
+except ImportError:
+    import Queue as std_queue
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    clock = time.time
+
+ITEM_SIZES = (16, 1024, 65536)
+MAXSIZES = (0, 1000)
+THREADS = ((1, 1), (4, 4))
+PRIORITIES = (1, 16, 1024)
+# bytes queued per case, so large items don't take forever
+VOLUME = 64 * 1024 * 1024
+MAX_ITEMS = 200000
+
+
+class Case(object):
+
+    def __init__(self, queue, item_size, maxsize=0, producers=0,
+                 consumers=0, priorities=0):
+        self.queue = queue
+        self.item_size = item_size
+        self.maxsize = maxsize
+        self.producers = producers
+        self.consumers = consumers
+        self.priorities = priorities
+
+    @property
+    def name(self):
+        parts = [self.queue, "size=%i" % self.item_size,
+                 "maxsize=%i" % self.maxsize]
+        if self.producers:
+            parts.append("threads=%ix%i" % (self.producers, self.consumers))
+        else:
+            parts.append("fill-drain")
+        if self.priorities:
+            parts.append("priorities=%i" % self.priorities)
+        return " ".join(parts)
+
+    def make_queue(self):
+        if self.queue.startswith("std."):
+            cls = getattr(std_queue, self.queue[4:])
+        else:
+            cls = getattr(filequeue, self.queue)
+        return cls(self.maxsize)
+
+
+def cases():
+    for item_size in ITEM_SIZES:
+        for name in ("Queue", "LifoQueue"):
+            yield Case("std." + name, item_size)
+        for name in ("FileQueue", "LifoFileQueue"):
+            for maxsize in MAXSIZES:
+                yield Case(name, item_size, maxsize)
+        for priorities in PRIORITIES:
+            yield Case("std.PriorityQueue", item_size, priorities=priorities)
+            for maxsize in MAXSIZES:
+                yield Case("PriorityFileQueue", item_size, maxsize,
+                           priorities=priorities)
+        for producers, consumers in THREADS:
+            yield Case("std.Queue", item_size, producers=producers,
+                       consumers=consumers)
+            for name in ("FileQueue", "ShardedFileQueue"):
+                for maxsize in MAXSIZES:
+                    yield Case(name, item_size, maxsize, producers,
+                               consumers)
+
+
+def make_put(q, case):
+    """
+    Return a function putting item number 'i' into the queue.
+    """
+    payload = b"x" * case.item_size
+    if case.queue == "std.PriorityQueue":
+        return lambda i: q.put((i % case.priorities, i, payload))
+    if case.priorities:
+        return lambda i: q.put(payload, priority=i % case.priorities)
+    return lambda i: q.put(payload)
+
+
+def fill_drain(case, count):
+    q = case.make_queue()
+    put = make_put(q, case)
+    get = q.get
+    start = clock()
+    for i in range(count):
+        put(i)
+    for i in range(count):
+        get()
+    return clock() - start, q
+
+
+def threaded(case, count):
+    q = case.make_queue()
+    put = make_put(q, case)
+    per_producer = count // case.producers
+    count = per_producer * case.producers
+    per_consumer = [count // case.consumers] * case.consumers
+    per_consumer[0] += count - sum(per_consumer)
+
+    def produce():
+        for i in range(per_producer):
+            put(i)
+
+    def consume(n):
+        get = q.get
+        for i in range(n):
+            get()
+
+    threads = [threading.Thread(target=produce)
+               for i in range(case.producers)]
+    threads += [threading.Thread(target=consume, args=(n,))
+                for n in per_consumer]
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clock() - start, q
+
+
+def run_case(case, scale):
+    count = max(1, min(MAX_ITEMS, VOLUME // case.item_size) // scale)
+    if case.producers:
+        seconds, q = threaded(case, count)
+        count = count // case.producers * case.producers
+    else:
+        seconds, q = fill_drain(case, count)
+    if hasattr(q, "dispose"):
+        q.dispose()
+    return dict(name=case.name, queue=case.queue, item_size=case.item_size,
+                maxsize=case.maxsize, producers=case.producers,
+                consumers=case.consumers, priorities=case.priorities,
+                items=count, seconds=seconds,
+                items_per_sec=count / seconds,
+                mb_per_sec=count * case.item_size / seconds / 1e6)
+
+
+def machine():
+    return dict(python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                platform=platform.platform(), processor=platform.processor(),
+                cpus=getattr(os, "cpu_count", lambda: None)(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def print_results(results, earlier=None):
+    earlier = dict((result["name"], result) for result in earlier or ())
+    for result in results:
+        line = "%-66s %10.0f items/s %8.1f MB/s" % (
+            result["name"], result["items_per_sec"], result["mb_per_sec"])
+        before = earlier.get(result["name"])
+        if before is not None:
+            line += "  %+6.1f%%" % (
+                (result["items_per_sec"] / before["items_per_sec"] - 1) * 100)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true",
+                        help="queue a tenth as many items per case")
+    parser.add_argument("--filter", default="",
+                        help="only run cases whose name contains this")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare",
+                        help="show the change from the results in this file")
+    args = parser.parse_args(argv)
+    scale = 10 if args.quick else 1
+    earlier = None
+    if args.compare:
+        with open(args.compare) as results_file:
+            earlier = json.load(results_file)["results"]
+    results = []
+    for case in cases():
+        if args.filter in case.name:
+            results.append(run_case(case, scale))
+            print_results(results[-1:], earlier)
+            sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(dict(machine=machine(), quick=args.quick,
+                           results=results), results_file, indent=2,
+                      sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
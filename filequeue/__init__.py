@@ -1 +1,6 @@
 from .filequeue import *
+try:
+    from .asyncqueue import *
+except (ImportError, SyntaxError):
+    # python 2, no asyncio
+    pass
@@ -0,0 +1,394 @@
+"""
+asyncio counterparts of the queue classes (python 3 only).
+
+Each async queue wraps one of the threaded queues, so the overflow is written
+in the same format. Every call on the wrapped queue runs on a single worker
+thread, which keeps them in order and keeps disk I/O off the event loop.
+"""
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .filequeue import (DEFAULT, DEFAULT_FLUSH_ITEMS, Empty, FileQueue,
+                        LifoFileQueue, PriorityFileQueue)
+
+__all__ = ["AsyncFileQueue", "AsyncLifoFileQueue", "AsyncPriorityFileQueue"]
+
+
+class AsyncFileQueue(object):
+    """
+    FileQueue for asyncio, with the interface of asyncio.Queue.
+
+    Puts never wait: items are collected in memory and handed to the
+    wrapped queue in batches of 'batch_size' on the worker thread (or sooner
+    when a get needs them). A get that has to go to the wrapped queue takes a
+    batch of items at a time, so most gets don't leave the event loop.
+    """
+
+    _queue_class = FileQueue
+    # Whether items taken from the wrapped queue in a batch can be handed out
+    # later. Not for LIFO or priority order, where a newer put can come first
+    _batch_gets = True
+
+    def __init__(self, maxsize=0, batch_size=DEFAULT_FLUSH_ITEMS, **kwargs):
+        """
+        :type maxsize: int
+        :param maxsize: Buffer size of the wrapped queue
+        :type batch_size: int
+        :param batch_size: Number of items put, or got, at a time on the
+            worker thread
+        :param kwargs: Passed on to the wrapped queue. With
+            'max_disk_bytes', 'disk_full' must be "raise": the worker thread
+            can't block as gets need it, and items dropped by the wrapped
+            queue would already have been counted by this one. The Full is
+            raised by a later call, as for any put that fails. It can't be
+            'unique' or 'expiring', for the same reason
+        """
+        if batch_size < 1:
+            raise ValueError("'batch_size' must be at least 1")
+        if (kwargs.get("max_disk_bytes") is not None and
+                kwargs.get("disk_full", "block") != "raise"):
+            raise ValueError("An async queue with 'max_disk_bytes' needs "
+                             "disk_full='raise'")
+        if kwargs.get("unique") or kwargs.get("key") is not None:
+            raise ValueError("An async queue can't be unique")
+        if kwargs.get("expiring") or kwargs.get("ttl") is not None:
+            raise ValueError("An async queue can't be expiring")
+        self._queue = self._queue_class(maxsize, **kwargs)
+        self._batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # items put but not yet passed on to the wrapped queue
+        self._incoming = []
+        # items already taken from the wrapped queue, oldest first
+        self._ready = deque()
+        # items available to a get (not counting those a waiting get has
+        # already claimed)
+        self._count = 0
+        self._getters = deque()
+        self._unfinished_tasks = 0
+        # set when the unfinished tasks are done, made by a join that has to
+        # wait (so in the running loop) and dropped once set
+        self._finished = None
+        # (first error, number of items not put) of the batch puts that
+        # failed since the last call, set by the worker thread
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        return self._queue.maxsize
+
+    def qsize(self):
+        """
+        Return the number of items in the queue.
+        """
+        return self._count
+
+    def empty(self):
+        """
+        Return True if the queue is empty, False otherwise.
+        """
+        return not self._count
+
+    def full(self):
+        """
+        Return True if the wrapped queue is full, which only a queue with
+        'max_disk_bytes' can be. Only a guess, as for FileQueue.full, and
+        the items put but not yet passed on to the wrapped queue aren't
+        counted: a put that fits now can still fail with Full later.
+        """
+        return self._queue.full()
+
+    def dispose(self):
+        """
+        Wait for the worker thread to finish and remove the overflow.
+        """
+        self._executor.shutdown(wait=True)
+        self._queue.dispose()
+
+    def compression_ratio(self):
+        return self._queue.compression_ratio()
+
+    def stats(self):
+        """
+        Return the wrapped queue's stats(), with 'qsize' as seen by this
+        queue, and 'incoming' and 'ready' counting the items put but not yet
+        passed on to the wrapped queue and those taken from it for later gets.
+        """
+        stats = self._queue.stats()
+        stats.update(qsize=self._count, incoming=len(self._incoming),
+                     ready=len(self._ready))
+        return stats
+
+    def _check_error(self):
+        """
+        Raise the error of a batch put that failed on the worker thread (the
+        first, if several have), and stop counting the items that weren't
+        put.
+        """
+        if self._error is not None:
+            with self._error_lock:
+                (error, failed), self._error = self._error, None
+            self._count -= failed
+            self._unfinished_tasks -= failed
+            if not self._unfinished_tasks:
+                self._tasks_finished()
+            raise error
+
+    def _submit(self, function, *args):
+        self._check_error()
+        return self._executor.submit(function, *args)
+
+    def _flush(self):
+        """
+        Pass the collected items on to the wrapped queue on the worker thread.
+        """
+        if self._incoming:
+            batch, self._incoming = self._incoming, []
+            self._submit(self._put_batch, batch)
+
+    def _put_batch(self, batch):
+        failed = 0
+        error = None
+        for run, put_many in self._put_runs(batch):
+            try:
+                put_many(run)
+            except Exception:
+                # nothing waits for a put, so put every item that can be and
+                # leave the first error to be raised by the next call
+                for item in run:
+                    try:
+                        put_many([item])
+                    except Exception as e:
+                        failed += 1
+                        if error is None:
+                            error = e
+        if failed:
+            with self._error_lock:
+                if self._error is not None:
+                    error, earlier = self._error
+                    failed += earlier
+                self._error = (error, failed)
+
+    def _put_runs(self, batch):
+        """
+        Split a batch of collected items into lists that can each be put
+        with one put_many, and return them with the function to put them.
+        """
+        return [(batch, self._queue.put_many)]
+
+    def _append(self, item, priority):
+        self._incoming.append(item)
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def put_nowait(self, item, priority=DEFAULT):
+        """
+        Put an item into the queue without waiting (it never has to).
+        """
+        self._check_error()
+        self._append(item, priority)
+        self._count += 1
+        self._unfinished_tasks += 1
+        if len(self._incoming) >= self._batch_size:
+            self._flush()
+        self._wakeup_next()
+
+    async def put(self, item, priority=DEFAULT):
+        """
+        Put an item into the queue.
+        """
+        self.put_nowait(item, priority)
+
+    async def put_many(self, items, priority=DEFAULT):
+        """
+        Put every item from the iterable 'items' into the queue.
+        """
+        for item in items:
+            self.put_nowait(item, priority)
+
+    def _take(self, count):
+        """
+        Take 'count' items from the wrapped queue, on the worker thread.
+        """
+        try:
+            return self._queue.get_many(count, False)
+        except Empty:
+            # another get took them in a batch, they're in _ready
+            return []
+
+    def _take_size(self, count):
+        if self._batch_gets:
+            return max(count, self._batch_size)
+        return count
+
+    def _collect(self, count, items, taken):
+        """
+        Add the first of the 'taken' items to 'items', up to 'count', and
+        keep the rest for later gets.
+        """
+        if not self._batch_gets:
+            items.extend(taken)
+            return
+        need = count - len(items)
+        items.extend(taken[:need])
+        self._ready.extend(taken[need:])
+
+    def _claimed(self, count):
+        """
+        Return 'count' items already claimed from the queue, those taken
+        before first.
+        """
+        items = []
+        ready = self._ready
+        while ready and len(items) < count:
+            items.append(ready.popleft())
+        return items
+
+    async def _wait(self):
+        loop = asyncio.get_running_loop()
+        while not self._count:
+            getter = loop.create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if self._count and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+
+    async def get_many(self, max_items):
+        """
+        Remove and return a list of up to 'max_items' items, waiting until at
+        least one is available.
+        """
+        if max_items < 1:
+            raise ValueError("'max_items' must be at least 1")
+        await self._wait()
+        count = min(max_items, self._count)
+        self._count -= count
+        items = self._claimed(count)
+        try:
+            while len(items) < count:
+                self._flush()
+                future = asyncio.wrap_future(self._submit(
+                    self._take, self._take_size(count - len(items))))
+                try:
+                    # the worker can't be interrupted, if this get is
+                    # cancelled the items it takes are kept for the next
+                    taken = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    future.add_done_callback(self._keep_taken)
+                    raise
+                self._collect(count, items, taken)
+                items.extend(self._claimed(count - len(items)))
+        except:
+            # hand back whatever couldn't be returned
+            self._ready.extendleft(reversed(items))
+            self._count += count
+            self._wakeup_next()
+            raise
+        return items
+
+    def _keep_taken(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._ready.extend(future.result())
+
+    async def get(self):
+        """
+        Remove and return an item from the queue, waiting until one is
+        available.
+        """
+        return (await self.get_many(1))[0]
+
+    def get_nowait(self):
+        """
+        Return an item if one is immediately available, else raise
+        asyncio.QueueEmpty. This waits for the worker thread if the item has
+        to come from the wrapped queue, use get in a coroutine to avoid that.
+        """
+        if not self._count:
+            raise asyncio.QueueEmpty
+        self._count -= 1
+        items = self._claimed(1)
+        try:
+            while not items:
+                self._flush()
+                self._collect(1, items, self._submit(
+                    self._take, self._take_size(1)).result())
+                items.extend(self._claimed(1 - len(items)))
+        except:
+            self._count += 1
+            raise
+        return items[0]
+
+    def task_done(self):
+        """
+        Indicate that a formerly enqueued task is complete, as for
+        asyncio.Queue.
+        """
+        if self._unfinished_tasks <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished_tasks -= 1
+        if not self._unfinished_tasks:
+            self._tasks_finished()
+
+    def _tasks_finished(self):
+        if self._finished is not None:
+            self._finished.set()
+            self._finished = None
+
+    async def join(self):
+        """
+        Wait until every item put into the queue has been got and processed.
+        """
+        if self._unfinished_tasks:
+            if self._finished is None:
+                self._finished = asyncio.Event()
+            await self._finished.wait()
+
+
+class AsyncLifoFileQueue(AsyncFileQueue):
+    """
+    LifoFileQueue for asyncio, with the interface of asyncio.LifoQueue.
+    """
+
+    _queue_class = LifoFileQueue
+    _batch_gets = False
+
+
+class AsyncPriorityFileQueue(AsyncFileQueue):
+    """
+    PriorityFileQueue for asyncio. As with PriorityFileQueue, put takes the
+    priority as a keyword argument instead of as part of the item.
+    """
+
+    _queue_class = PriorityFileQueue
+    _batch_gets = False
+
+    def _append(self, item, priority):
+        self._incoming.append((priority, item))
+
+    def _put_runs(self, batch):
+        # each run of items with the same priority is put together
+        runs = []
+        start = 0
+        for i in range(1, len(batch) + 1):
+            if i == len(batch) or batch[i][0] != batch[start][0]:
+                runs.append(([item for p, item in batch[start:i]],
+                             partial(self._queue.put_many,
+                                     priority=batch[start][0])))
+                start = i
+        return runs
@@ -1,8 +1,22 @@
-#import gzip
-import bisect
+import heapq
+import itertools
+import marshal
+import math
+import mmap
+import os
+import select
+import shutil
+import sqlite3
+import struct
 import tempfile
-from time import time as _time
-from errno import EINVAL
+import threading
+import zlib
+from collections import deque
+from time import sleep as _time_sleep, time as _time
+try:
+    from time import perf_counter as _clock
+except ImportError:
+    _clock = _time
 try:
     import cPickle as _pickle
 except ImportError:
@@ -11,259 +25,3885 @@ try:
     from Queue import Queue, Empty, Full
 except ImportError:
     from queue import Queue, Empty, Full
-from contextlib import contextmanager
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    # python 2's sqlite3 only takes byte strings as blobs in a buffer
+    _blob = buffer
+except NameError:
+    _blob = bytes
+
+__all__ = ["Empty", "Full", "FileQueue", "PriorityFileQueue", "LifoFileQueue",
+           "DelayFileQueue", "ShardedFileQueue", "ProcessFileQueue",
+           "PickleSerializer", "MarshalSerializer", "BytesSerializer"]
+
+DEFAULT = None
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_FLUSH_ITEMS = 1000
+DEFAULT_FLUSH_BYTES = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_READ_AHEAD = 1000
+DEFAULT_UNIQUE_CAPACITY = 1000000
+
+# What a put does when the overflow has reached 'max_disk_bytes'
+_DISK_FULL_POLICIES = ("block", "raise", "drop_oldest", "drop_newest")
+
+# FileQueue arguments that apply to a PriorityFileQueue's shared spill
+_SHARED_SPILL_OPTIONS = ("segment_size", "flush_items", "flush_bytes",
+                         "flush_interval", "compression", "spill_dir",
+                         "preallocate", "fadvise")
+
+# record count, stored payload length, codec id, crc32 of the stored payload
+_BLOCK_HEADER = struct.Struct("<IIBI")
+_RECORD_HEADER = struct.Struct("<I")
+# LifoFileQueue block trailer: block length, crc32 of the block header
+_LIFO_TRAILER = struct.Struct("<II")
+# DelayFileQueue record prefix: the time the item is due
+_DUE_TIME = struct.Struct("<d")
+# expiring queue record prefix: the time the item expires
+_EXPIRY = struct.Struct("<d")
+_NEVER = float("inf")
+# what an expiring queue's serializer loads for a record that's expired
+_EXPIRED = (0.0, None)
+
+# ProcessFileQueue state: head segment id, head block position, items taken
+# from the head block, tail segment id, tail position, item count, unfinished
+# task count
+_PROCESS_STATE = struct.Struct("<QQIQQQQ")
+# Longest a blocked ProcessFileQueue get waits before checking the queue again,
+# in case its wakeup went to another process
+_PROCESS_POLL_INTERVAL = 0.1
+
+_SEGMENT_SUFFIX = ".seg"
+_SEGMENT_NAME = "%016i" + _SEGMENT_SUFFIX
+_INDEX_SUFFIX = ".idx"
+_INDEX_NAME = "%016i" + _INDEX_SUFFIX
+# Durable segment index: segment size, sequence number of the first record,
+# record count, block count, crc32 of the entries. Followed by an entry per
+# block: end position, record count
+_INDEX_HEADER = struct.Struct("<QQQII")
+_INDEX_ENTRY = "QI"
+
+_file_open = open
+# not on windows, or python 2
+_posix_fadvise = getattr(os, "posix_fadvise", None)
+_posix_fallocate = getattr(os, "posix_fallocate", None)
+
+
+def _replace(source, destination):
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        # python 2, rename won't overwrite on windows
+        if os.name == "nt" and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+class PickleSerializer(object):
+    """
+    Serializer for items in the overflow, the default. A serializer is any
+    object with a 'dumps' method returning bytes and a 'loads' method taking
+    them back to an item.
+    """
+
+    def __init__(self, protocol=_pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, item):
+        return _pickle.dumps(item, self.protocol)
+
+    def loads(self, data):
+        return _pickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """
+    Serializer for items made only of builtin types (dicts, lists, strings,
+    numbers...). Smaller and quicker to load than pickle for simple records.
+    """
+
+    def __init__(self, version=marshal.version):
+        self.version = version
+
+    def dumps(self, item):
+        return marshal.dumps(item, self.version)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class BytesSerializer(object):
+    """
+    Serializer for queues of bytes. Items are written to the overflow as they
+    are, each record already carries its length. Accepts bytes, bytearray and
+    memoryview items, all come back out as bytes (or as memoryviews of the
+    file when read back with use_mmap).
+    """
+
+    def dumps(self, item):
+        if isinstance(item, bytes):
+            return item
+        if isinstance(item, memoryview):
+            return item.tobytes()
+        if isinstance(item, bytearray):
+            return bytes(item)
+        raise TypeError("BytesSerializer can only queue bytes-like items, "
+                        "not %s" % type(item).__name__)
+
+    def loads(self, data):
+        return data
+
+
+_DEFAULT_SERIALIZER = PickleSerializer()
+
+
+class _DueSerializer(object):
+    """
+    Serializer for the levels of a DelayFileQueue, which queue (due time,
+    item) pairs: the time is written ahead of the item as serialised by the
+    queue's own serializer.
+    """
+
+    def __init__(self, serializer):
+        self._dumps = serializer.dumps
+        self._loads = serializer.loads
+
+    def dumps(self, entry):
+        return _DUE_TIME.pack(entry[0]) + self._dumps(entry[1])
+
+    def loads(self, data):
+        return (_DUE_TIME.unpack_from(data)[0],
+                self._loads(data[_DUE_TIME.size:]))
+
+
+class _ExpirySerializer(object):
+    """
+    Serializer for an expiring FileQueue, which queues (expiry time, item)
+    pairs: the time is written ahead of the item as serialised by the
+    queue's own serializer, so an expired record is recognised without
+    loading the item.
+    """
+
+    def __init__(self, serializer):
+        self._dumps = serializer.dumps
+        self._loads = serializer.loads
+
+    def dumps(self, entry):
+        return _EXPIRY.pack(entry[0]) + self._dumps(entry[1])
+
+    def loads(self, data):
+        expires = _EXPIRY.unpack_from(data)[0]
+        if expires <= _time():
+            return _EXPIRED
+        return expires, self._loads(data[_EXPIRY.size:])
+
+
+class _Segment(object):
+    """
+    One file in the overflow chain. A single file object is shared for reads
+    and writes (separate read and write descriptors don't work on windows).
+    """
+
+    def __init__(self, directory=None):
+        self.file = tempfile.NamedTemporaryFile(suffix=".queue",
+                                                dir=directory)
+        self.read_pos = self.write_pos = 0
+        # (end position, record count) of each unread block
+        self.blocks = deque()
+        self.map = None
+        # how far writes have been flushed to the file, for the mapping
+        self.flushed = 0
+        # end of the data in the file, which is past write_pos once it's been
+        # rewound, or popped blocks are left behind
+        self.size = 0
+        # latest expiry time of the records written, for an expiring queue
+        self.expires = 0.0
+
+    def mapped(self, end):
+        """
+        Return a read-only view of the file covering at least up to 'end'.
+        The file is mapped again when it's grown past the current mapping,
+        earlier mappings stay alive for as long as anything refers to them.
+        Writes are flushed first if they haven't been up to 'end' (the
+        mapping may already cover them, in a preallocated file).
+        """
+        if end > self.flushed:
+            self.file.flush()
+            self.flushed = self.write_pos
+        if self.map is None or len(self.map) < end:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        try:
+            return memoryview(self.map)
+        except TypeError:
+            # python 2 mmaps don't export buffers, slices are copies
+            return self.map
+
+    def reset(self):
+        self.read_pos = self.write_pos = self.size = self.flushed = 0
+        self.expires = 0.0
+        self.blocks.clear()
+        self.file.seek(0)
+        self.file.truncate()
+
+    def close(self):
+        self.file.close()
+
+
+class _Codec(object):
+    """
+    A compression format for overflow blocks. 'codec_id' goes in each block
+    header so a block can always be read back with the codec that wrote it.
+    """
+
+    def __init__(self, codec_id, compress, decompress):
+        self.codec_id = codec_id
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+_NO_CODEC = 0
+_CUSTOM_CODEC = 255
+_CODECS = {"zlib": _Codec(1, zlib.compress, zlib.decompress),
+           "gzip": _Codec(2, _gzip_compress, _gzip_decompress)}
+if lzma is not None:
+    _CODECS["lzma"] = _Codec(3, lzma.compress, lzma.decompress)
+if bz2 is not None:
+    _CODECS["bz2"] = _Codec(4, bz2.compress, bz2.decompress)
+_CODECS_BY_ID = dict((codec.codec_id, codec) for codec in _CODECS.values())
+
+
+def _get_codec(compression):
+    """
+    Return the _Codec for a 'compression' argument: None, the name of a
+    built in codec, or an object with 'compress' and 'decompress' methods.
+    """
+    if compression is None:
+        return None
+    if hasattr(compression, "compress") and hasattr(compression, "decompress"):
+        return _Codec(_CUSTOM_CODEC, compression.compress,
+                      compression.decompress)
+    try:
+        return _CODECS[compression]
+    except (KeyError, TypeError):
+        raise ValueError("Unknown compression %r, expected one of %s or an "
+                         "object with compress and decompress methods"
+                         % (compression, ", ".join(sorted(_CODECS))))
+
+
+def _encode_block(records, codec=None):
+    """
+    Frame a list of serialised items as one block: a header with the record
+    count, payload length and codec, then each record prefixed with its
+    length. The records are compressed together when a codec is given,
+    unless that doesn't make them any smaller.
+    """
+    pack = _RECORD_HEADER.pack
+    payload = b"".join([pack(len(record)) + record for record in records])
+    codec_id = _NO_CODEC
+    if codec is not None:
+        compressed = codec.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            codec_id = codec.codec_id
+    return _BLOCK_HEADER.pack(len(records), len(payload), codec_id,
+                              zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def _decode_block(count, data, pos=0):
+    """
+    Return the records of the block payload found at 'pos' in 'data'.
+    """
+    unpack_from = _RECORD_HEADER.unpack_from
+    header_size = _RECORD_HEADER.size
+    records = []
+    for i in range(count):
+        record_len, = unpack_from(data, pos)
+        pos += header_size
+        records.append(data[pos:pos + record_len])
+        pos += record_len
+    return records
+
+
+def _decode_blocks(data, codec=None):
+    """
+    Return the records of every block in 'data', a run of whole blocks.
+    'codec' is the queue's own codec, needed for custom compression.
+    """
+    unpack_from = _BLOCK_HEADER.unpack_from
+    header_size = _BLOCK_HEADER.size
+    records = []
+    pos = 0
+    while pos < len(data):
+        count, payload_len, codec_id, crc = unpack_from(data, pos)
+        pos += header_size
+        if zlib.crc32(data[pos:pos + payload_len]) & 0xffffffff != crc:
+            raise IOError("Overflow block failed its checksum")
+        if codec_id == _NO_CODEC:
+            records.extend(_decode_block(count, data, pos))
+        else:
+            if codec_id == _CUSTOM_CODEC:
+                decompress = codec.decompress
+            else:
+                decompress = _CODECS_BY_ID[codec_id].decompress
+            records.extend(_decode_block(
+                count, decompress(data[pos:pos + payload_len])))
+        pos += payload_len
+    return records
+
+
+class _Spill(object):
+    """
+    The overflow of a FileQueue: serialised items waiting on disk.
+
+    Items aren't written one at a time, they are collected in memory and
+    written as a single block once there are 'flush_items' of them,
+    'flush_bytes' worth, or the oldest has waited 'flush_interval' seconds.
+    A reader that catches up with the unwritten items takes them straight from
+    memory, so the file is only touched for items that really did back up.
+
+    Reads are done 'read_ahead' items at a time, as many whole blocks as it
+    takes in a single read call. With 'prefetch' set a background thread keeps
+    that many items read ahead from the segments that are no longer being
+    written to, so gets draining a large backlog don't wait on the disk.
+
+    With 'use_mmap' set segments are memory mapped for reading and records
+    are memoryviews into the mapping rather than copies. Nothing handed out
+    may change afterwards, so segments are never rewound or reused and the
+    spare segment isn't kept.
+
+    Segment files are created in 'spill_dir' (the temp directory by default)
+    as the first block is written, not before. With 'preallocate' each
+    segment has 'segment_size' bytes allocated up front, and with 'fadvise'
+    the OS is told segments are read sequentially and that what's been read
+    won't be needed again, so draining the queue doesn't fill the page cache.
+    Both are ignored where the OS doesn't support them.
+
+    With 'expiring' set, records start with their expiry time (see
+    _ExpirySerializer) and each segment notes the latest one written to it.
+    A segment no longer being written to whose records have all expired is
+    dropped without being read, and its records counted in 'expired' for
+    the FileQueue to take with take_expired().
+
+    Writes and reads can come from different threads at once: writers hold
+    the chain lock, and readers take it only to hand over unwritten items or
+    plan a read. Segments no longer being written to are read outside it.
+    Only one thread may read at a time, the FileQueue sees to that.
+    """
+
+    def __init__(self, segment_size=DEFAULT_SEGMENT_SIZE,
+                 flush_items=DEFAULT_FLUSH_ITEMS,
+                 flush_bytes=DEFAULT_FLUSH_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 read_ahead=DEFAULT_READ_AHEAD, prefetch=False,
+                 compression=None, use_mmap=False, spill_dir=None,
+                 preallocate=False, fadvise=False, expiring=False):
+        self._segment_size = segment_size
+        self._spill_dir = spill_dir
+        self._preallocate = preallocate and _posix_fallocate is not None
+        self._fadvise = fadvise and _posix_fadvise is not None
+        self._flush_items = flush_items
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._read_ahead = max(1, read_ahead)
+        self._segments = deque()
+        self._spare_segment = None
+        self._pending = self._new_pending()
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._read_buffer = deque()
+        # Guards the segment chain and the unwritten items against readers
+        # and the prefetch thread (the tail lock, writers hold it throughout)
+        self._chain_cond = threading.Condition(threading.RLock())
+        self._prefetch = prefetch
+        self._prefetch_thread = None
+        self._prefetch_busy = False
+        self._closed = False
+        self._codec = _get_codec(compression)
+        self._raw_bytes = self._stored_bytes = 0
+        self._use_mmap = use_mmap
+        self._expiring = expiring
+        self.expired = 0
+
+    _new_pending = deque
+
+    def compression_ratio(self):
+        """
+        Return the size of the blocks written so far over their size on disk.
+        """
+        if not self._stored_bytes:
+            return 1.0
+        return float(self._raw_bytes) / self._stored_bytes
+
+    def disk_usage(self):
+        """
+        Return the number of segment files, their total size in bytes, and
+        how many of those bytes hold nothing still queued.
+        """
+        with self._chain_cond:
+            size = sum(segment.size for segment in self._segments)
+            live = sum(segment.write_pos - segment.read_pos
+                       for segment in self._segments)
+            return len(self._segments), size, size - live
+
+    def _encode_block(self, records):
+        block = _encode_block(records, self._codec)
+        self._raw_bytes += (_BLOCK_HEADER.size + len(records) *
+                            _RECORD_HEADER.size + sum(map(len, records)))
+        self._stored_bytes += len(block)
+        return block
+
+    def close(self):
+        if self._closed:
+            return
+        with self._chain_cond:
+            self._closed = True
+            self._chain_cond.notify_all()
+            while self._segments:
+                self._segments.popleft().close()
+            if self._spare_segment is not None:
+                self._spare_segment.close()
+                self._spare_segment = None
+
+    def _new_segment(self):
+        """
+        Add a segment to the end of the chain, reusing the spare if there is one.
+        """
+        with self._chain_cond:
+            if (self._segments and
+                    self._segments[0].read_pos >= self._segments[0].write_pos):
+                # a mapped segment that's been read to the end is kept while
+                # it's the last (see _read_done), readers only look at the
+                # first so it has to go once there's another
+                self._release_segment(self._segments.popleft())
+            segment, self._spare_segment = self._spare_segment, None
+            if segment is None:
+                segment = _Segment(self._spill_dir)
+            self._prepare_segment(segment)
+            self._segments.append(segment)
+            if self._prefetch and len(self._segments) > 1:
+                self._start_prefetch()
+        return segment
+
+    def _prepare_segment(self, segment):
+        """
+        Preallocate a new (or emptied) segment and give the OS the read hint,
+        as asked.
+        """
+        if self._preallocate:
+            _posix_fallocate(segment.file.fileno(), 0, self._segment_size)
+        if self._fadvise:
+            _posix_fadvise(segment.file.fileno(), 0, 0,
+                           os.POSIX_FADV_SEQUENTIAL)
+
+    def _release_segment(self, segment):
+        """
+        Drop a segment that has been fully read. One is kept back as a spare
+        (emptied, so it holds no disk space) to save recreating a file when
+        the queue keeps crossing a segment boundary.
+        """
+        if self._spare_segment is None and not self._use_mmap:
+            segment.reset()
+            self._spare_segment = segment
+        else:
+            segment.close()
+
+    def _write_segment(self):
+        """
+        Return the segment new blocks should be written to.
+        """
+        if (not self._segments or
+                self._segments[-1].write_pos >= self._segment_size):
+            return self._new_segment()
+        return self._segments[-1]
+
+    def write(self, record):
+        with self._chain_cond:
+            if not self._pending:
+                self._pending_since = _time()
+            self._pending.append(record)
+            self._pending_bytes += len(record)
+            self._check_flush()
+
+    def write_many(self, records):
+        with self._chain_cond:
+            if not self._pending:
+                self._pending_since = _time()
+            self._pending.extend(records)
+            self._pending_bytes += sum(map(len, records))
+            self._check_flush()
+
+    def _check_flush(self):
+        if (len(self._pending) >= self._flush_items or
+                self._pending_bytes >= self._flush_bytes or
+                (self._flush_interval is not None and
+                 _time() - self._pending_since >= self._flush_interval)):
+            self._flush_due()
+
+    def _flush_due(self):
+        self.flush()
+
+    def flush(self):
+        """
+        Write every item still held in memory to disk.
+        """
+        with self._chain_cond:
+            if self._pending:
+                self._write_records(list(self._pending))
+                self._pending = self._new_pending()
+                self._pending_bytes = 0
+
+    def _write_records(self, records):
+        """
+        Write records to disk in blocks of at most 'flush_items', with a
+        single write call however many blocks that makes.
+        """
+        step = self._flush_items
+        chunks = [records[i:i + step] for i in range(0, len(records), step)]
+        self._write_blocks([self._encode_block(chunk) for chunk in chunks],
+                           [len(chunk) for chunk in chunks])
+        if self._expiring:
+            # the blocks all went to the last segment
+            unpack = _EXPIRY.unpack_from
+            segment = self._segments[-1]
+            segment.expires = max(segment.expires,
+                                  max(unpack(record)[0] for record in records))
+
+    def _skip_expired(self):
+        """
+        Drop the leading segments (not the one being written to) whose
+        records have all expired, without reading them.
+        """
+        now = _time()
+        segments = self._segments
+        while len(segments) > 1 and segments[0].expires <= now:
+            segment = segments[0]
+            self.expired += sum(count for end, count in segment.blocks)
+            segment.blocks.clear()
+            self._read_done(segment, segment.write_pos)
+
+    def take_expired(self):
+        """
+        Return the number of records dropped by _skip_expired since the last
+        call.
+        """
+        with self._chain_cond:
+            expired, self.expired = self.expired, 0
+            return expired
+
+    def _write_blocks(self, blocks, counts):
+        segment = self._write_segment()
+        segment.file.seek(segment.write_pos)
+        segment.file.write(b"".join(blocks))
+        for block, count in zip(blocks, counts):
+            segment.write_pos += len(block)
+            segment.blocks.append((segment.write_pos, count))
+        segment.size = max(segment.size, segment.write_pos)
+
+    def _plan_read(self, segment, want=1):
+        """
+        Take enough of the segment's unread blocks to give 'read_ahead'
+        records (or 'want', if more) and return the end position of the
+        last one.
+        """
+        blocks = segment.blocks
+        end = segment.read_pos
+        count = 0
+        want = max(want, self._read_ahead)
+        while blocks and count < want:
+            end, block_count = blocks.popleft()
+            count += block_count
+        return end
+
+    def _read_data(self, segment, start, end):
+        if self._use_mmap:
+            return segment.mapped(end)[start:end]
+        segment.file.seek(start)
+        data = segment.file.read(end - start)
+        if self._fadvise:
+            # read once, drop it from the page cache
+            _posix_fadvise(segment.file.fileno(), start, end - start,
+                           os.POSIX_FADV_DONTNEED)
+        return data
+
+    def _read_range(self, segment, start, end):
+        return _decode_blocks(self._read_data(segment, start, end),
+                              self._codec)
+
+    def _read_done(self, segment, end):
+        segment.read_pos = end
+        if end >= segment.write_pos:
+            if len(self._segments) > 1:
+                self._release_segment(self._segments.popleft())
+            elif self._use_mmap:
+                # Carry on writing after what's been read, it may still be
+                # in use through a memoryview
+                pass
+            else:
+                # Caught up with the writer, rewind rather than growing
+                segment.read_pos = segment.write_pos = 0
+
+    def _read_block(self, want=1):
+        """
+        Return the next records read ahead from disk, or None if there
+        aren't any.
+        """
+        with self._chain_cond:
+            if self._prefetch:
+                # Held on to until the read below is planned: segments that
+                # are no longer being written to are only read by the
+                # prefetch thread, a writer mustn't add one in the meantime
+                records = self._wait_prefetched()
+                if records is not None:
+                    return records
+            if self._expiring:
+                self._skip_expired()
+            if not self._segments:
+                return None
+            segment = self._segments[0]
+            if segment.read_pos >= segment.write_pos:
+                return None
+            start = segment.read_pos
+            end = self._plan_read(segment, want)
+            if segment is self._segments[-1]:
+                # still being written to, through the same file object
+                records = self._read_range(segment, start, end)
+                self._read_done(segment, end)
+                return records
+        records = self._read_range(segment, start, end)
+        with self._chain_cond:
+            self._read_done(segment, end)
+        return records
+
+    def _start_prefetch(self):
+        if self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(target=self._prefetch_run)
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+        else:
+            self._chain_cond.notify_all()
+
+    def _wait_prefetched(self):
+        """
+        Take whatever the prefetch thread has read. While there are segments
+        no longer being written to, those are left to the prefetch thread, so
+        wait for it rather than reading them here.
+        """
+        with self._chain_cond:
+            while True:
+                if self._prefetch_error is not None:
+                    raise self._prefetch_error
+                if self._prefetched:
+                    records = self._prefetched
+                    self._prefetched = deque()
+                    self._chain_cond.notify_all()
+                    return records
+                if not self._prefetch_busy and len(self._segments) < 2:
+                    return None
+                self._chain_cond.notify_all()
+                self._chain_cond.wait()
+
+    _prefetched = ()
+    _prefetch_error = None
+
+    def _prefetch_run(self):
+        cond = self._chain_cond
+        self._prefetched = deque()
+        while True:
+            with cond:
+                self._prefetch_busy = False
+                cond.notify_all()
+                while not self._closed and (
+                        len(self._segments) < 2 or
+                        len(self._prefetched) >= self._read_ahead):
+                    cond.wait()
+                if self._closed:
+                    return
+                if self._expiring:
+                    self._skip_expired()
+                    if len(self._segments) < 2:
+                        continue
+                segment = self._segments[0]
+                start = segment.read_pos
+                end = self._plan_read(segment)
+                self._prefetch_busy = True
+            try:
+                records = self._read_range(segment, start, end)
+            except Exception as err:
+                # Handed to the reader, unless it's from the files being
+                # closed under us
+                with cond:
+                    self._prefetch_busy = False
+                    if not self._closed:
+                        self._prefetch_error = err
+                    cond.notify_all()
+                return
+            with cond:
+                self._prefetched.extend(records)
+                self._read_done(segment, end)
+
+    def _fill_read_buffer(self, want=1):
+        records = self._read_block(want)
+        if records is None:
+            with self._chain_cond:
+                # look again now writers are held off, they may have just
+                # written out what was unwritten
+                records = self._read_block(want)
+                if records is None:
+                    if not self._pending:
+                        raise Empty
+                    # Caught up with the writer, hand over the unwritten items
+                    self._read_buffer, self._pending = (self._pending,
+                                                        self._new_pending())
+                    self._pending_bytes = 0
+                    return
+        self._read_buffer = deque(records)
+
+    def read(self):
+        """
+        Remove and return the next record, raises Empty if there isn't one.
+        """
+        if not self._read_buffer:
+            self._fill_read_buffer()
+        return self._read_buffer.popleft()
+
+    def read_many(self, count):
+        """
+        Remove and return a list of up to 'count' records.
+        """
+        records = []
+        while len(records) < count:
+            if not self._read_buffer:
+                try:
+                    self._fill_read_buffer(count - len(records))
+                except Empty:
+                    break
+            popleft = self._read_buffer.popleft
+            take = min(count - len(records), len(self._read_buffer))
+            records.extend([popleft() for i in range(take)])
+        return records
+
+
+class _LifoSpill(_Spill):
+    """
+    Overflow for LifoFileQueue. Unwritten items form the top of the stack, and
+    when they run out the newest blocks are read back off the end of the file.
+    Each block is followed by a trailer holding its length and the checksum of
+    its header so the file can be walked backwards. Popped blocks are left on
+    disk to be overwritten by the next write, the file is only truncated once
+    enough of them have built up past the write position.
+    Only the older half of the items in memory are flushed, so a queue sitting
+    on a flush threshold doesn't write and read back the same block each time.
+    """
+
+    _new_pending = list
+
+    def __init__(self, *args, **kwargs):
+        _Spill.__init__(self, *args, **kwargs)
+        # Blocks are read back from the end of the file, which is also where
+        # they are written, so there is nothing to prefetch, and popped
+        # blocks are overwritten so they can't be memory mapped
+        self._prefetch = False
+        self._use_mmap = False
+        self._truncate_slack = max(self._segment_size // 4, 1)
+
+    def _flush_due(self):
+        keep = min(len(self._pending), self._flush_items) // 2
+        if not keep:
+            return self.flush()
+        records = self._pending[:-keep]
+        del self._pending[:-keep]
+        self._write_records(records)
+        self._pending_bytes -= sum(map(len, records))
+        self._pending_since = _time()
+
+    def _write_blocks(self, blocks, counts):
+        header_size = _BLOCK_HEADER.size
+        _Spill._write_blocks(
+            self, [block + _LIFO_TRAILER.pack(
+                len(block), zlib.crc32(block[:header_size]) & 0xffffffff)
+                   for block in blocks], counts)
+
+    def _read_block(self, want=1):
+        # An emptied segment is only dropped once we need to read behind it
+        while len(self._segments) > 1 and not self._segments[-1].write_pos:
+            self._release_segment(self._segments.pop())
+        if not self._segments or not self._segments[-1].write_pos:
+            return None
+        segment = self._segments[-1]
+        # Take the newest blocks until there are enough records, and read
+        # them in one go
+        blocks = segment.blocks
+        count = 0
+        while blocks and count < want:
+            count += blocks.pop()[1]
+        start = blocks[-1][0] if blocks else 0
+        data = self._read_data(segment, start, segment.write_pos)
+        segment.write_pos = start
+        # a preallocated segment keeps its space
+        if (not self._preallocate and
+                segment.size - start >= self._truncate_slack):
+            segment.file.seek(start)
+            segment.file.truncate()
+            segment.size = start
+        return self._decode_trailed(data)
+
+    def _decode_trailed(self, data):
+        """
+        Return the records of 'data', a run of whole blocks each followed by
+        its trailer, checking every trailer against its block.
+        """
+        header_size = _BLOCK_HEADER.size
+        trailer_size = _LIFO_TRAILER.size
+        records = []
+        pos = 0
+        while pos < len(data):
+            payload_len = _BLOCK_HEADER.unpack_from(data, pos)[1]
+            end = pos + header_size + payload_len
+            block_len, crc = _LIFO_TRAILER.unpack_from(data, end)
+            if (block_len != end - pos or
+                    zlib.crc32(data[pos:pos + header_size]) & 0xffffffff
+                    != crc):
+                raise IOError("Overflow block trailer doesn't match its block")
+            records.extend(_decode_blocks(data[pos:end], self._codec))
+            pos = end + trailer_size
+        return records
+
+    def read(self):
+        with self._chain_cond:
+            if not self._pending:
+                records = self._read_block()
+                if records is None:
+                    raise Empty
+                self._pending = records
+                self._pending_bytes = sum(len(record) for record in records)
+                # back in memory from now, not since they were first put
+                self._pending_since = _time()
+            record = self._pending.pop()
+            self._pending_bytes -= len(record)
+            return record
+
+    def read_many(self, count):
+        with self._chain_cond:
+            records = []
+            while len(records) < count:
+                if not self._pending:
+                    block = self._read_block(count - len(records))
+                    if block is None:
+                        break
+                    self._pending = block
+                    self._pending_bytes = sum(map(len, block))
+                    self._pending_since = _time()
+                take = self._pending[-(count - len(records)):]
+                del self._pending[-len(take):]
+                take.reverse()
+                records.extend(take)
+                self._pending_bytes -= sum(map(len, take))
+            return records
+
+
+class _SharedSegment(_Segment):
+
+    def __init__(self, directory=None):
+        _Segment.__init__(self, directory)
+        self.live_blocks = 0
+
+
+class _SharedSpill(_Spill):
+    """
+    A single overflow shared by every priority level of a PriorityFileQueue.
+
+    Each level collects its own unwritten records (see _SharedSpillLevel),
+    but the thresholds for writing them apply to all levels together, and
+    when they're hit every level's records go to the end of the one segment
+    chain with a single write, a block per level. Levels keep an index of
+    where their blocks are and read them back directly. A segment is removed
+    once none of its blocks are left unread, whichever levels they belong to.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["prefetch"] = False
+        _Spill.__init__(self, **kwargs)
+        self._dirty = set()
+        self._pending_count = 0
+
+    def _new_segment(self):
+        segment, self._spare_segment = self._spare_segment, None
+        if segment is None:
+            segment = _SharedSegment(self._spill_dir)
+        self._prepare_segment(segment)
+        self._segments.append(segment)
+        return segment
+
+    def _pending_added(self, count, size):
+        if not self._pending_count:
+            self._pending_since = _time()
+        self._pending_count += count
+        self._pending_bytes += size
+        if (self._pending_count >= self._flush_items or
+                self._pending_bytes >= self._flush_bytes or
+                (self._flush_interval is not None and
+                 _time() - self._pending_since >= self._flush_interval)):
+            self.flush()
+
+    def _pending_removed(self, level):
+        self._dirty.discard(level)
+        self._pending_count -= len(level._pending)
+        self._pending_bytes -= level._pending_bytes
+
+    def flush(self):
+        if not self._dirty:
+            return
+        segment = self._write_segment()
+        pos = segment.write_pos
+        step = self._flush_items
+        blocks = []
+        for level in self._dirty:
+            records = list(level._pending)
+            for i in range(0, len(records), step):
+                block = self._encode_block(records[i:i + step])
+                level._blocks.append((segment, pos, len(block)))
+                pos += len(block)
+                blocks.append(block)
+            level._pending = deque()
+            level._pending_bytes = 0
+        segment.file.seek(segment.write_pos)
+        segment.file.write(b"".join(blocks))
+        segment.write_pos = pos
+        segment.size = max(segment.size, pos)
+        segment.live_blocks += len(blocks)
+        self._dirty = set()
+        self._pending_count = self._pending_bytes = 0
+
+    def read_block(self, segment, pos, size):
+        records = _decode_blocks(self._read_data(segment, pos, pos + size),
+                                 self._codec)
+        self.block_done(segment)
+        return records
+
+    def block_done(self, segment):
+        segment.live_blocks -= 1
+        if not segment.live_blocks:
+            if segment is self._segments[-1]:
+                # Nothing left in the segment being written, start it again
+                segment.write_pos = 0
+            else:
+                self._segments.remove(segment)
+                self._release_segment(segment)
+
+
+class _SharedSpillLevel(object):
+    """
+    The overflow of one priority level in a PriorityFileQueue with a shared
+    spill, with the same interface as _Spill.
+    """
+
+    _raw_bytes = _stored_bytes = 0
+
+    def __init__(self, shared, read_ahead=DEFAULT_READ_AHEAD):
+        self._shared = shared
+        self._read_ahead = max(1, read_ahead)
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._read_buffer = deque()
+        # (segment, position, size) of each unread block
+        self._blocks = deque()
+
+    def close(self):
+        if self._pending:
+            self._shared._pending_removed(self)
+            self._pending = deque()
+        while self._blocks:
+            self._shared.block_done(self._blocks.popleft()[0])
+
+    def compression_ratio(self):
+        return self._shared.compression_ratio()
+
+    def disk_usage(self):
+        # the files belong to the PriorityFileQueue
+        return 0, 0, 0
+
+    def write(self, record):
+        self._pending.append(record)
+        self._pending_bytes += len(record)
+        self._shared._dirty.add(self)
+        self._shared._pending_added(1, len(record))
+
+    def write_many(self, records):
+        size = sum(map(len, records))
+        self._pending.extend(records)
+        self._pending_bytes += size
+        self._shared._dirty.add(self)
+        self._shared._pending_added(len(records), size)
+
+    def flush(self):
+        self._shared.flush()
+
+    def _fill_read_buffer(self):
+        if self._blocks:
+            records = []
+            while self._blocks and len(records) < self._read_ahead:
+                records.extend(self._shared.read_block(
+                    *self._blocks.popleft()))
+            self._read_buffer = deque(records)
+        elif self._pending:
+            # Caught up with the writer, hand over the unwritten items
+            self._shared._pending_removed(self)
+            self._read_buffer, self._pending = self._pending, deque()
+            self._pending_bytes = 0
+        else:
+            raise Empty
+
+    def read(self):
+        if not self._read_buffer:
+            self._fill_read_buffer()
+        return self._read_buffer.popleft()
+
+    def read_many(self, count):
+        records = []
+        while len(records) < count:
+            if not self._read_buffer:
+                try:
+                    self._fill_read_buffer()
+                except Empty:
+                    break
+            popleft = self._read_buffer.popleft
+            take = min(count - len(records), len(self._read_buffer))
+            records.extend([popleft() for i in range(take)])
+        return records
+
+
+class _DurableSegment(_Segment):
+    """
+    A segment of a durable queue, a named file in the queue's directory that
+    is kept when closed, and deleted once it's been read. Once full it gets
+    an index file next to it listing its blocks.
+
+    The file is only opened when it's first used, so a large backlog doesn't
+    hold a descriptor open for every segment.
+    """
+
+    def __init__(self, directory, segment_id, first_seq=0):
+        self.segment_id = segment_id
+        self.name = os.path.join(directory, _SEGMENT_NAME % segment_id)
+        self.index_name = os.path.join(directory, _INDEX_NAME % segment_id)
+        # sequence number of the first record in the segment
+        self.first_seq = first_seq
+        # (end position, record count) of every block, read or not
+        self.index = []
+        self.records = 0
+        self.read_pos = self.write_pos = self.size = 0
+        self.blocks = deque()
+        self.map = None
+        # how far writes have been flushed to the file, for the mapping
+        self.flushed = 0
+        self._file = None
+        self._closed = False
+
+    @property
+    def file(self):
+        if self._file is None:
+            if self._closed:
+                raise ValueError("Segment %r is closed" % self.name)
+            if os.path.exists(self.name):
+                self._file = _file_open(self.name, "r+b")
+            else:
+                self._file = _file_open(self.name, "w+b")
+        return self._file
+
+    def close(self):
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+
+    def fsync(self):
+        if self._file is not None and not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def delete(self):
+        self.close()
+        os.remove(self.name)
+        try:
+            os.remove(self.index_name)
+        except OSError:
+            pass
+
+
+class _DurableSpill(_Spill):
+    """
+    Overflow of a durable FileQueue, kept in a directory so a restarted
+    process carries on where the last one left off.
+
+    The segments are an append-only log of checksummed blocks. Next to them a
+    cursor file records the position of the first item not yet returned by a
+    get: a segment id, the position of a block in it and how many of that
+    block's items have been taken (and the sequence number of the segment's
+    first item). Every item is written to the log, a durable queue has no
+    memory buffer.
+
+    Records are numbered in the order they're written. Each full segment
+    gets an index file with its size, its first sequence number, its record
+    count and where each block ends, so reopening a queue reads the index of
+    every segment rather than the segments themselves. Only the segment
+    being written to when the queue was closed is scanned. An index that
+    doesn't match its segment is ignored and the segment scanned instead.
+
+    What survives a crash depends on the fsync policy: with 'fsync_items'
+    the log is flushed, fsynced and the cursor saved after that many puts or
+    gets (1 for every one), with 'fsync_interval' once that many seconds
+    have passed. With neither the data is written at the normal flush
+    thresholds but left to the OS, and the cursor only saved on dispose, so
+    items got since the last dispose can be returned again after a crash.
+    """
+
+    def __init__(self, path, fsync_items=None, fsync_interval=None, **kwargs):
+        # Read ahead items are only acknowledged as they're taken, which the
+        # prefetch thread knows nothing about
+        kwargs["prefetch"] = False
+        _Spill.__init__(self, **kwargs)
+        self._path = path
+        self._fsync_items = fsync_items
+        self._fsync_interval = fsync_interval
+        self._unsynced = 0
+        self._unsynced_segments = set()
+        self._synced_at = _time()
+        self._cursor_moved = False
+        self._next_segment_id = 0
+        # sequence number of the next record written to a segment
+        self._next_seq = 0
+        # (segment, position, record count) of each block in the read buffer
+        self._marks = deque()
+        self._taken = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock_file = _file_open(os.path.join(path, "lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self._lock_file.close()
+                raise IOError("Queue at %r is already open" % path)
+        self.recovered = self._recover()
+
+    def close(self):
+        if self._closed:
+            return
+        self.sync()
+        self._closed = True
+        while self._segments:
+            self._segments.popleft().close()
+        self._lock_file.close()
+
+    def _new_segment(self):
+        if self._segments:
+            # the last segment is full, nothing more will be written to it
+            self._write_index(self._segments[-1])
+        segment = _DurableSegment(self._path, self._next_segment_id,
+                                  self._next_seq)
+        self._next_segment_id += 1
+        self._segments.append(segment)
+        return segment
+
+    def _release_segment(self, segment):
+        self._unsynced_segments.discard(segment)
+        segment.delete()
+
+    def _write_blocks(self, blocks, counts):
+        segment = self._write_segment()
+        end = segment.write_pos
+        _Spill._write_blocks(self, blocks, counts)
+        for block, count in zip(blocks, counts):
+            end += len(block)
+            segment.index.append((end, count))
+        segment.records += sum(counts)
+        self._next_seq += sum(counts)
+        self._unsynced_segments.add(segment)
+
+    def _write_index(self, segment):
+        """
+        Write the index file of a segment. It isn't fsynced: an index that
+        didn't make it to disk intact is ignored when the queue is reopened.
+        """
+        entries = [value for entry in segment.index for value in entry]
+        body = struct.pack("<" + _INDEX_ENTRY * len(segment.index), *entries)
+        header = _INDEX_HEADER.pack(segment.write_pos, segment.first_seq,
+                                    segment.records, len(segment.index),
+                                    zlib.crc32(body) & 0xffffffff)
+        with _file_open(segment.index_name, "wb") as index_file:
+            index_file.write(header + body)
+
+    def _load_index(self, segment):
+        """
+        Return the first sequence number and the (end position, record count)
+        of each block of a segment from its index file, or None if there's
+        no index or it doesn't match the segment.
+        """
+        try:
+            with _file_open(segment.index_name, "rb") as index_file:
+                data = index_file.read()
+            segment_size = os.path.getsize(segment.name)
+        except (IOError, OSError):
+            return None
+        if len(data) < _INDEX_HEADER.size:
+            return None
+        size, first_seq, records, block_count, crc = \
+            _INDEX_HEADER.unpack_from(data)
+        body = data[_INDEX_HEADER.size:]
+        entry_format = "<" + _INDEX_ENTRY * block_count
+        if (size != segment_size or
+                len(body) != struct.calcsize(entry_format) or
+                zlib.crc32(body) & 0xffffffff != crc):
+            return None
+        values = struct.unpack(entry_format, body)
+        blocks = list(zip(values[::2], values[1::2]))
+        if sum(values[1::2]) != records or (blocks and blocks[-1][0] != size):
+            return None
+        return first_seq, blocks
+
+    def _read_range(self, segment, start, end):
+        data = self._read_data(segment, start, end)
+        unpack_from = _BLOCK_HEADER.unpack_from
+        pos = 0
+        while pos < len(data):
+            count, payload_len = unpack_from(data, pos)[:2]
+            self._marks.append((segment, start + pos, count))
+            pos += _BLOCK_HEADER.size + payload_len
+        return _decode_blocks(data, self._codec)
+
+    def _read_block(self, want=1):
+        # Segments are only deleted once their items have all been taken, so
+        # the first may have been read already
+        for segment in self._segments:
+            if segment.read_pos < segment.write_pos:
+                start = segment.read_pos
+                segment.read_pos = self._plan_read(segment, want)
+                return self._read_range(segment, start, segment.read_pos)
+        return None
+
+    def _fill_read_buffer(self, want=1):
+        # Unwritten items aren't handed over from memory as they are for
+        # other queues: the cursor can only point into the log, so they're
+        # written out first and read back like any other block
+        records = self._read_block(want)
+        if records is None:
+            self.flush()
+            records = self._read_block(want)
+            if records is None:
+                raise Empty
+        self._read_buffer = deque(records)
+
+    def read(self):
+        with self._chain_cond:
+            record = _Spill.read(self)
+            self._taken_records(1)
+            return record
+
+    def read_many(self, count):
+        with self._chain_cond:
+            records = _Spill.read_many(self, count)
+            self._taken_records(len(records))
+            return records
+
+    def _taken_records(self, count):
+        if self._marks:
+            self._taken += count
+            while self._marks and self._taken >= self._marks[0][2]:
+                self._taken -= self._marks.popleft()[2]
+        segments = self._segments
+        while (len(segments) > 1 and
+               segments[0].read_pos >= segments[0].write_pos and
+               not (self._marks and self._marks[0][0] is segments[0])):
+            self._release_segment(segments.popleft())
+        self._cursor_moved = True
+        self._unsynced += count
+        self._check_sync()
+
+    def write(self, record):
+        with self._chain_cond:
+            _Spill.write(self, record)
+            self._unsynced += 1
+            self._check_sync()
+
+    def write_many(self, records):
+        with self._chain_cond:
+            _Spill.write_many(self, records)
+            self._unsynced += len(records)
+            self._check_sync()
+
+    def _check_sync(self):
+        if ((self._fsync_items is not None and
+             self._unsynced >= self._fsync_items) or
+                (self._fsync_interval is not None and
+                 _time() - self._synced_at >= self._fsync_interval)):
+            self.sync()
+
+    def sync(self):
+        """
+        Write out everything held in memory, fsync it and save the cursor.
+        """
+        with self._chain_cond:
+            self.flush()
+            for segment in self._unsynced_segments:
+                segment.fsync()
+            self._unsynced_segments.clear()
+            if self._cursor_moved:
+                self._save_cursor()
+            self._unsynced = 0
+            self._synced_at = _time()
+
+    def _cursor(self):
+        if self._marks:
+            segment, pos, count = self._marks[0]
+            return segment.segment_id, pos, self._taken, segment.first_seq
+        if self._segments:
+            segment = self._segments[0]
+            return segment.segment_id, segment.read_pos, 0, segment.first_seq
+        return self._next_segment_id, 0, 0, self._next_seq
+
+    def _save_cursor(self):
+        name = os.path.join(self._path, "cursor")
+        temp_name = name + ".tmp"
+        with _file_open(temp_name, "w") as cursor_file:
+            cursor_file.write("%i %i %i %i\n" % self._cursor())
+            cursor_file.flush()
+            os.fsync(cursor_file.fileno())
+        _replace(temp_name, name)
+        self._cursor_moved = False
+
+    def _load_cursor(self):
+        try:
+            with _file_open(os.path.join(self._path, "cursor")) as cursor_file:
+                cursor = [int(value) for value in cursor_file.read().split()]
+        except IOError:
+            cursor = [0, 0, 0]
+        if len(cursor) == 3:
+            # saved before records had sequence numbers
+            cursor.append(None)
+        return cursor
+
+    def _recover(self):
+        """
+        Open the segments left in the directory and find the items still to
+        be read, returning how many there are.
+        """
+        segment_id, pos, skip, first_seq = self._load_cursor()
+        names = os.listdir(self._path)
+        segment_ids = sorted(int(name.split(".")[0]) for name in names
+                             if name.endswith(_SEGMENT_SUFFIX))
+        for existing_id in segment_ids:
+            if existing_id < segment_id:
+                # read before the cursor was last saved
+                os.remove(os.path.join(self._path,
+                                       _SEGMENT_NAME % existing_id))
+            else:
+                self._segments.append(_DurableSegment(self._path,
+                                                      existing_id))
+        kept = set(segment.segment_id for segment in self._segments)
+        for name in names:
+            if (name.endswith(_INDEX_SUFFIX) and
+                    int(name.split(".")[0]) not in kept):
+                os.remove(os.path.join(self._path, name))
+        if segment_ids:
+            self._next_segment_id = segment_ids[-1] + 1
+        if self._segments and self._segments[0].segment_id != segment_id:
+            # the cursor's segment was deleted after it was saved, the
+            # sequence number is for that one
+            first_seq = None
+        if not self._segments or self._segments[0].segment_id != segment_id:
+            pos = skip = 0
+        count = 0
+        for segment in self._segments:
+            last = segment is self._segments[-1]
+            index = None if last else self._load_index(segment)
+            if index is not None and first_seq not in (None, index[0]):
+                # left over from an earlier queue on the same path
+                index = None
+            if index is None:
+                segment.index = self._scan(segment, last)
+                segment.first_seq = first_seq or 0
+            else:
+                segment.first_seq, segment.index = index
+                segment.write_pos = segment.size = (
+                    segment.index[-1][0] if segment.index else 0)
+            segment.records = sum(block_count
+                                  for end, block_count in segment.index)
+            if index is None and not last:
+                self._write_index(segment)
+            segment.read_pos = pos
+            segment.blocks.extend(block for block in segment.index
+                                  if block[0] > pos)
+            count += sum(block_count for end, block_count in segment.blocks)
+            first_seq = segment.first_seq + segment.records
+            pos = 0
+        self._next_seq = first_seq or 0
+        if skip and count:
+            self._fill_read_buffer()
+            skip = min(skip, len(self._read_buffer))
+            for i in range(skip):
+                self._read_buffer.popleft()
+            self._taken = skip
+            count -= skip
+        return count
+
+    def _scan(self, segment, last):
+        """
+        Read the block headers of a segment, returning the (end position,
+        record count) of each block. An incomplete block at the end of the
+        last segment (a write cut short by a crash) is truncated away.
+        """
+        file = segment.file
+        file.seek(0, 2)
+        size = file.tell()
+        blocks = []
+        pos = 0
+        while pos + _BLOCK_HEADER.size <= size:
+            file.seek(pos)
+            header = file.read(_BLOCK_HEADER.size)
+            block_count, payload_len, codec_id, crc = _BLOCK_HEADER.unpack(
+                header)
+            end = pos + _BLOCK_HEADER.size + payload_len
+            if end > size:
+                break
+            if last and zlib.crc32(file.read(payload_len)) & 0xffffffff != crc:
+                break
+            blocks.append((end, block_count))
+            pos = end
+        if pos < size:
+            if not last:
+                raise IOError("Overflow segment %r is corrupt" % segment.name)
+            file.seek(pos)
+            file.truncate()
+        segment.write_pos = segment.size = pos
+        return blocks
+
+
+class _Histogram(object):
+    """
+    Count of timings in buckets of powers of two microseconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = self.max = 0.0
+        self.buckets = [0] * 32
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1000000).bit_length(), 31)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def snapshot(self):
+        """
+        Return the figures as a dict, with 'buckets' mapping the upper bound
+        of each bucket in microseconds to the number of timings under it (and
+        not under the bound below).
+        """
+        return dict(count=self.count, total=self.total, max=self.max,
+                    mean=self.total / self.count if self.count else 0.0,
+                    buckets=dict((1 << i, n)
+                                 for i, n in enumerate(self.buckets) if n))
+
+
+class _Metrics(object):
+    """
+    Item counts and timings collected by a queue created with 'metrics' set.
+    Operations are named by what they did and where: "put_memory",
+    "put_file", "get_memory" and "get_file".
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.items = {}
+        self.latency = {}
+        self.lock_wait = _Histogram()
+
+    def record(self, name, seconds, count=1):
+        self.items[name] = self.items.get(name, 0) + count
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = _Histogram()
+        histogram.add(seconds)
+        if self.hook is not None:
+            self.hook(name, seconds)
+
+    def record_wait(self, seconds):
+        self.lock_wait.add(seconds)
+        if self.hook is not None:
+            self.hook("lock_wait", seconds)
+
+    def merge(self, other):
+        for name, count in other.items.items():
+            self.items[name] = self.items.get(name, 0) + count
+        for name, histogram in other.latency.items():
+            if name not in self.latency:
+                self.latency[name] = _Histogram()
+            self.latency[name].merge(histogram)
+        self.lock_wait.merge(other.lock_wait)
+
+    def snapshot(self):
+        return dict(items=dict(self.items),
+                    latency=dict((name, histogram.snapshot())
+                                 for name, histogram in self.latency.items()),
+                    lock_wait=self.lock_wait.snapshot())
+
+
+class _TimedLock(object):
+    """
+    Lock that records how long each acquire waited for it.
+    """
+
+    def __init__(self, lock, metrics):
+        self._lock = lock
+        self._metrics = metrics
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self._metrics.record_wait(0.0)
+            return True
+        if not blocking:
+            return False
+        start = _clock()
+        if timeout == -1:
+            acquired = self._lock.acquire()
+        else:
+            acquired = self._lock.acquire(True, timeout)
+        self._metrics.record_wait(_clock() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def _is_owned(self):
+        # for Condition, without counting as a wait
+        if self._lock.acquire(False):
+            self._lock.release()
+            return False
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _timed(metrics, name, function, counted=None):
+    """
+    Wrap the queue method 'function' to record its timings under 'name'.
+    'counted' picks the number of items out of its argument and result,
+    otherwise each call is one item.
+    """
+    def timed(*args):
+        start = _clock()
+        result = function(*args)
+        count = 1 if counted is None else counted(args, result)
+        metrics.record(name, _clock() - start, count)
+        return result
+    return timed
+
+
+def _first_len(args, result):
+    return len(args[0])
+
+
+def _result_len(args, result):
+    return len(result)
+
+
+class _DiskQuota(object):
+    """
+    Limit on the size of an overflow, counted as the serialised size of the
+    items in it (shared by the levels of a PriorityFileQueue). An empty
+    overflow takes the next put however big it is.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.dropped = 0
+        # size of the newest record, the guess at the next one for full()
+        self.last = 0
+
+    def fits(self, size):
+        return not self.used or self.used + size <= self.limit
+
+    def full(self):
+        """
+        Return True if a record the size of the newest one wouldn't fit.
+        """
+        return not self.fits(max(self.last, 1))
+
+
+class _BloomFilter(object):
+    """
+    Bit array answering whether a key may have been added (or certainly
+    hasn't), sized for 'capacity' keys at 'error_rate' false positives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self._size = max(8, int(-capacity * math.log(error_rate) /
+                                math.log(2) ** 2))
+        self._hashes = max(1, int(round(
+            float(self._size) / capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, from two cheap checksums
+        first = zlib.crc32(key) & 0xffffffff
+        step = (zlib.adler32(key) & 0xffffffff) | 1
+        size = self._size
+        return [(first + i * step) % size for i in range(self._hashes)]
+
+    def add(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class _KeyIndex(object):
+    """
+    Keys of the items in a unique queue: a Bloom filter in memory in front
+    of an sqlite table on disk. The table has a bounded page cache, so the
+    memory used doesn't grow with the queue, and a key the Bloom filter has
+    never seen is added without first looking for it.
+
+    The file is temporary and nothing is synced. The Bloom filter can't
+    forget a key, so it's reset (with the table) whenever the queue has no
+    keys left.
+    """
+
+    # uncommitted changes that are written out together
+    _commit_every = 1000
+
+    def __init__(self, directory=None, capacity=DEFAULT_UNIQUE_CAPACITY):
+        self._path = tempfile.mkdtemp(prefix="filequeue-keys-", dir=directory)
+        self._capacity = capacity
+        # only used under the queue's lock, from whichever thread has it
+        self._db = sqlite3.connect(os.path.join(self._path, "keys"),
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE keys (key BLOB PRIMARY KEY)")
+        self._changes = 0
+        self.count = 0
+        self.duplicates = 0
+        self._bloom = _BloomFilter(capacity)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self._commit_every:
+            self._db.commit()
+            self._changes = 0
+
+    def add(self, key):
+        """
+        Add a key, returning False if it's already there.
+        """
+        if key in self._bloom:
+            added = self._db.execute("INSERT OR IGNORE INTO keys VALUES (?)",
+                                     (_blob(key),)).rowcount
+            if not added:
+                self.duplicates += 1
+                return False
+        else:
+            self._db.execute("INSERT INTO keys VALUES (?)", (_blob(key),))
+            self._bloom.add(key)
+        self.count += 1
+        self._changed()
+        return True
+
+    def discard(self, key):
+        if not self._db.execute("DELETE FROM keys WHERE key = ?",
+                                (_blob(key),)).rowcount:
+            return
+        self.count -= 1
+        if not self.count:
+            self._db.execute("DELETE FROM keys")
+            self._bloom = _BloomFilter(self._capacity)
+        self._changed()
+
+
+class FileQueue(Queue):
+    """
+    Class to a thread safe file queue object. Keeps the same interface
+    and is interchangeable with the Queue in the python standard lib (see note).
+    Put objects into a queue, the same as the regular Queue.Queue but any
+    overflow (number of items in the queue greater than maxsize) will get put
+    into a file on disk (optionally compressed) to keep excessive amounts of
+    queued items out of memory.
+
+    Note: The order items are returned is guaranteed FIFO only if no buffer is
+    set (maxsize=0), or the queue is created with ordered=True. Otherwise it
+    remains FIFO until the point at which the buffer overflows in which case
+    you cannot rely on the order of returned items to be the same as they were
+    put in.
+
+    (Items in the overflow will be retrieved in the order they were put into
+    the overflow, but a series of 'put's may put some items in the buffer,
+    and some in the overflow, meaning the order ends up being slightly shuffled,
+    because items in the buffer will always be returned before any in the
+    overflow, which is only ever accessed when nothing is available from the
+    buffer)
+
+    With ordered=True the buffer holds the oldest items. Once anything has
+    overflowed, new items go to the overflow behind it until it's drained,
+    and when the buffer runs out it's refilled from the overflow in one go.
+    """
+
+    _spill_class = _Spill
+
+    def __init__(self, maxsize=0, segment_size=DEFAULT_SEGMENT_SIZE,
+                 flush_items=DEFAULT_FLUSH_ITEMS,
+                 flush_bytes=DEFAULT_FLUSH_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 read_ahead=DEFAULT_READ_AHEAD, prefetch=False,
+                 compression=None, serializer=None, path=None, durable=False,
+                 fsync_items=None, fsync_interval=None, use_mmap=False,
+                 max_buffer_bytes=None, sizer=None, ordered=False,
+                 metrics=False, metrics_hook=None, max_disk_bytes=None,
+                 disk_full="block", spill_dir=None, preallocate=False,
+                 fadvise=False, unique=False, key=None,
+                 unique_capacity=DEFAULT_UNIQUE_CAPACITY, expiring=False,
+                 ttl=None):
+        """
+        :type maxsize: int
+        :param maxsize: Set the maximum number of items to be held in the buffer
+        :type segment_size: int
+        :param segment_size: Size in bytes at which the overflow rolls over to
+            a new segment file. Segments are deleted as soon as every item in
+            them has been read, so disk usage follows the number of items
+            currently in the overflow rather than the total ever put
+        :type flush_items: int
+        :param flush_items: Number of overflowing items collected in memory
+            before they are written to disk together as one block
+        :type flush_bytes: int
+        :param flush_bytes: Write the collected items once their serialised size
+            reaches this many bytes, whatever their number
+        :type flush_interval: float
+        :param flush_interval: Write the collected items once the oldest has
+            waited this many seconds (checked on put, None to disable)
+        :type read_ahead: int
+        :param read_ahead: Number of items to read from the overflow at a time
+            (LifoFileQueue reads back one block at a time regardless)
+        :type prefetch: bool
+        :param prefetch: Read ahead on a background thread, so items are
+            already in memory when a get reaches them
+        :param compression: Compress each block written to the overflow with
+            "zlib", "gzip", "lzma" or "bz2", or an object with 'compress' and
+            'decompress' methods (default None, not compressed)
+        :param serializer: Object with 'dumps' and 'loads' methods used to
+            write items to the overflow (default PickleSerializer). See also
+            MarshalSerializer and BytesSerializer
+        :type path: str
+        :param path: Directory to keep a durable queue in
+        :type durable: bool
+        :param durable: Keep every item in a log in 'path' that a new
+            FileQueue opened on the same path will pick up from, after a
+            restart or a crash. Needs maxsize=0, as nothing is held in memory
+        :type fsync_items: int
+        :param fsync_items: For a durable queue, fsync the log and save the
+            read position after this many puts and gets (1 for every one)
+        :type fsync_interval: float
+        :param fsync_interval: For a durable queue, fsync the log and save the
+            read position when this many seconds have passed (checked on put
+            and get). With neither set the queue is only synced on dispose
+        :type use_mmap: bool
+        :param use_mmap: Read the overflow through memory maps, so items are
+            loaded straight from the mapping without copying the data first.
+            With BytesSerializer, items read back from disk are memoryviews
+            of the mapping (ignored by LifoFileQueue)
+        :type max_buffer_bytes: int
+        :param max_buffer_bytes: Hold items in the buffer only while their
+            total size stays within this many bytes, and overflow the rest.
+            'maxsize' still caps the number of items if it's set, with
+            maxsize=0 the buffer is limited by size alone
+        :param sizer: Function returning the size in bytes of an item, for
+            'max_buffer_bytes'. By default an item's size is the length of
+            its serialised form
+        :type ordered: bool
+        :param ordered: Keep items strictly FIFO with a buffer set. The buffer
+            holds the head of the queue and is refilled from the overflow in
+            bulk as it drains (FileQueue and PriorityFileQueue only)
+        :type metrics: bool
+        :param metrics: Count the items put and got through the buffer and
+            through the overflow, time each of those operations and time
+            waits for the queue's lock, all reported by stats(). Nothing is
+            measured without it
+        :param metrics_hook: Function called with the name and the duration
+            in seconds of every operation timed, as well as "lock_wait" for
+            each wait for the lock (implies 'metrics')
+        :type max_disk_bytes: int
+        :param max_disk_bytes: Limit the overflow to this many bytes of
+            serialised items (compression and block headers aside). The
+            check is a sum kept as items come and go, so costs nothing
+            much on a put
+        :type disk_full: str
+        :param disk_full: What a put does when the overflow has no room for
+            an item: "block" to wait for gets to make room (as long as
+            'block' and 'timeout' allow, then raise Full), "raise" to raise
+            Full straight away, "drop_oldest" to throw away the oldest
+            items in the overflow, or "drop_newest" to throw away the item
+            being put. Dropped items are counted by stats()
+        :type spill_dir: str
+        :param spill_dir: Directory to create the overflow's segment files
+            in (default the temp directory). No file is created until
+            something overflows
+        :type preallocate: bool
+        :param preallocate: Allocate 'segment_size' bytes for each segment
+            as it's created (posix_fallocate), so the overflow isn't
+            fragmented and running out of disk shows up straight away
+        :type fadvise: bool
+        :param fadvise: Tell the OS segments are read sequentially and drop
+            what's been read from the page cache (posix_fadvise), so a large
+            overflow doesn't push other programs' data out of it
+        :type unique: bool
+        :param unique: Drop a put of an item whose key is the same as that
+            of an item still in the queue (one not yet got). By default an
+            item's key is its serialised form
+        :param key: Function returning the key (bytes or str) of an item
+            (implies 'unique')
+        :type unique_capacity: int
+        :param unique_capacity: Number of keys the in-memory Bloom filter in
+            front of the on-disk key index is sized for. More keys still
+            work, but more of them have to be looked up on disk
+        :type expiring: bool
+        :param expiring: Let items be put with a time to live (put's 'ttl'),
+            after which gets skip them. The expiry time is written ahead of
+            each item in the overflow, so expired items are skipped without
+            being loaded, and a segment whose items have all expired isn't
+            read at all (unless 'max_disk_bytes' is set, or the queue is
+            durable or a LifoFileQueue)
+        :type ttl: float
+        :param ttl: Time to live in seconds of items put without one (implies
+            'expiring', default None for no limit)
+        """
+        if ordered and self._spill_class is _LifoSpill:
+            raise ValueError("A LifoFileQueue can't be ordered")
+        if disk_full not in _DISK_FULL_POLICIES:
+            raise ValueError("'disk_full' must be one of %s" %
+                             ", ".join(_DISK_FULL_POLICIES))
+        if disk_full == "drop_oldest" and self._spill_class is _LifoSpill:
+            raise ValueError("A LifoFileQueue can't drop its oldest items")
+        if (unique or key is not None) and durable:
+            raise ValueError("A durable queue can't be unique")
+        expiring = expiring or ttl is not None
+        if expiring and (unique or key is not None):
+            raise ValueError("A unique queue can't be expiring")
+        Queue.__init__(self, maxsize)
+        self._contains = 0
+        if serializer is None:
+            serializer = _DEFAULT_SERIALIZER
+        self._expiring = expiring
+        self._ttl = ttl
+        self._expired_items = 0
+        if expiring:
+            # the queue holds (expiry time, item) pairs
+            serializer = _ExpirySerializer(serializer)
+            if sizer is not None:
+                item_sizer = sizer
+                sizer = lambda entry: item_sizer(entry[1])
+        self._dumps = serializer.dumps
+        self._loads = serializer.loads
+        self._max_buffer_bytes = max_buffer_bytes
+        self._sizer = sizer
+        # sizes of the items in the buffer, only kept with max_buffer_bytes
+        self._buffer_sizes = deque()
+        self._buffer_bytes = 0
+        self._ordered = ordered
+        self._quota = None
+        self._disk_full = disk_full
+        if max_disk_bytes is not None:
+            self._quota = _DiskQuota(max_disk_bytes)
+        # whether the quota's count is a guess, made from the disk usage of
+        # the overflow a durable queue was reopened with
+        self._quota_estimated = False
+        self._key = key
+        self._keys = None
+        # keys of the items in the buffer, only kept by a unique queue
+        self._buffer_keys = deque()
+        if unique or key is not None:
+            self._keys = _KeyIndex(spill_dir, unique_capacity)
+        options = dict(
+            segment_size=segment_size, flush_items=flush_items,
+            flush_bytes=flush_bytes, flush_interval=flush_interval,
+            read_ahead=read_ahead, prefetch=prefetch, compression=compression,
+            use_mmap=use_mmap, spill_dir=spill_dir, preallocate=preallocate,
+            fadvise=fadvise)
+        # whether whole segments of expired items are skipped
+        self._skip_segments = (expiring and not durable and
+                               max_disk_bytes is None and
+                               self._spill_class is _Spill)
+        if self._skip_segments:
+            options["expiring"] = True
+        if durable:
+            if path is None:
+                raise ValueError("A durable queue needs a 'path'")
+            if spill_dir is not None or preallocate:
+                raise ValueError("A durable queue keeps its segments in "
+                                 "'path', as they are")
+            if maxsize or max_buffer_bytes is not None:
+                raise ValueError("A durable queue can't have a buffer "
+                                 "(maxsize must be 0)")
+            if self._spill_class is not _Spill:
+                raise ValueError("Only FileQueue can be durable")
+            self._spill = _DurableSpill(path, fsync_items, fsync_interval,
+                                        **options)
+            self._contains = self.unfinished_tasks = self._spill.recovered
+            if self._quota is not None and self._contains:
+                segments, disk_bytes, reclaimable_bytes = (
+                    self._spill.disk_usage())
+                self._quota.used = disk_bytes - reclaimable_bytes
+                self._quota_estimated = True
+        elif path is not None:
+            raise ValueError("'path' is only used by a durable queue")
+        else:
+            self._spill = self._new_spill(**options)
+        self._metrics = None
+        if metrics or metrics_hook is not None:
+            self._metrics = _Metrics(metrics_hook)
+            self._instrument()
+
+    _timed_hooks = (
+        ("_put", "put_memory", None), ("_put_file", "put_file", None),
+        ("_put_record", "put_file", None),
+        ("_put_many", "put_memory", _first_len),
+        ("_put_many_file", "put_file", _first_len),
+        ("_get", "get_memory", None), ("_get_file", "get_file", None),
+        ("_get_many", "get_memory", _result_len),
+        ("_get_many_file", "get_file", _result_len))
+
+    def _instrument(self):
+        """
+        Swap in a timed lock and timed versions of the put and get hooks,
+        so a queue without metrics runs none of this.
+        """
+        metrics = self._metrics
+        self.mutex = _TimedLock(self.mutex, metrics)
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        for attribute, name, counted in self._timed_hooks:
+            setattr(self, attribute, _timed(
+                metrics, name, getattr(self, attribute), counted))
+
+    def _new_spill(self, **options):
+        return self._spill_class(**options)
+
+    def __del__(self):
+        self.dispose()
+
+    def dispose(self):
+        spill = getattr(self, "_spill", None)
+        if spill is not None:
+            spill.close()
+        keys = getattr(self, "_keys", None)
+        if keys is not None:
+            keys.close()
+
+    def sync(self):
+        """
+        For a durable queue, write out any items still held in memory, fsync
+        them and save the read position, whatever the fsync policy.
+        """
+        self.mutex.acquire()
+        try:
+            if isinstance(self._spill, _DurableSpill):
+                self._spill.sync()
+        finally:
+            self.mutex.release()
+
+    def compression_ratio(self):
+        """
+        Return how many times smaller the overflow is on disk than it would
+        have been uncompressed (1.0 if not compressed or nothing written yet).
+        """
+        return self._spill.compression_ratio()
+
+    def stats(self):
+        """
+        Return a snapshot of the queue's state as a dict:
+
+        - qsize, buffered_items and spilled_items: the items in the queue, in
+          the buffer and in the overflow (on disk or waiting to be written)
+        - buffered_bytes: the size of the buffer, with max_buffer_bytes set
+        - segments, disk_bytes and reclaimable_bytes: the overflow files,
+          their total size, and how much of that holds nothing still queued
+        - bytes_written and bytes_stored: everything written to the overflow
+          so far, before and after compression
+        - compression_ratio
+        - spilled_bytes: the overflow's use of max_disk_bytes, if it's set
+        - dropped_items: items thrown away by a "drop_oldest" or
+          "drop_newest" disk_full policy
+        - duplicate_items: puts dropped by a unique queue
+        - expired_items: items an expiring queue has skipped as expired
+
+        With 'metrics' set, also 'items' (the number of items put and got by
+        each operation, "put_memory", "put_file", "get_memory", "get_file"),
+        'latency' (a histogram of each operation's timings, see _Histogram)
+        and 'lock_wait' (a histogram of waits for the lock).
+        """
+        self.mutex.acquire()
+        try:
+            stats = self._stats()
+            if self._metrics is not None:
+                stats.update(self._all_metrics().snapshot())
+        finally:
+            self.mutex.release()
+        return stats
+
+    def _all_metrics(self):
+        return self._metrics
+
+    def _stats(self):
+        segments, disk_bytes, reclaimable_bytes = self._spill.disk_usage()
+        buffered = self._buffer_size()
+        return dict(
+            qsize=self._qsize(), buffered_items=buffered,
+            spilled_items=self._qsize() - buffered,
+            buffered_bytes=(self._buffer_bytes
+                            if self._max_buffer_bytes is not None else None),
+            segments=segments, disk_bytes=disk_bytes,
+            reclaimable_bytes=reclaimable_bytes,
+            bytes_written=self._spill._raw_bytes,
+            bytes_stored=self._spill._stored_bytes,
+            compression_ratio=self._spill.compression_ratio(),
+            spilled_bytes=self._quota.used if self._quota else None,
+            dropped_items=self._quota.dropped if self._quota else 0,
+            duplicate_items=self._keys.duplicates if self._keys else 0,
+            expired_items=self._expired_items)
+
+    def _buffer_size(self):
+        """
+        Return the approximate size of the buffer (not reliable!).
+        """
+        return Queue._qsize(self)
+
+    def _item_size(self, item):
+        """
+        Return the size of 'item' for the byte budget, and its serialised
+        form if that had to be worked out to get the size (else None).
+        """
+        if self._sizer is not None:
+            return self._sizer(item), None
+        record = self._dumps(item)
+        return len(record), record
+
+    def _buffer_room(self, items):
+        """
+        Return the sizes of the leading items of 'items' that fit in the
+        buffer under the byte budget.
+        """
+        sizes = []
+        total = self._buffer_bytes
+        if self.maxsize:
+            items = items[:max(0, self.maxsize - self._buffer_size())]
+        for item in items:
+            size = self._item_size(item)[0]
+            total += size
+            if total > self._max_buffer_bytes:
+                break
+            sizes.append(size)
+        return sizes
+
+    def _sizes_room(self, sizes):
+        """
+        Return how many of the leading item 'sizes' still fit in the buffer
+        under the byte budget.
+        """
+        if self.maxsize:
+            sizes = sizes[:max(0, self.maxsize - self._buffer_size())]
+        total = self._buffer_bytes
+        for fits, size in enumerate(sizes):
+            total += size
+            if total > self._max_buffer_bytes:
+                return fits
+        return len(sizes)
+
+    def _overflowing(self):
+        """
+        Return True if an ordered queue has items in the overflow, which new
+        items have to go behind.
+        """
+        return self._ordered and self._contains > self._buffer_size()
+
+    def _refill(self):
+        """
+        Move as many items from the overflow of an ordered queue into the
+        (empty) buffer as it has room for.
+        """
+        if self._max_buffer_bytes is None:
+            records = self._spill.read_many(self.maxsize)
+            if self._skip_segments:
+                self._take_skipped()
+            items = [self._loads(record) for record in records]
+            if self._quota is not None:
+                self._spill_taken(sum(map(len, records)))
+            if self._expiring:
+                items = [item for item in items if item is not _EXPIRED]
+                self._drop_expired(len(records) - len(items))
+            elif self._keys is not None:
+                self._buffer_keys.extend(map(self._item_key, items, records))
+            self.queue.extend(items)
+            return
+        # read a record at a time (read ahead is buffered) to stop at the byte
+        # budget, the last item can take the buffer a little over it
+        loads = self._loads
+        sizer = self._sizer
+        limit = self.maxsize or self._contains
+        while (len(self.queue) < limit and
+               self._buffer_bytes < self._max_buffer_bytes):
+            try:
+                record = self._spill.read()
+            except Empty:
+                break
+            finally:
+                if self._skip_segments:
+                    self._take_skipped()
+            item = loads(record)
+            if self._quota is not None:
+                self._spill_taken(len(record))
+            if item is _EXPIRED:
+                self._drop_expired(1)
+                continue
+            size = len(record) if sizer is None else sizer(item)
+            self.queue.append(item)
+            self._buffer_sizes.append(size)
+            self._buffer_bytes += size
+            if self._keys is not None:
+                self._buffer_keys.append(self._item_key(item, record))
+
+    def full(self):
+        """
+        Return True if the queue is full, False otherwise. Only a queue with
+        'max_disk_bytes' can be full: when an item the size of the last one
+        put in the overflow wouldn't fit under the limit, and the next item
+        wouldn't go in the buffer either. As the next item's size isn't
+        known this is only a guess, a put can still block or raise Full
+        after full() returned False (or go ahead after it returned True).
+        """
+        if self._quota is None:
+            return False
+        self.mutex.acquire()
+        try:
+            if not self._quota.full():
+                return False
+            if self._overflowing():
+                return True
+            if self.maxsize and self._buffer_size() < self.maxsize:
+                return False
+            if self._max_buffer_bytes is not None:
+                return self._buffer_bytes >= self._max_buffer_bytes
+            return True
+        finally:
+            self.mutex.release()
+
+    def _disk_room(self, records, block, timeout):
+        """
+        Make room in the disk quota for the overflowing 'records' as the
+        disk_full policy says, and return those to be written (fewer than
+        given if the newest are dropped).
+        """
+        quota = self._quota
+        size = sum(map(len, records))
+        if not quota.fits(size):
+            policy = self._disk_full
+            if policy == "raise":
+                raise Full
+            elif policy == "drop_newest":
+                used = quota.used
+                fits = 0
+                for record in records:
+                    if used and used + len(record) > quota.limit:
+                        break
+                    used += len(record)
+                    fits += 1
+                quota.dropped += len(records) - fits
+                if self._keys is not None:
+                    self._forget_records(records[fits:])
+                records = records[:fits]
+                size = used - quota.used
+            elif policy == "drop_oldest":
+                self._drop_oldest(size)
+            elif not block:
+                raise Full
+            elif timeout is None:
+                while not quota.fits(size):
+                    self.not_full.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
+            else:
+                endtime = _time() + timeout
+                while not quota.fits(size):
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        raise Full
+                    self.not_full.wait(remaining)
+        quota.used += size
+        if records:
+            quota.last = len(records[-1])
+        return records
+
+    def _drop_oldest(self, size):
+        """
+        Throw away the oldest items in the overflow until 'size' more bytes
+        fit in the disk quota. They count as done for join().
+        """
+        quota = self._quota
+        dropped = 0
+        while not quota.fits(size):
+            try:
+                record = self._spill.read()
+            except Empty:
+                break
+            self._contains -= 1
+            self._spill_taken(len(record))
+            if self._keys is not None:
+                self._forget_records([record])
+            dropped += 1
+        quota.dropped += dropped
+        self.unfinished_tasks -= dropped
+        if dropped and not self.unfinished_tasks:
+            self.all_tasks_done.notify_all()
+
+    def _spill_taken(self, size):
+        """
+        Take 'size' bytes of records read from the overflow off the quota.
+        """
+        quota = self._quota
+        quota.used -= size
+        if self._quota_estimated and self._contains <= self._buffer_size():
+            # drained, whatever the guess was
+            quota.used = 0
+            self._quota_estimated = False
+        elif quota.used < 0:
+            quota.used = 0
+
+    def _qsize(self, len=len):
+        return self._contains
+
+    def _item_key(self, item, record=None):
+        """
+        Return the key of 'item' in a unique queue, as bytes. Without a
+        'key' function that's the serialised item, 'record' if it's given.
+        """
+        if self._key is None:
+            key = self._dumps(item) if record is None else record
+            if isinstance(key, memoryview):
+                key = key.tobytes()
+            return key
+        key = self._key(item)
+        if not isinstance(key, bytes):
+            try:
+                key = key.encode("utf-8")
+            except AttributeError:
+                raise TypeError("'key' must return bytes or str, not %s" %
+                                type(key).__name__)
+        return key
+
+    def _forget_records(self, records):
+        """
+        Remove the keys of the items in 'records' (serialised items that
+        are leaving the queue) from the key index.
+        """
+        for record in records:
+            if self._key is None:
+                self._keys.discard(self._item_key(None, record))
+            else:
+                self._keys.discard(self._item_key(self._loads(record)))
+
+    def _forget(self, items):
+        keys = self._keys
+        for item in items:
+            keys.discard(self._item_key(item))
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self._put_done()
+
+    def _unlocked(self, function, *args):
+        """
+        Call 'function' with the mutex let go, so a put serialising or
+        writing to the overflow doesn't hold up gets from the buffer, and
+        a get deserialising an item doesn't hold up anything. The overflow
+        has a lock of its own.
+        """
+        self.mutex.release()
+        try:
+            return function(*args)
+        finally:
+            self.mutex.acquire()
+
+    def _put_file(self, item):
+        # _unlocked, written out as this is the busiest path
+        self.mutex.release()
+        try:
+            self._spill.write(self._dumps(item))
+        finally:
+            self.mutex.acquire()
+        self._put_done()
+
+    def _put_record(self, record):
+        self._unlocked(self._spill.write, record)
+        self._put_done()
+
+    def _put_many(self, items):
+        self.queue.extend(items)
+        self._put_done(len(items))
+
+    def _put_many_file(self, records):
+        self._unlocked(self._spill.write_many, records)
+        self._put_done(len(records))
+
+    def _put_done(self, count=1):
+        self._contains += count
+        self.unfinished_tasks += count
+        self.not_empty.notify(count)
+
+    def _entry(self, item, ttl):
+        """
+        Return the (expiry time, item) pair an expiring queue holds for an
+        item put with 'ttl' (None for the queue's default).
+        """
+        if ttl is None:
+            ttl = self._ttl
+            if ttl is None:
+                return _NEVER, item
+        return _time() + ttl, item
+
+    def _expired(self, count):
+        """
+        Count 'count' expired items, already taken off the queue's size, as
+        done for join().
+        """
+        self._expired_items += count
+        self.unfinished_tasks -= count
+        if not self.unfinished_tasks:
+            self.all_tasks_done.notify_all()
+
+    def _take_skipped(self):
+        """
+        Take off the items in segments the overflow skipped as expired.
+        """
+        self._drop_expired(self._spill.take_expired())
+
+    def _drop_expired(self, count):
+        """
+        Take 'count' expired items, no longer in the buffer or the overflow,
+        off the queue.
+        """
+        if count:
+            self._contains -= count
+            self._expired(count)
+
+    def _live(self, entries):
+        """
+        Return the items of those (expiry time, item) pairs that haven't
+        expired, counting the rest.
+        """
+        now = _time()
+        items = [entry[1] for entry in entries if entry[0] > now]
+        if len(items) < len(entries):
+            self._expired(len(entries) - len(items))
+        return items
+
+    def put(self, item, block=True, timeout=None, ttl=None):
+        """
+        Put an item into the queue (must be pickle-able, or whatever the
+        queue's serializer accepts)
+
+        Note: optional arguments 'block' and 'timeout' are only used with
+        'max_disk_bytes' and the "block" disk_full policy, when a put may
+        have to wait for room in the overflow (raising Full if there is
+        none by then). Otherwise FileQueue always has a file to put any
+        overflow into, so there is no time when put needs to block
+
+        An expiring queue takes a 'ttl', the number of seconds after which
+        the item is skipped by gets (default the queue's 'ttl').
+        """
+        if self._expiring:
+            item = self._entry(item, ttl)
+        elif ttl is not None:
+            raise ValueError("'ttl' needs a queue made with expiring=True")
+        record = key = size = None
+        if self._max_buffer_bytes is not None:
+            size, record = self._item_size(item)
+        if self._keys is not None:
+            if self._key is None and record is None:
+                # the key is the record, which a spill can use as well
+                record = self._dumps(item)
+            key = self._item_key(item, record)
+        self.not_full.acquire()
+        try:
+            if key is not None and not self._keys.add(key):
+                return
+            try:
+                self._put_item(item, record, size, key, block, timeout)
+            except BaseException:
+                if key is not None:
+                    self._keys.discard(key)
+                raise
+        finally:
+            self.not_full.release()
+
+    def _put_item(self, item, record, size, key, block, timeout):
+        if self._overflowing():
+            self._spill_item(item, record, block, timeout)
+            return
+        if self._max_buffer_bytes is None:
+            if self._buffer_size() < self.maxsize:
+                self._put_buffered(item, key)
+            elif self._quota is None and record is None:
+                self._put_file(item)
+            else:
+                self._spill_item(item, record, block, timeout)
+            return
+        if (self._buffer_bytes + size <= self._max_buffer_bytes and
+                (not self.maxsize or self._buffer_size() < self.maxsize)):
+            self._put_buffered(item, key)
+            self._buffer_sizes.append(size)
+            self._buffer_bytes += size
+        else:
+            self._spill_item(item, record, block, timeout)
+
+    def _put_buffered(self, item, key):
+        self._put(item)
+        if key is not None:
+            self._buffer_keys.append(key)
+
+    def _spill_item(self, item, record, block, timeout):
+        """
+        Put an item into the overflow, using its serialised form 'record' if
+        that's already been worked out (else None).
+        """
+        if self._quota is None:
+            if record is None:
+                self._put_file(item)
+            else:
+                self._put_record(record)
+            return
+        if record is None:
+            record = self._unlocked(self._dumps, item)
+        if self._disk_room([record], block, timeout):
+            self._put_record(record)
+
+    def put_many(self, items, block=True, timeout=None, ttl=None):
+        """
+        Put every item from the iterable 'items' into the queue, taking the
+        lock once and writing any that overflow to disk together.
+        'block', 'timeout' and 'ttl' are used as for put. With the "block"
+        policy, a put_many that runs out of time waiting for room in the
+        overflow has still put the items that went in the buffer.
+        """
+        if self._expiring:
+            expires = self._entry(None, ttl)[0]
+            items = [(expires, item) for item in items]
+        elif ttl is not None:
+            raise ValueError("'ttl' needs a queue made with expiring=True")
+        items = list(items)
+        if not items:
+            return
+        keys = None
+        if self._keys is not None:
+            keys = [self._item_key(item) for item in items]
+        self.not_full.acquire()
+        try:
+            if keys is not None:
+                items, keys = self._add_keys(items, keys)
+                if not items:
+                    return
+            done = 0
+            try:
+                if self._overflowing():
+                    room = 0
+                elif self._max_buffer_bytes is None:
+                    room = max(0, self.maxsize - self._buffer_size())
+                else:
+                    sizes = self._buffer_room(items)
+                    room = len(sizes)
+                if keys is not None and self._key is None:
+                    # the keys are the records
+                    records = keys[room:]
+                elif room < len(items):
+                    # serialise first so a bad item doesn't leave a batch
+                    # half put
+                    records = self._unlocked(self._dump_items, items[room:])
+                else:
+                    records = []
+                if room:
+                    # other puts may have filled the buffer in the meantime
+                    if self._max_buffer_bytes is None:
+                        fits = max(0, self.maxsize - self._buffer_size())
+                    else:
+                        fits = self._sizes_room(sizes)
+                    if fits < room:
+                        records[:0] = self._dump_items(items[fits:room])
+                        room = fits
+                        if self._max_buffer_bytes is not None:
+                            del sizes[fits:]
+                quota = self._quota is not None and bool(records)
+                if quota and self._disk_full != "block":
+                    # nothing has been put yet, if this raises
+                    records = self._disk_room(records, block, timeout)
+                if room:
+                    self._put_many(items[:room])
+                    if keys is not None:
+                        self._buffer_keys.extend(keys[:room])
+                    if self._max_buffer_bytes is not None:
+                        self._buffer_sizes.extend(sizes)
+                        self._buffer_bytes += sum(sizes)
+                    done = room
+                if quota and self._disk_full == "block":
+                    records = self._disk_room(records, block, timeout)
+                if records:
+                    self._put_many_file(records)
+            except BaseException:
+                if keys is not None:
+                    for key in keys[done:]:
+                        self._keys.discard(key)
+                raise
+        finally:
+            self.not_full.release()
+
+    def _add_keys(self, items, keys):
+        """
+        Add the keys of a put_many's items to the key index, and return the
+        items and keys that weren't already there (or earlier in the batch).
+        """
+        add = self._keys.add
+        kept = []
+        kept_keys = []
+        for item, key in zip(items, keys):
+            if add(key):
+                kept.append(item)
+                kept_keys.append(key)
+        return kept, kept_keys
+
+    def _dump_items(self, items):
+        dumps = self._dumps
+        return [dumps(item) for item in items]
+
+    def _get(self):
+        item = Queue._get(self)
+        if self._buffer_sizes:
+            self._buffer_bytes -= self._buffer_sizes.popleft()
+        self._get_done()
+        if self._buffer_keys:
+            self._keys.discard(self._buffer_keys.popleft())
+        return item
+
+    def _get_file(self):
+        try:
+            record = self._spill.read()
+        finally:
+            if self._skip_segments:
+                self._take_skipped()
+        self._get_done()
+        if self._quota is not None:
+            self._spill_taken(len(record))
+        if self._keys is not None and self._key is None:
+            self._forget_records((record,))
+        self.mutex.release()
+        try:
+            item = self._loads(record)
+        finally:
+            self.mutex.acquire()
+        if self._key is not None:
+            self._forget((item,))
+        return item
+
+    def _get_many(self, count):
+        popleft = self.queue.popleft
+        items = [popleft() for i in range(min(count, len(self.queue)))]
+        if self._buffer_sizes:
+            popleft = self._buffer_sizes.popleft
+            for i in range(len(items)):
+                self._buffer_bytes -= popleft()
+        self._get_done(len(items))
+        if self._buffer_keys:
+            popleft = self._buffer_keys.popleft
+            discard = self._keys.discard
+            for i in range(len(items)):
+                discard(popleft())
+        return items
+
+    def _get_many_file(self, count):
+        try:
+            records = self._spill.read_many(count)
+        finally:
+            if self._skip_segments:
+                self._take_skipped()
+        self._get_done(len(records))
+        if self._quota is not None:
+            self._spill_taken(sum(map(len, records)))
+        if self._keys is not None and self._key is None:
+            self._forget_records(records)
+        items = self._unlocked(self._load_records, records)
+        if self._key is not None:
+            self._forget(items)
+        return items
+
+    def _load_records(self, records):
+        loads = self._loads
+        return [loads(record) for record in records]
+
+    def _get_done(self, count=1):
+        self._contains -= count
+        if self._quota is None:
+            self.not_full.notify(count)
+        else:
+            # a put waiting for room may need less than one item's worth
+            self.not_full.notify_all()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return an item from the queue.
+
+        If optional args 'block' is true and 'timeout' is None (the default),
+        block if necessary until an item is available. If 'timeout' is
+        a positive number, it blocks at most 'timeout' seconds and raises
+        the Empty exception if no item was available within that time.
+        Otherwise ('block' is false), return an item if one is immediately
+        available, else raise the Empty exception ('timeout' is ignored
+        in that case).
+        """
+        self.not_empty.acquire()
+        try:
+            while True:
+                self._get_block_check(block, timeout)
+                if self._ordered and not self._buffer_size():
+                    self._refill()
+                if self._buffer_size():
+                    item = self._get()
+                else:
+                    try:
+                        item = self._get_file()
+                    except Empty:
+                        # only right if items were skipped as expired
+                        self._check_spilled()
+                        continue
+                if self._expiring:
+                    if item[0] <= _time():
+                        self._expired(1)
+                        continue
+                    item = item[1]
+                return item
+        finally:
+            self.not_empty.release()
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """
+        Remove and return a list of up to 'max_items' items, taking the lock
+        once and reading the overflow in one go.
+
+        Blocks until at least one item is available in the same way as get,
+        then returns whatever is available up to 'max_items' without waiting
+        for more.
+        """
+        if max_items < 1:
+            raise ValueError("'max_items' must be at least 1")
+        self.not_empty.acquire()
+        try:
+            while True:
+                self._get_block_check(block, timeout)
+                count = min(max_items, self._qsize())
+                items = self._get_many(count)
+                if len(items) < count:
+                    items.extend(self._get_many_file(count - len(items)))
+                    if not items:
+                        self._check_spilled()
+                if self._expiring:
+                    items = self._live(items)
+                if items:
+                    return items
+        finally:
+            self.not_empty.release()
+
+    def _check_spilled(self):
+        """
+        Raise an error if the queue counts items its overflow turned out not
+        to have, rather than look for them forever.
+        """
+        if self._qsize() > self._buffer_size():
+            raise RuntimeError("The overflow has none of the %i items counted "
+                               "in it" % (self._qsize() - self._buffer_size()))
+
+    def _get_block_check(self, block, timeout):
+        if not block:
+            if not self._qsize():
+                raise Empty
+        elif timeout is None:
+            while not self._qsize():
+                self.not_empty.wait()
+        elif timeout < 0:
+            raise ValueError("'timeout' must be a positive number")
+        else:
+            endtime = _time() + timeout
+            while not self._qsize():
+                remaining = endtime - _time()
+                if remaining <= 0.0:
+                    raise Empty
+                self.not_empty.wait(remaining)
+
+
+class PriorityFileQueue(FileQueue):
+    """
+    Variant of FileQueue that retrieves entries in priority order (lowest
+    first). Each priority with items queued has its own FileQueue, and only
+    those are kept, in a heap, so a get doesn't look at any other priority
+    and a level's files are removed as soon as it's drained.
+
+    With 'shared_spill' set, the levels all overflow into one shared chain of
+    segment files instead of a chain each, so the number of open files
+    depends on the size of the overflow and not the number of priorities.
+
+    'max_disk_bytes' limits the overflow of all the levels together. The
+    "drop_oldest" disk_full policy isn't available, as the oldest items
+    aren't the next out of a priority queue.
+    """
+
+    def __init__(self, maxsize=0, default_priority=1, shared_spill=False,
+                 **kwargs):
+        """
+        :type maxsize: int
+        :param maxsize: Set the maximum number of items to be held in the
+            buffer of each priority level
+        :param default_priority: Priority for items put without one
+        :type shared_spill: bool
+        :param shared_spill: Write every level's overflow to the same files
+        :param kwargs: Passed on to the FileQueue of each priority level
+        """
+        if kwargs.get("durable"):
+            raise ValueError("Only FileQueue can be durable")
+        if kwargs.get("unique") or kwargs.get("key") is not None:
+            raise ValueError("Only FileQueue and LifoFileQueue can be unique")
+        if kwargs.get("expiring") or kwargs.get("ttl") is not None:
+            raise ValueError("Only FileQueue and LifoFileQueue can be "
+                             "expiring")
+        max_disk_bytes = kwargs.pop("max_disk_bytes", None)
+        disk_full = kwargs.pop("disk_full", "block")
+        if disk_full not in _DISK_FULL_POLICIES:
+            raise ValueError("'disk_full' must be one of %s" %
+                             ", ".join(_DISK_FULL_POLICIES))
+        if disk_full == "drop_oldest":
+            raise ValueError("A PriorityFileQueue can't drop its oldest items")
+        Queue.__init__(self, 1)
+        self._quota = None
+        self._disk_full = disk_full
+        if max_disk_bytes is not None:
+            self._quota = _DiskQuota(max_disk_bytes)
+        self._metrics = None
+        if kwargs.get("metrics") or kwargs.get("metrics_hook") is not None:
+            self._metrics = _Metrics(kwargs.get("metrics_hook"))
+            self._instrument()
+        self._contains = 0
+        self._max_buffer_size = maxsize
+        self._queue_kwargs = kwargs
+        self._default_priority = default_priority
+        self._heap = list()
+        self._levels = dict()
+        # compression figures of the levels already drained and disposed of
+        self._raw_bytes = self._stored_bytes = 0
+        self._shared_spill = None
+        if shared_spill:
+            self._shared_spill = _SharedSpill(**dict(
+                (name, value) for name, value in kwargs.items()
+                if name in _SHARED_SPILL_OPTIONS))
+
+    def dispose(self):
+        for q in getattr(self, "_levels", {}).values():
+            q.dispose()
+        if getattr(self, "_shared_spill", None) is not None:
+            self._shared_spill.close()
+
+    # the levels time their own operations, this only times the lock
+    _timed_hooks = ()
+
+    def _all_metrics(self):
+        # what's been collected by this queue's lock and the levels drained
+        # so far, plus the current levels
+        metrics = _Metrics()
+        metrics.merge(self._metrics)
+        for q in self._levels.values():
+            metrics.merge(q._metrics)
+        return metrics
+
+    def _stats(self):
+        levels = list(self._levels.values())
+        buffered = sum(q._buffer_size() for q in levels)
+        if self._shared_spill is not None:
+            segments, disk_bytes, reclaimable_bytes = (
+                self._shared_spill.disk_usage())
+            raw_bytes = self._shared_spill._raw_bytes
+            stored_bytes = self._shared_spill._stored_bytes
+        else:
+            segments = disk_bytes = reclaimable_bytes = 0
+            raw_bytes, stored_bytes = self._raw_bytes, self._stored_bytes
+            for q in levels:
+                usage = q._spill.disk_usage()
+                segments += usage[0]
+                disk_bytes += usage[1]
+                reclaimable_bytes += usage[2]
+                raw_bytes += q._spill._raw_bytes
+                stored_bytes += q._spill._stored_bytes
+        return dict(
+            qsize=self._qsize(), levels=len(levels), buffered_items=buffered,
+            spilled_items=self._qsize() - buffered,
+            buffered_bytes=(sum(q._buffer_bytes for q in levels)
+                            if self._queue_kwargs.get("max_buffer_bytes")
+                            is not None else None),
+            segments=segments, disk_bytes=disk_bytes,
+            reclaimable_bytes=reclaimable_bytes, bytes_written=raw_bytes,
+            bytes_stored=stored_bytes,
+            compression_ratio=self.compression_ratio(),
+            spilled_bytes=self._quota.used if self._quota else None,
+            dropped_items=self._quota.dropped if self._quota else 0)
+
+    def full(self):
+        """
+        Return True if an item the size of the last one put in the overflow
+        wouldn't fit under 'max_disk_bytes' (the buffer of the level the next
+        item goes to may still have room). Only a guess, as for
+        FileQueue.full.
+        """
+        quota = self._quota
+        return quota is not None and quota.full()
+
+    def compression_ratio(self):
+        if self._shared_spill is not None:
+            return self._shared_spill.compression_ratio()
+        raw_bytes, stored_bytes = self._raw_bytes, self._stored_bytes
+        for q in self._levels.values():
+            raw_bytes += q._spill._raw_bytes
+            stored_bytes += q._spill._stored_bytes
+        if not stored_bytes:
+            return 1.0
+        return float(raw_bytes) / stored_bytes
+
+    def _get_queue(self, priority):
+        queue = self._levels.get(priority)
+        if queue is None:
+            if self._shared_spill is not None:
+                queue = _PriorityLevel(self._shared_spill,
+                                       self._max_buffer_size,
+                                       **self._queue_kwargs)
+            else:
+                queue = FileQueue(self._max_buffer_size, **self._queue_kwargs)
+            if self._quota is not None:
+                # the levels share the quota, and leave waiting to this queue
+                queue._quota = self._quota
+                if self._disk_full != "drop_newest":
+                    queue._disk_full = "raise"
+                else:
+                    queue._disk_full = "drop_newest"
+            heapq.heappush(self._heap, priority)
+            self._levels[priority] = queue
+        return queue
+
+    def _drop_queue(self, priority=None):
+        """
+        Remove a (drained) level, the highest priority one by default.
+        """
+        if priority is None:
+            priority = heapq.heappop(self._heap)
+        else:
+            self._heap.remove(priority)
+            heapq.heapify(self._heap)
+        queue = self._levels.pop(priority)
+        self._raw_bytes += queue._spill._raw_bytes
+        self._stored_bytes += queue._spill._stored_bytes
+        if self._metrics is not None:
+            self._metrics.merge(queue._metrics)
+        queue.dispose()
+
+    def put(self, item, block=True, timeout=None, priority=DEFAULT):
+        self.not_full.acquire()
+        try:
+            if priority is DEFAULT:
+                priority= self._default_priority
+            if self._quota is None:
+                self._get_queue(priority).put(item)
+                self._put_done()
+            else:
+                self._put_level(priority, FileQueue.put, item, block,
+                                timeout)
+        finally:
+            self.not_full.release()
+
+    def put_many(self, items, block=True, timeout=None, priority=DEFAULT):
+        """
+        Put every item from the iterable 'items' into the queue with the
+        same priority.
+        """
+        items = list(items)
+        if not items:
+            return
+        self.not_full.acquire()
+        try:
+            if priority is DEFAULT:
+                priority= self._default_priority
+            if self._quota is None:
+                self._get_queue(priority).put_many(items)
+                self._put_done(len(items))
+            else:
+                self._put_level(priority, FileQueue.put_many, items, block,
+                                timeout)
+        finally:
+            self.not_full.release()
+
+    def _put_level(self, priority, put, items, block, timeout):
+        """
+        Call put(level, items) with the disk quota in force. A level raises
+        Full without putting anything when the overflow has no room (or
+        drops what doesn't fit), and any waiting for room is done here,
+        where gets notify.
+        """
+        if block and timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
+            endtime = _time() + timeout
+        while True:
+            queue = self._get_queue(priority)
+            before = queue._qsize()
+            try:
+                put(queue, items)
+            except Full:
+                if not queue._qsize():
+                    self._drop_queue(priority)
+                if self._disk_full == "raise" or not block:
+                    raise
+                if timeout is None:
+                    self.not_full.wait()
+                else:
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        raise
+                    self.not_full.wait(remaining)
+                continue
+            if not queue._qsize():
+                # everything was dropped
+                self._drop_queue(priority)
+            self._put_done(queue._qsize() - before)
+            return
+
+    def get(self, block=True, timeout=None):
+        self.not_empty.acquire()
+        try:
+            self._get_block_check(block, timeout)
+            queue = self._levels[self._heap[0]]
+            item = queue.get(False)
+            if not queue._qsize():
+                self._drop_queue()
+            self._get_done()
+            return item
+        finally:
+            self.not_empty.release()
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """
+        Remove and return a list of up to 'max_items' items, highest priority
+        first.
+        """
+        if max_items < 1:
+            raise ValueError("'max_items' must be at least 1")
+        self.not_empty.acquire()
+        try:
+            self._get_block_check(block, timeout)
+            items = []
+            while self._heap and len(items) < max_items:
+                queue = self._levels[self._heap[0]]
+                items.extend(queue.get_many(max_items - len(items), False))
+                if not queue._qsize():
+                    self._drop_queue()
+            self._get_done(len(items))
+            return items
+        finally:
+            self.not_empty.release()
+
+
+class _PriorityLevel(FileQueue):
+    """
+    A level of a PriorityFileQueue that overflows into a shared spill.
+    """
+
+    def __init__(self, shared_spill, *args, **kwargs):
+        self._shared_spill = shared_spill
+        FileQueue.__init__(self, *args, **kwargs)
+
+    def _new_spill(self, read_ahead=DEFAULT_READ_AHEAD, **options):
+        return _SharedSpillLevel(self._shared_spill, read_ahead)
+
+
+class LifoFileQueue(FileQueue):
+    """Variant of FileQueue that retrieves most recently added entries first."""
+
+    _spill_class = _LifoSpill
+
+
+class DelayFileQueue(PriorityFileQueue):
+    """
+    Variant of FileQueue where each item is hidden until the time it's due,
+    given to put as a 'delay' in seconds or a 'not_before' timestamp, and
+    items are returned in order of that time.
+
+    Items due within the current 'bucket_seconds' long stretch of time are
+    kept in memory in a heap. Later ones go to a level per bucket, on the
+    priority machinery, so they overflow to disk (with maxsize=0, the
+    default, all of them do). When a bucket's time comes it's read back into
+    the heap in one go. A blocked get sleeps until the earliest item in the
+    heap is due or the next bucket starts, whichever comes first, and a put
+    of an earlier item wakes it.
+
+    qsize() counts every item, due or not, so a get can block on a queue
+    that isn't empty.
+    """
+
+    def __init__(self, maxsize=0, bucket_seconds=60, **kwargs):
+        """
+        :type maxsize: int
+        :param maxsize: Set the maximum number of items to be held in the
+            buffer of each bucket
+        :type bucket_seconds: float
+        :param bucket_seconds: Length of the stretches of time items are
+            grouped into on disk
+        :param kwargs: Passed on to the FileQueue of each bucket
+        """
+        if bucket_seconds <= 0:
+            raise ValueError("'bucket_seconds' must be a positive number")
+        serializer = kwargs.pop("serializer", None)
+        if serializer is None:
+            serializer = _DEFAULT_SERIALIZER
+        kwargs["serializer"] = _DueSerializer(serializer)
+        sizer = kwargs.pop("sizer", None)
+        if sizer is not None:
+            kwargs["sizer"] = lambda entry: sizer(entry[1])
+        PriorityFileQueue.__init__(self, maxsize, **kwargs)
+        self._bucket_seconds = bucket_seconds
+        # (due time, sequence number, item) of the items in memory
+        self._due = []
+        self._sequence = 0
 
-__all__ = ["Empty", "Full", "FileQueue", "PriorityFileQueue", "LifoFileQueue"]
+    def _stats(self):
+        stats = PriorityFileQueue._stats(self)
+        stats["buffered_items"] += len(self._due)
+        stats["spilled_items"] -= len(self._due)
+        return stats
 
-DEFAULT = None
+    def _due_time(self, delay, not_before):
+        if not_before is not None:
+            return not_before
+        return _time() + (delay or 0)
 
-_file_open = open
+    def _push(self, due, item):
+        heapq.heappush(self._due, (due, self._sequence, item))
+        self._sequence += 1
 
+    def _wake_for(self, due):
+        """
+        Wake the blocked gets if an item due at 'due' is earlier than any
+        they could be waiting for.
+        """
+        if self._due and self._due[0][0] < due:
+            return
+        if self._heap and self._heap[0] * self._bucket_seconds < due:
+            return
+        self.not_empty.notify_all()
 
-class FileQueue(Queue):
+    def put(self, item, block=True, timeout=None, delay=None,
+            not_before=None):
+        """
+        Put an item into the queue, to be got no sooner than 'delay' seconds
+        from now, or the time.time() timestamp 'not_before' (straight away
+        with neither). 'block' and 'timeout' are used as for FileQueue.put.
+        """
+        self.put_many([item], block, timeout, delay, not_before)
+
+    def put_many(self, items, block=True, timeout=None, delay=None,
+                 not_before=None):
+        """
+        Put every item from the iterable 'items' into the queue, all due at
+        the same time.
+        """
+        items = list(items)
+        if not items:
+            return
+        due = self._due_time(delay, not_before)
+        bucket = int(due // self._bucket_seconds)
+        self.not_full.acquire()
+        try:
+            self._wake_for(due)
+            if bucket <= int(_time() // self._bucket_seconds):
+                for item in items:
+                    self._push(due, item)
+                self._put_done(len(items))
+                return
+            entries = [(due, item) for item in items]
+            if self._quota is None:
+                self._get_queue(bucket).put_many(entries)
+                self._put_done(len(entries))
+            else:
+                self._put_level(bucket, FileQueue.put_many, entries, block,
+                                timeout)
+        finally:
+            self.not_full.release()
+
+    def _promote(self, now):
+        """
+        Move the items of every bucket that has started into the heap.
+        """
+        while self._heap and self._heap[0] * self._bucket_seconds <= now:
+            queue = self._levels[self._heap[0]]
+            for due, item in queue.get_many(queue._qsize(), False):
+                self._push(due, item)
+            self._drop_queue()
+            if self._quota is not None:
+                # room made on disk
+                self.not_full.notify_all()
+
+    def _wait_due(self, block, timeout):
+        """
+        Wait until an item is due, in the same way as a get waits for an
+        item in the other queues.
+        """
+        if block and timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
+            endtime = _time() + timeout
+        while True:
+            now = _time()
+            self._promote(now)
+            if self._due and self._due[0][0] <= now:
+                return now
+            if not block:
+                raise Empty
+            wake = None
+            if self._due:
+                wake = self._due[0][0]
+            if self._heap:
+                start = self._heap[0] * self._bucket_seconds
+                if wake is None or start < wake:
+                    wake = start
+            if timeout is not None:
+                if now >= endtime:
+                    raise Empty
+                if wake is None or endtime < wake:
+                    wake = endtime
+            self.not_empty.wait(None if wake is None else wake - now)
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the earliest item that's due, waiting for one as
+        FileQueue.get waits for an item.
+        """
+        self.not_empty.acquire()
+        try:
+            self._wait_due(block, timeout)
+            item = heapq.heappop(self._due)[2]
+            self._get_done()
+            return item
+        finally:
+            self.not_empty.release()
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """
+        Remove and return a list of up to 'max_items' items that are due,
+        earliest first, waiting until at least one is.
+        """
+        if max_items < 1:
+            raise ValueError("'max_items' must be at least 1")
+        self.not_empty.acquire()
+        try:
+            now = self._wait_due(block, timeout)
+            due = self._due
+            items = []
+            while due and due[0][0] <= now and len(items) < max_items:
+                items.append(heapq.heappop(due)[2])
+            self._get_done(len(items))
+            return items
+        finally:
+            self.not_empty.release()
+
+
+class _ItemCount(object):
+    """
+    The items of a ShardedFileQueue not yet claimed by a get, and its
+    unfinished tasks. A put wakes one waiting get per item, and nothing
+    slow is done holding the lock.
     """
-    Class to a thread safe file queue object. Keeps the same interface
-    and is interchangeable with the Queue in the python standard lib (see note).
-    Put objects into a queue, the same as the regular Queue.Queue but any
-    overflow (number of items in the queue greater than maxsize) will get put
-    into a gzipped file on disk to keep excessive amounts of queued items out
-    of memory.
 
-    Note: The order items are returned is guaranteed FIFO only if no buffer is
-    set (maxsize=0). If a buffer size is set it remains FIFO until the point at
-    which the buffer overflows in which case you cannot rely on the order of
-    returned items to be the same as they were put in. I wouldn't recommend
-    using this queue with maxsize set if the order of the items is important.
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.available = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        self.count = 0
+        self.unfinished_tasks = 0
 
-    (Items in the overflow will be retrieved in the order they were put into
-    the overflow, but a series of 'put's may put some items in the buffer,
-    and some in the overflow, meaning the order ends up being slightly shuffled,
-    because items in the buffer will always be returned before any in the
-    overflow, which is only ever accessed when nothing is available from the
-    buffer)
+    def added(self, count):
+        with self.mutex:
+            self.count += count
+            self.unfinished_tasks += count
+            self.available.notify(count)
+
+    def claim(self, most, block, timeout):
+        """
+        Claim up to 'most' items, waiting for at least one as a get waits,
+        and return how many were claimed.
+        """
+        with self.mutex:
+            if not block:
+                if not self.count:
+                    raise Empty
+            elif timeout is None:
+                while not self.count:
+                    self.available.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
+            else:
+                endtime = _time() + timeout
+                while not self.count:
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.available.wait(remaining)
+            count = min(most, self.count)
+            self.count -= count
+            return count
+
+    def unclaim(self, count):
+        with self.mutex:
+            self.count += count
+            self.available.notify(count)
+
+    def task_done(self):
+        with self.mutex:
+            if self.unfinished_tasks <= 0:
+                raise ValueError("task_done() called too many times")
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.mutex:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+
+class ShardedFileQueue(object):
     """
+    A queue spread over several FileQueue shards, each with its own lock,
+    buffer and overflow, for many threads putting and getting at once.
 
-    def __init__(self, maxsize=0):
+    Puts go to the shards in turn. Each thread getting has a home shard it
+    takes items from, and takes them from the others when that one is
+    empty. A get waits on a shared count of the items, which a put bumps,
+    waking one get per item put.
+
+    qsize, task_done and join cover the queue as a whole. Items aren't
+    returned in any particular order across the shards.
+    """
+
+    def __init__(self, maxsize=0, shards=None, **kwargs):
         """
         :type maxsize: int
-        :param maxsize: Set the maximum number of items to be held in the buffer
+        :param maxsize: Set the maximum number of items to be held in the
+            buffer of each shard
+        :type shards: int
+        :param shards: Number of shards (default one per CPU)
+        :param kwargs: Passed on to the FileQueue of each shard
+            ('max_disk_bytes' applies to each shard's overflow, and only
+            the "block" and "raise" disk_full policies are available, as
+            the count of items a get waits on can't follow dropped ones)
         """
-        Queue.__init__(self, maxsize)
-        self._contains = 0
-        self._temp_file = tempfile.NamedTemporaryFile(suffix=".queue")
-        self._read_pos = self._write_pos = 0
-        self._init_fds()
-
-    def _init_fds(self):
-        self._file_write = self._file_read = self._temp_file
+        if kwargs.get("durable"):
+            raise ValueError("Only FileQueue can be durable")
+        if kwargs.get("disk_full") in ("drop_oldest", "drop_newest"):
+            raise ValueError("A ShardedFileQueue can't drop items")
+        if kwargs.get("unique") or kwargs.get("key") is not None:
+            raise ValueError("Only FileQueue and LifoFileQueue can be unique")
+        if kwargs.get("expiring") or kwargs.get("ttl") is not None:
+            raise ValueError("Only FileQueue and LifoFileQueue can be "
+                             "expiring")
+        if shards is None:
+            shards = getattr(os, "cpu_count", lambda: None)() or 4
+        if shards < 1:
+            raise ValueError("'shards' must be at least 1")
+        self.maxsize = maxsize
+        self._shards = [FileQueue(maxsize, **kwargs) for i in range(shards)]
+        self._count = _ItemCount()
+        self._next_put = itertools.count()
+        self._next_home = itertools.count()
+        self._local = threading.local()
 
     def __del__(self):
         self.dispose()
 
     def dispose(self):
-        self._file_read.close()
-        self._file_write.close()
+        for shard in getattr(self, "_shards", ()):
+            shard.dispose()
 
-    def _buffer_size(self):
+    def compression_ratio(self):
+        raw_bytes = sum(shard._spill._raw_bytes for shard in self._shards)
+        stored_bytes = sum(shard._spill._stored_bytes
+                           for shard in self._shards)
+        if not stored_bytes:
+            return 1.0
+        return float(raw_bytes) / stored_bytes
+
+    def stats(self):
         """
-        Return the approximate size of the buffer (not reliable!).
+        Return the totals of the shards' stats(), as FileQueue.stats, with
+        'shards' the number of them.
         """
-        return Queue._qsize(self)
+        stats = dict(shards=len(self._shards))
+        metrics = None
+        for shard in self._shards:
+            shard.mutex.acquire()
+            try:
+                for name, value in shard._stats().items():
+                    if value is not None:
+                        value += stats.get(name) or 0
+                    stats[name] = value
+                if shard._metrics is not None:
+                    if metrics is None:
+                        metrics = _Metrics()
+                    metrics.merge(shard._metrics)
+            finally:
+                shard.mutex.release()
+        stats["compression_ratio"] = self.compression_ratio()
+        if metrics is not None:
+            stats.update(metrics.snapshot())
+        return stats
+
+    def _home(self):
+        try:
+            return self._local.home
+        except AttributeError:
+            home = self._local.home = (next(self._next_home) %
+                                       len(self._shards))
+            return home
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put an item into the next shard in turn. 'block' and 'timeout' are
+        used as for FileQueue.put.
+        """
+        shard = self._shards[next(self._next_put) % len(self._shards)]
+        shard.put(item, block, timeout)
+        self._count.added(1)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_many(self, items, block=True, timeout=None):
+        """
+        Put every item from the iterable 'items' into the queue, split
+        evenly between the shards.
+        """
+        items = list(items)
+        shards = len(self._shards)
+        step = -(-len(items) // shards)
+        for i in range(0, len(items), step or 1):
+            shard = self._shards[next(self._next_put) % shards]
+            shard.put_many(items[i:i + step], block, timeout)
+            self._count.added(len(items[i:i + step]))
+
+    def _take(self, count):
+        """
+        Take 'count' claimed items, from the home shard first. The items
+        are there to be taken, but may have to be looked for again if other
+        gets take them from a shard after this one has looked at it.
+        """
+        shards = self._shards
+        home = self._home()
+        items = []
+        try:
+            while len(items) < count:
+                taken = len(items)
+                for i in range(len(shards)):
+                    shard = shards[(home + i) % len(shards)]
+                    try:
+                        items.extend(shard.get_many(count - len(items),
+                                                    False))
+                    except Empty:
+                        continue
+                    if len(items) == count:
+                        break
+                if len(items) == taken and self._drained():
+                    # The count was out, the rest of the items claimed
+                    # aren't anywhere to be taken. Forget them rather than
+                    # look for them forever
+                    if not items:
+                        raise Empty
+                    return items
+        except Empty:
+            raise
+        except:
+            self._count.unclaim(count - len(items))
+            raise
+        return items
+
+    def _drained(self):
+        """
+        Return True if every shard is empty, checked with all their locks
+        held so gets taking items meanwhile can't make it look that way.
+        """
+        locked = []
+        try:
+            for shard in self._shards:
+                shard.mutex.acquire()
+                locked.append(shard)
+            return not any(shard._qsize() for shard in self._shards)
+        finally:
+            for shard in locked:
+                shard.mutex.release()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return an item from the queue, waiting for one as
+        FileQueue.get does.
+        """
+        self._count.claim(1, block, timeout)
+        try:
+            return self._shards[self._home()].get(False)
+        except Empty:
+            return self._take(1)[0]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """
+        Remove and return a list of up to 'max_items' items, waiting until
+        at least one is available.
+        """
+        if max_items < 1:
+            raise ValueError("'max_items' must be at least 1")
+        return self._take(self._count.claim(max_items, block, timeout))
+
+    def qsize(self):
+        """
+        Return the approximate number of items in the queue.
+        """
+        return sum(shard.qsize() for shard in self._shards)
+
+    def empty(self):
+        return not self._count.count
 
     def full(self):
         """
-        Return True if the queue is full, False otherwise.
-        (always returns False- can't be full because of the overflow)
+        Return True if every shard is full (see FileQueue.full).
         """
-        return False
+        return all(shard.full() for shard in self._shards)
 
-    def _qsize(self, len=len):
-        return self._contains
+    def task_done(self):
+        """
+        Indicate that a formerly enqueued task is complete, as for Queue.
+        """
+        self._count.task_done()
 
-    def _put(self, item):
-        Queue._put(self, item)
-        self._put_done()
+    def join(self):
+        """
+        Block until every item put into the queue has been got and processed.
+        """
+        self._count.join()
 
-    @contextmanager
-    def _put_file_wrapper(self):
-        self._file_write.seek(self._write_pos)
-        yield
-        self._write_pos = self._file_write.tell()
 
-    def _put_file(self, item):
-        with self._put_file_wrapper():
-            _pickle.dump(item, self._file_write, _pickle.HIGHEST_PROTOCOL)
-        self._put_done()
+class ProcessFileQueue(object):
+    """
+    Queue shared by any number of processes, kept in the directory 'path'.
+    Items are written straight to segment files there as they're put, with
+    the positions of the first and last items in a state file that every
+    operation locks (with flock, so not on windows). Processes waiting in get
+    are woken through a fifo in the directory.
 
-    def _put_done(self):
-        self._contains += 1
-        self.unfinished_tasks += 1
-        self.not_empty.notify()
+    A ProcessFileQueue can be passed to multiprocessing workers, each
+    process opens the directory for itself. It has the interface of
+    FileQueue, without a memory buffer. The files are left in the directory
+    when the queue is disposed of, for the other processes.
+    """
 
-    def put(self, item, block=True, timeout=None):
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE,
+                 compression=None, serializer=None):
+        """
+        :type path: str
+        :param path: Directory the queue is kept in, the same for every
+            process using it
+        :type segment_size: int
+        :param segment_size: Size in bytes at which the files roll over to a
+            new segment, segments are deleted once every item in them has
+            been got
+        :param compression: As for FileQueue, each put is compressed as a block
+        :param serializer: As for FileQueue
+        """
+        if fcntl is None:
+            raise IOError("ProcessFileQueue needs fcntl, which this platform "
+                          "doesn't have")
+        self._args = dict(path=path, segment_size=segment_size,
+                          compression=compression, serializer=serializer)
+        self._path = path
+        self._segment_size = segment_size
+        self._codec = _get_codec(compression)
+        if serializer is None:
+            serializer = _DEFAULT_SERIALIZER
+        self._dumps = serializer.dumps
+        self._loads = serializer.loads
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        wakeup = os.path.join(path, "wakeup")
+        try:
+            os.mkfifo(wakeup)
+        except OSError:
+            if not os.path.exists(wakeup):
+                raise
+        self._open()
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._mutex = threading.Lock()
+        self._state_fd = os.open(os.path.join(self._path, "state"),
+                                 os.O_RDWR | os.O_CREAT, 420)
+        # Opened for writing as well, so there's always a writer and the fifo
+        # never reads as closed
+        self._wakeup_fd = os.open(os.path.join(self._path, "wakeup"),
+                                  os.O_RDWR | os.O_NONBLOCK)
+        self._segments = {}
+        # (segment id, position, records, block length) of the last block
+        # read, whose remaining items are taken by the following gets
+        self._block = None
+
+    def __getstate__(self):
+        return self._args
+
+    def __setstate__(self, args):
+        self.__init__(**args)
+
+    def __del__(self):
+        self.dispose()
+
+    def dispose(self):
         """
-        Put an item into the queue (must be pickle-able)
+        Close this process's files. The queue itself is left in its directory.
+        """
+        if getattr(self, "_state_fd", None) is None:
+            return
+        for fd in self._segments.values():
+            os.close(fd)
+        self._segments.clear()
+        os.close(self._wakeup_fd)
+        os.close(self._state_fd)
+        self._state_fd = None
 
-        Note: optional arguments 'block' and 'timeout' are *IGNORED*.
-        FileQueue always has a file to put any overflow into, so there is
-        no time when put needs to block. These arguments only exist to hold
-        the interface with Queue.Queue
+    def _lock(self):
         """
-        self.not_full.acquire()
+        Lock the queue and return its state as a list.
+        """
+        if os.getpid() != self._pid:
+            # a forked child shares its parent's open files, and with them
+            # the flock, so it needs its own
+            for fd in list(self._segments.values()) + [self._wakeup_fd,
+                                                        self._state_fd]:
+                os.close(fd)
+            self._open()
+        self._mutex.acquire()
         try:
-            if self._buffer_size() < self.maxsize:
-                self._put(item)
-            else:
-                self._put_file(item)
+            fcntl.flock(self._state_fd, fcntl.LOCK_EX)
+            os.lseek(self._state_fd, 0, os.SEEK_SET)
+            data = os.read(self._state_fd, _PROCESS_STATE.size)
+        except:
+            self._unlock()
+            raise
+        if len(data) < _PROCESS_STATE.size:
+            return [0] * 7
+        return list(_PROCESS_STATE.unpack(data))
+
+    def _unlock(self, state=None):
+        """
+        Save 'state' (if the operation changed it) and unlock the queue.
+        """
+        try:
+            if state is not None:
+                os.lseek(self._state_fd, 0, os.SEEK_SET)
+                os.write(self._state_fd, _PROCESS_STATE.pack(*state))
         finally:
-            self.not_full.release()
+            fcntl.flock(self._state_fd, fcntl.LOCK_UN)
+            self._mutex.release()
 
-    def _get(self):
-        item = Queue._get(self)
-        self._get_done()
-        return item
+    def _segment(self, segment_id, create=False):
+        fd = self._segments.get(segment_id)
+        if fd is None:
+            flags = os.O_RDWR
+            if create:
+                flags |= os.O_CREAT | os.O_TRUNC
+            fd = os.open(os.path.join(self._path, _SEGMENT_NAME % segment_id),
+                         flags, 420)
+            self._segments[segment_id] = fd
+        elif create:
+            os.ftruncate(fd, 0)
+        return fd
 
-    @contextmanager
-    def _get_file_wrapper(self):
-        self._file_write.flush()
-        self._file_read.seek(self._read_pos)
-        yield
-        self._read_pos = self._file_read.tell()
+    def _drop_segments(self, head_id):
+        """
+        Close the files of segments before 'head_id', which have been read.
+        """
+        for segment_id in [segment_id for segment_id in self._segments
+                           if segment_id < head_id]:
+            os.close(self._segments.pop(segment_id))
 
-    def _get_file(self):
-        with self._get_file_wrapper():
-            try:
-                item = _pickle.load(self._file_read)
-            except EOFError:
-                raise Empty
-        self._get_done()
-        return item
+    def _notify(self, count):
+        try:
+            os.write(self._wakeup_fd, b"x" * min(count, 64))
+        except OSError:
+            # the fifo is full of wakeups nobody has waited for yet
+            pass
 
-    def _get_done(self):
-        self._contains -= 1
-        self.not_full.notify()
+    def _put_records(self, records):
+        data = _encode_block(records, self._codec)
+        state = self._lock()
+        new_state = None
+        try:
+            tail_id, tail_pos = state[3:5]
+            if tail_pos >= self._segment_size:
+                # cut off anything a failed put left behind before moving on
+                os.ftruncate(self._segment(tail_id), tail_pos)
+                tail_id += 1
+                tail_pos = 0
+            fd = self._segment(tail_id, create=not tail_pos)
+            os.lseek(fd, tail_pos, os.SEEK_SET)
+            os.write(fd, data)
+            new_state = state[:3] + [tail_id, tail_pos + len(data),
+                                     state[5] + len(records),
+                                     state[6] + len(records)]
+        finally:
+            self._unlock(new_state)
+        self._notify(len(records))
 
-    def get(self, block=True, timeout=None):
+    def put(self, item, block=True, timeout=None):
         """
-        Remove and return an item from the queue.
+        Put an item into the queue. 'block' and 'timeout' are ignored, as
+        for FileQueue.
+        """
+        self._put_records([self._dumps(item)])
 
-        If optional args 'block' is true and 'timeout' is None (the default),
-        block if necessary until an item is available. If 'timeout' is
-        a positive number, it blocks at most 'timeout' seconds and raises
-        the Empty exception if no item was available within that time.
-        Otherwise ('block' is false), return an item if one is immediately
-        available, else raise the Empty exception ('timeout' is ignored
-        in that case).
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_many(self, items, block=True, timeout=None):
         """
-        self.not_empty.acquire()
+        Put every item from the iterable 'items' into the queue, written
+        together as one block.
+        """
+        records = [self._dumps(item) for item in items]
+        if records:
+            self._put_records(records)
+
+    def _read_block(self, segment_id, pos):
+        block = self._block
+        if block is not None and block[:2] == (segment_id, pos):
+            return block[2], block[3]
+        fd = self._segment(segment_id)
+        os.lseek(fd, pos, os.SEEK_SET)
+        header = os.read(fd, _BLOCK_HEADER.size)
+        payload_len = _BLOCK_HEADER.unpack(header)[1]
+        records = _decode_blocks(header + os.read(fd, payload_len),
+                                 self._codec)
+        length = _BLOCK_HEADER.size + payload_len
+        self._block = (segment_id, pos, records, length)
+        return records, length
+
+    def _take_records(self, max_items):
+        """
+        Remove up to 'max_items' records from the head of the queue.
+        """
+        state = self._lock()
+        head_id, head_pos, taken, tail_id = state[:4]
+        count = state[5]
+        if not count:
+            self._unlock()
+            return []
+        new_state = None
+        records = []
         try:
-            while True:
-                self._get_block_check(block, timeout)
-                if self._buffer_size():
-                    item = self._get()
-                else:
-                    try:
-                        item = self._get_file()
-                    except Empty:
-                        continue
-                return item
+            self._drop_segments(head_id)
+            while count and len(records) < max_items:
+                if (head_id < tail_id and head_pos >=
+                        os.fstat(self._segment(head_id)).st_size):
+                    os.close(self._segments.pop(head_id))
+                    os.remove(os.path.join(self._path,
+                                           _SEGMENT_NAME % head_id))
+                    head_id += 1
+                    head_pos = 0
+                    continue
+                block, length = self._read_block(head_id, head_pos)
+                take = block[taken:taken + max_items - len(records)]
+                records.extend(take)
+                count -= len(take)
+                taken += len(take)
+                if taken == len(block):
+                    head_pos += length
+                    taken = 0
+            new_state = [head_id, head_pos, taken] + state[3:5] + [
+                count, state[6]]
         finally:
-            self.not_empty.release()
+            self._unlock(new_state)
+        return records
 
-    def _get_block_check(self, block, timeout):
-        if not block:
-            if not self._qsize():
-                raise Empty
-        elif timeout is None:
-            while not self._qsize():
-                self.not_empty.wait()
-        elif timeout < 0:
-            raise ValueError("'timeout' must be a positive number")
-        else:
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wakeup_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """
+        Remove and return a list of up to 'max_items' items, blocking until
+        at least one is available as for get.
+        """
+        if max_items < 1:
+            raise ValueError("'max_items' must be at least 1")
+        endtime = None
+        if block and timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
             endtime = _time() + timeout
-            while not self._qsize():
+        drained = False
+        while True:
+            records = self._take_records(max_items)
+            if records:
+                loads = self._loads
+                return [loads(record) for record in records]
+            if not block:
+                raise Empty
+            if not drained:
+                # clear out old wakeups before looking again, so a put from
+                # now on is sure to wake us
+                self._drain_wakeups()
+                drained = True
+                continue
+            wait = _PROCESS_POLL_INTERVAL
+            if endtime is not None:
                 remaining = endtime - _time()
                 if remaining <= 0.0:
                     raise Empty
-                self.not_empty.wait(remaining)
+                wait = min(wait, remaining)
+            select.select([self._wakeup_fd], [], [], wait)
+            drained = False
 
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return an item from the queue, with 'block' and 'timeout'
+        as for Queue.get.
+        """
+        return self.get_many(1, block, timeout)[0]
 
-class PriorityFileQueue(FileQueue):
-    def __init__(self, maxsize=0, default_priority=1):
-        Queue.__init__(self, 1)
-        self._contains = 0
-        self._max_buffer_size = maxsize
-        self._default_priority = default_priority
-        self._queues = list()
-        self._queue_index = dict()
+    def get_nowait(self):
+        return self.get(False)
 
-    def dispose(self):
-        for priority, q in self._queues:
-            q.dispose()
+    def qsize(self):
+        """
+        Return the number of items in the queue.
+        """
+        state = self._lock()
+        self._unlock()
+        return state[5]
 
-    def _get_queue(self, priority):
-        queue = self._queue_index.get(priority)
-        if not queue:
-            queue = FileQueue(self._max_buffer_size)
-            bisect.insort(self._queues, (priority, queue))
-            self._queue_index[priority] = queue
-        return queue
+    def empty(self):
+        return not self.qsize()
 
-    def put(self, item, block=True, timeout=None, priority=DEFAULT):
-        self.not_full.acquire()
+    def stats(self):
+        """
+        Return a snapshot of the queue's state as a dict: 'qsize',
+        'unfinished_tasks', and 'segments', 'disk_bytes' and
+        'reclaimable_bytes' for the segment files, as for FileQueue.
+        """
+        state = self._lock()
         try:
-            if priority is DEFAULT:
-                priority= self._default_priority
-            self._get_queue(priority).put(item)
-            self._put_done()
+            head_id, head_pos = state[:2]
+            tail_id = state[3]
+            disk_bytes = 0
+            for name in os.listdir(self._path):
+                if name.endswith(_SEGMENT_SUFFIX):
+                    disk_bytes += os.path.getsize(os.path.join(self._path,
+                                                               name))
         finally:
-            self.not_full.release()
+            self._unlock()
+        return dict(qsize=state[5], unfinished_tasks=state[6],
+                    segments=tail_id - head_id + 1 if disk_bytes else 0,
+                    disk_bytes=disk_bytes, reclaimable_bytes=head_pos)
 
-    def get(self, block=True, timeout=None):
-        self.not_empty.acquire()
+    def full(self):
+        """
+        Return False, the queue can't be full.
+        """
+        return False
+
+    def task_done(self):
+        """
+        Indicate that a formerly enqueued task is complete, in any process.
+        """
+        state = self._lock()
+        new_state = None
         try:
-            while True:
-                self._get_block_check(block, timeout)
-                for id, queue in self._queues:
-                    try:
-                        item = queue.get(False)
-                        self._get_done()
-                        return item
-                    except Empty:
-                        pass
+            if state[6] <= 0:
+                raise ValueError("task_done() called too many times")
+            state[6] -= 1
+            new_state = state
         finally:
-            self.not_empty.release()
+            self._unlock(new_state)
 
-
-class LifoFileQueue(FileQueue):
-    """Variant of FileQueue that retrieves most recently added entries first."""
-    def __init__(self, *args, **kwargs):
-        FileQueue.__init__(self, *args, **kwargs)
-        self._position_store_len = 8
-        self._position_format_str = "%%0%ii" % self._position_store_len
-
-    def _format_pos(self, relative_position):
-        return (self._position_format_str % relative_position).encode()
-
-    @contextmanager
-    def _put_file_wrapper(self):
-        start_pos = self._file_write.tell()
-        yield
-        current_pos = self._file_write.tell()
-        item_len = current_pos - start_pos
-        self._file_write.write(self._format_pos(item_len))
-
-    @contextmanager
-    def _get_file_wrapper(self):
-        try:
-            self._file_read.seek(-self._position_store_len, 1)
-        except IOError as err:
-            if err.errno == EINVAL:
-                raise Empty
-            else:
-                raise
-        item_size = int(self._file_read.read(self._position_store_len))
-        self._file_read.seek(-(self._position_store_len + item_size), 1)
-        yield
-        self._file_write.seek(-item_size, 1)
-        self._file_write.truncate()
+    def join(self):
+        """
+        Block until every item put into the queue, by any process, has been
+        got and processed (checked every so often).
+        """
+        while True:
+            state = self._lock()
+            self._unlock()
+            if not state[6]:
+                return
+            _time_sleep(_PROCESS_POLL_INTERVAL)
@@ -0,0 +1,183 @@
+# Tests for the asyncio queues (python 3 only)
+import asyncio
+import threading
+import unittest
+
+import filequeue
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncFileQueueTest(unittest.TestCase):
+
+    def test_fifo(self):
+        async def test():
+            q = filequeue.AsyncFileQueue(batch_size=7, flush_items=5)
+            for i in range(50):
+                await q.put(i)
+            self.assertEqual(q.qsize(), 50)
+            got = [await q.get() for i in range(20)]
+            got.append(q.get_nowait())
+            got += await q.get_many(100)
+            self.assertEqual(got, list(range(50)))
+            self.assertTrue(q.empty())
+            self.assertRaises(asyncio.QueueEmpty, q.get_nowait)
+            q.dispose()
+        run(test())
+
+    def test_lifo(self):
+        async def test():
+            q = filequeue.AsyncLifoFileQueue(batch_size=7, flush_items=5)
+            await q.put_many(range(30))
+            got = [await q.get() for i in range(10)]
+            await q.put(100)
+            got.append(await q.get())
+            got += await q.get_many(100)
+            self.assertEqual(got, list(range(29, 19, -1)) + [100] +
+                             list(range(19, -1, -1)))
+            q.dispose()
+        run(test())
+
+    def test_priority(self):
+        async def test():
+            q = filequeue.AsyncPriorityFileQueue(batch_size=4)
+            for i in range(10):
+                await q.put(i, priority=i % 3)
+            got = [await q.get() for i in range(10)]
+            self.assertEqual(got, [0, 3, 6, 9, 1, 4, 7, 2, 5, 8])
+            q.dispose()
+        run(test())
+
+    def test_waiting_get(self):
+        async def test():
+            q = filequeue.AsyncFileQueue()
+            getters = [asyncio.ensure_future(q.get()) for i in range(3)]
+            await asyncio.sleep(0.01)
+            self.assertFalse(any(getter.done() for getter in getters))
+            for i in range(3):
+                q.put_nowait(i)
+            self.assertEqual(sorted(await asyncio.gather(*getters)),
+                             [0, 1, 2])
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(q.get(), 0.01)
+            q.put_nowait(3)
+            self.assertEqual(await q.get(), 3)
+            q.dispose()
+        run(test())
+
+    def test_join(self):
+        async def test():
+            q = filequeue.AsyncFileQueue(batch_size=10)
+            total = []
+
+            async def worker():
+                while True:
+                    item = await q.get()
+                    total.append(item)
+                    q.task_done()
+
+            workers = [asyncio.ensure_future(worker()) for i in range(3)]
+            for i in range(100):
+                await q.put(i)
+            await asyncio.wait_for(q.join(), 10)
+            self.assertEqual(sorted(total), list(range(100)))
+            for w in workers:
+                w.cancel()
+            self.assertRaises(ValueError, q.task_done)
+            q.dispose()
+        run(test())
+
+    def test_outside_loop(self):
+        # made before any loop runs, then used from one loop after another
+        q = filequeue.AsyncFileQueue(batch_size=2)
+
+        async def test():
+            async def worker():
+                item = await q.get()
+                q.task_done()
+                return item
+
+            getter = asyncio.ensure_future(worker())
+            await asyncio.sleep(0)
+            await q.put(1)
+            await asyncio.wait_for(q.join(), 10)
+            self.assertEqual(await getter, 1)
+        run(test())
+        run(test())
+        q.dispose()
+
+    def test_bad_item(self):
+        async def test():
+            q = filequeue.AsyncFileQueue(
+                batch_size=3, serializer=filequeue.BytesSerializer())
+            await q.put_many([b"a", 1, b"b"])
+            # let the worker thread get to the batch
+            q._executor.submit(lambda: None).result()
+            with self.assertRaises(TypeError):
+                await q.put(b"c")
+            self.assertEqual(q.qsize(), 2)
+            self.assertEqual(await q.get_many(10), [b"a", b"b"])
+            q.dispose()
+        run(test())
+
+    def test_bad_items(self):
+        async def test():
+            q = filequeue.AsyncFileQueue(
+                batch_size=2, serializer=filequeue.BytesSerializer())
+            # two batches fail before anything reports it
+            release = threading.Event()
+            q._executor.submit(release.wait)
+            await q.put_many([b"a", 1, b"b", 2])
+            release.set()
+            q._executor.submit(lambda: None).result()
+            with self.assertRaises(TypeError):
+                await q.put(b"c")
+            self.assertEqual(q.qsize(), 2)
+            self.assertEqual(await q.get_many(10), [b"a", b"b"])
+            self.assertTrue(q.empty())
+            q.task_done()
+            q.task_done()
+            await asyncio.wait_for(q.join(), 1)
+            q.dispose()
+        run(test())
+
+    def test_overflow(self):
+        async def test():
+            q = filequeue.AsyncFileQueue(batch_size=5, flush_items=5)
+            await q.put_many(range(20))
+            q._executor.submit(lambda: None).result()
+            self.assertTrue(q._queue._spill._segments,
+                            "Items weren't written to the overflow")
+            stats = q.stats()
+            self.assertEqual((stats["qsize"], stats["incoming"]), (20, 0))
+            self.assertTrue(stats["disk_bytes"] > 0)
+            self.assertEqual(await q.get_many(20), list(range(20)))
+            q.dispose()
+        run(test())
+
+    def test_disk_quota(self):
+        self.assertRaises(ValueError, filequeue.AsyncFileQueue,
+                          max_disk_bytes=100)
+
+        async def test():
+            q = filequeue.AsyncFileQueue(
+                batch_size=1, max_disk_bytes=50, disk_full="raise",
+                serializer=filequeue.BytesSerializer())
+            await q.put_many([b"x" * 10] * 6)
+            q._executor.submit(lambda: None).result()
+            self.assertTrue(q.full())
+            with self.assertRaises(filequeue.Full):
+                await q.put(b"y" * 10)
+            self.assertEqual(await q.get_many(10), [b"x" * 10] * 5)
+            q.dispose()
+        run(test())
+
+
+if __name__ == "__main__":
+    unittest.main()
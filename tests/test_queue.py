@@ -1,6 +1,12 @@
 # Some simple queue module tests, plus some failure conditions
 # to ensure the FileQueue locks remain stable.
 import filequeue
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+import tempfile
 import time
 import unittest
 from test import test_support
@@ -207,6 +213,1580 @@ class PriorityFileQueueTest(BaseFileQueueTest):
 
 
 
+class SegmentTest(unittest.TestCase):
+
+    def segment_test(self, q, expected_order):
+        spill = q._spill
+        for i in range(100):
+            q.put(i)
+        self.assertTrue(len(spill._segments) > 1,
+                        "Overflow should be segmented")
+        names = [segment.file.name for segment in spill._segments]
+        got = [q.get() for i in range(50)]
+        self.assertEqual(got, expected_order[:50])
+        self.assertTrue(len(spill._segments) < len(names),
+                        "Consumed segments should have been dropped")
+        got += [q.get() for i in range(50)]
+        self.assertEqual(got, expected_order)
+        self.assertTrue(len(spill._segments) <= 1)
+        # the spare is the only segment file kept once dropped
+        kept = [segment.file.name for segment in spill._segments]
+        if spill._spare_segment is not None:
+            kept.append(spill._spare_segment.file.name)
+        for name in names:
+            if name not in kept:
+                self.assertFalse(os.path.exists(name),
+                                 "Segment file wasn't deleted")
+        q.dispose()
+
+    def test_fifo_segments(self):
+        self.segment_test(filequeue.FileQueue(segment_size=64, flush_items=4),
+                          list(range(100)))
+
+    def test_lifo_segments(self):
+        self.segment_test(filequeue.LifoFileQueue(segment_size=64,
+                                                  flush_items=4),
+                          list(reversed(range(100))))
+
+
+class ReadAheadTest(unittest.TestCase):
+
+    def drain_test(self, q):
+        for i in range(5000):
+            q.put(i)
+        self.assertTrue(len(q._spill._segments) > 2)
+        got = []
+        for i in range(2500):
+            got.append(q.get())
+            if i % 10 == 0:
+                q.put(5000 + i // 10)
+        while not q.empty():
+            got.append(q.get())
+        self.assertEqual(got, list(range(5250)))
+        q.dispose()
+
+    def test_read_ahead(self):
+        self.drain_test(filequeue.FileQueue(segment_size=4096, flush_items=7,
+                                            read_ahead=50))
+
+    def test_prefetch(self):
+        self.drain_test(filequeue.FileQueue(segment_size=4096, flush_items=7,
+                                            read_ahead=50, prefetch=True))
+
+    def test_prefetch_threads(self):
+        q = filequeue.FileQueue(segment_size=4096, flush_items=7,
+                                read_ahead=50, prefetch=True)
+        got = []
+        def consumer():
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                got.append(item)
+        threads = [threading.Thread(target=consumer) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(20000):
+            q.put(i)
+        for thread in threads:
+            q.put(None)
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(sorted(got), list(range(20000)))
+        q.dispose()
+
+
+class CompressionTest(unittest.TestCase):
+
+    items = [{"id": i, "name": "item", "tags": ["a", "b", "c"]}
+             for i in range(500)]
+
+    def compression_test(self, q, expected_order):
+        for item in self.items:
+            q.put(item)
+        self.assertEqual([q.get() for item in self.items], expected_order)
+        self.assertTrue(q.compression_ratio() > 2,
+                        "Overflow doesn't seem to be compressed")
+        q.dispose()
+
+    def test_codecs(self):
+        for name in sorted(filequeue.filequeue._CODECS):
+            self.compression_test(
+                filequeue.FileQueue(compression=name, flush_items=50),
+                self.items)
+            self.compression_test(
+                filequeue.LifoFileQueue(compression=name, flush_items=50),
+                list(reversed(self.items)))
+
+    def test_custom_codec(self):
+        import zlib
+        class Codec(object):
+            compress = staticmethod(zlib.compress)
+            decompress = staticmethod(zlib.decompress)
+        self.compression_test(
+            filequeue.FileQueue(compression=Codec(), flush_items=50),
+            self.items)
+
+    def test_priority(self):
+        q = filequeue.PriorityFileQueue(compression="zlib", flush_items=50)
+        for item in self.items:
+            q.put(item, priority=item["id"] % 2)
+        evens = [item for item in self.items if not item["id"] % 2]
+        self.assertEqual([q.get() for item in evens], evens)
+        self.assertTrue(q.compression_ratio() > 2)
+        q.dispose()
+
+    def test_incompressible(self):
+        q = filequeue.FileQueue(compression="zlib", flush_items=1)
+        data = os.urandom(1000)
+        q.put(data)
+        q.put(data)
+        self.assertEqual([q.get(), q.get()], [data, data])
+        self.assertEqual(q.compression_ratio(), 1.0)
+        q.dispose()
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, filequeue.FileQueue,
+                          compression="snappy")
+
+
+class SerializerTest(unittest.TestCase):
+
+    def serializer_test(self, serializer, items, expected=None):
+        for cls in (filequeue.FileQueue, filequeue.LifoFileQueue):
+            q = cls(serializer=serializer, flush_items=3)
+            for item in items:
+                q.put(item)
+            got = [q.get() for item in items]
+            if cls is filequeue.LifoFileQueue:
+                got.reverse()
+            self.assertEqual(got, expected or items)
+            q.dispose()
+
+    def test_marshal(self):
+        self.serializer_test(filequeue.MarshalSerializer(),
+                             [{"id": i, "tags": ["a", "b"]} for i in range(10)])
+
+    def test_bytes(self):
+        self.serializer_test(filequeue.BytesSerializer(),
+                             [b"abc", bytearray(b"def"), memoryview(b"ghi"),
+                              b""],
+                             [b"abc", b"def", b"ghi", b""])
+
+    def test_bytes_written_raw(self):
+        q = filequeue.FileQueue(serializer=filequeue.BytesSerializer())
+        payload = b"payload"
+        q.put(payload)
+        self.assertTrue(q._spill._pending[0] is payload,
+                        "bytes shouldn't be copied or wrapped")
+        q.dispose()
+
+    def test_bytes_rejects_objects(self):
+        q = filequeue.FileQueue(serializer=filequeue.BytesSerializer())
+        self.assertRaises(TypeError, q.put, {"not": "bytes"})
+        self.assertTrue(q.empty())
+        q.dispose()
+
+    def test_priority(self):
+        q = filequeue.PriorityFileQueue(serializer=filequeue.BytesSerializer())
+        q.put(b"low", priority=2)
+        q.put(b"high", priority=1)
+        self.assertEqual([q.get(), q.get()], [b"high", b"low"])
+        q.dispose()
+
+
+class BatchTest(unittest.TestCase, BlockingTestMixin):
+
+    def batch_test(self, q, expected_order):
+        q.put_many(iter(range(100)))
+        q.put_many([])
+        self.assertEqual(q.qsize(), 100)
+        got = q.get_many(30)
+        got += q.get_many(30, block=False)
+        got += q.get_many(1000, timeout=1)
+        self.assertEqual(got, expected_order)
+        self.assertTrue(q.empty())
+        self.assertRaises(filequeue.Empty, q.get_many, 10, False)
+        self.assertRaises(filequeue.Empty, q.get_many, 10, True, 0.01)
+        self.assertEqual(sorted(self.do_blocking_test(q.get_many, (10,),
+                                                      q.put_many, ([1, 2],))),
+                         [1, 2])
+        for i in range(102):
+            q.task_done()
+        q.join()
+        q.dispose()
+
+    def test_fifo(self):
+        self.batch_test(filequeue.FileQueue(flush_items=7), list(range(100)))
+
+    def test_fifo_buffered(self):
+        q = filequeue.FileQueue(10, flush_items=7)
+        q.put_many(range(5))
+        self.assertEqual(q._buffer_size(), 5)
+        q.put_many(range(5, 20))
+        self.assertEqual(q._buffer_size(), 10)
+        self.assertEqual(sorted(q.get_many(100)), list(range(20)))
+        q.dispose()
+
+    def test_lifo(self):
+        self.batch_test(filequeue.LifoFileQueue(flush_items=7),
+                        list(reversed(range(100))))
+
+    def test_priority(self):
+        q = filequeue.PriorityFileQueue()
+        q.put_many(range(10), priority=2)
+        q.put_many(range(10, 20), priority=1)
+        self.assertEqual(q.get_many(15), list(range(10, 20)) + list(range(5)))
+        self.assertEqual(q.get_many(15), list(range(5, 10)))
+        q.dispose()
+
+    def test_bad_item(self):
+        q = filequeue.FileQueue(2, serializer=filequeue.BytesSerializer())
+        self.assertRaises(TypeError, q.put_many, [b"a", b"b", b"c", 4])
+        self.assertTrue(q.empty())
+        q.dispose()
+
+
+class BlockingSerializer(filequeue.PickleSerializer):
+
+    def __init__(self):
+        filequeue.PickleSerializer.__init__(self)
+        self.dumping = threading.Event()
+        self.release = threading.Event()
+
+    def dumps(self, item):
+        if item == "slow":
+            self.dumping.set()
+            self.release.wait(10)
+        return filequeue.PickleSerializer.dumps(self, item)
+
+
+class LockSplitTest(unittest.TestCase):
+
+    def test_get_while_serialising(self):
+        serializer = BlockingSerializer()
+        q = filequeue.FileQueue(2, serializer=serializer)
+        q.put(1)
+        q.put(2)
+        producer = threading.Thread(target=q.put, args=("slow",))
+        producer.start()
+        self.assertTrue(serializer.dumping.wait(10))
+        # the put is in the middle of serialising, a get from the buffer
+        # goes ahead regardless
+        self.assertEqual(q.get(timeout=1), 1)
+        self.assertEqual(q.qsize(), 1)
+        serializer.release.set()
+        producer.join(10)
+        self.assertEqual(q.get_many(10), [2, "slow"])
+        q.dispose()
+
+    def test_put_many_budget(self):
+        serializer = BlockingSerializer()
+        q = filequeue.FileQueue(max_buffer_bytes=4, sizer=len,
+                                serializer=serializer)
+        producer = threading.Thread(target=q.put_many, args=(["ab", "slow"],))
+        producer.start()
+        self.assertTrue(serializer.dumping.wait(10))
+        # this put takes the room the batch had counted on while it was
+        # serialising the rest
+        q.put("xyz")
+        serializer.release.set()
+        producer.join(10)
+        self.assertEqual(q._buffer_bytes, 3)
+        self.assertEqual(q.get_many(10), ["xyz", "ab", "slow"])
+        q.dispose()
+
+    def test_prefetch_new_segment(self):
+        q = filequeue.FileQueue(flush_items=1, read_ahead=1, segment_size=60,
+                                prefetch=True)
+        spill = q._spill
+        for i in range(3):
+            spill.write(("%02i" % i).encode() * 4)
+        self.assertEqual(len(spill._segments), 1)
+        wait_prefetched = spill._wait_prefetched
+        writer = threading.Thread(target=spill.write, args=(b"03" * 4,))
+
+        def racing_wait():
+            # a writer starts a new segment just as a read of the last one
+            # is about to be planned
+            spill._wait_prefetched = wait_prefetched
+            records = wait_prefetched()
+            writer.start()
+            writer.join(0.2)
+            return records
+
+        spill._wait_prefetched = racing_wait
+        got = [spill.read() for i in range(3)]
+        writer.join(10)
+        got.append(spill.read())
+        self.assertEqual(got, [("%02i" % i).encode() * 4 for i in range(4)])
+        self.assertRaises(filequeue.Empty, spill.read)
+        q.dispose()
+
+    def threads_test(self, q, producers=4, consumers=4, count=2000):
+        got = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def produce(start):
+            for i in range(start, start + count, 10):
+                if i % 20:
+                    q.put_many(range(i, i + 10))
+                else:
+                    for j in range(i, i + 10):
+                        q.put(j)
+
+        def consume():
+            while True:
+                try:
+                    items = q.get_many(7, timeout=0.05)
+                except filequeue.Empty:
+                    if done.is_set():
+                        return
+                    continue
+                with lock:
+                    got.extend(items)
+
+        threads = [threading.Thread(target=consume) for i in range(consumers)]
+        for thread in threads:
+            thread.start()
+        producing = [threading.Thread(target=produce, args=(i * count,))
+                     for i in range(producers)]
+        for thread in producing:
+            thread.start()
+        for thread in producing:
+            thread.join(60)
+        done.set()
+        for thread in threads:
+            thread.join(60)
+        self.assertEqual(sorted(got), list(range(producers * count)))
+        q.dispose()
+
+    def test_fifo_threads(self):
+        self.threads_test(filequeue.FileQueue(50, flush_items=13,
+                                              read_ahead=17,
+                                              segment_size=1024))
+
+    def test_prefetch_threads(self):
+        self.threads_test(filequeue.FileQueue(flush_items=13, read_ahead=17,
+                                              segment_size=1024,
+                                              prefetch=True))
+
+    def test_lifo_threads(self):
+        self.threads_test(filequeue.LifoFileQueue(20, flush_items=13,
+                                                  segment_size=1024))
+
+    def test_priority_threads(self):
+        self.threads_test(filequeue.PriorityFileQueue(10, flush_items=13,
+                                                      shared_spill=True))
+
+    def test_durable_threads(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.threads_test(filequeue.FileQueue(
+                path=path, durable=True, flush_items=13, segment_size=1024))
+        finally:
+            shutil.rmtree(path)
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_snapshot(self):
+        q = filequeue.FileQueue(5, flush_items=10, read_ahead=10)
+        for i in range(100):
+            q.put(i)
+        stats = q.stats()
+        self.assertEqual(stats["qsize"], 100)
+        self.assertEqual(stats["buffered_items"], 5)
+        self.assertEqual(stats["spilled_items"], 95)
+        self.assertEqual(stats["buffered_bytes"], None)
+        self.assertEqual(stats["segments"], 1)
+        self.assertTrue(stats["disk_bytes"] > 0)
+        self.assertEqual(stats["reclaimable_bytes"], 0)
+        self.assertTrue(stats["bytes_written"] > 0)
+        self.assertFalse("latency" in stats)
+        q.get_many(40)
+        stats = q.stats()
+        self.assertEqual(stats["qsize"], 60)
+        self.assertTrue(stats["reclaimable_bytes"] > 0)
+        q.dispose()
+
+    def test_metrics(self):
+        events = []
+        q = filequeue.FileQueue(2, metrics_hook=lambda name, seconds:
+                                events.append(name))
+        for i in range(5):
+            q.put(i)
+        q.put_many(range(3))
+        self.assertEqual(len(q.get_many(4)), 4)
+        q.get()
+        stats = q.stats()
+        self.assertEqual(stats["items"], {"put_memory": 2, "put_file": 6,
+                                          "get_memory": 2, "get_file": 3})
+        self.assertEqual(stats["latency"]["put_file"]["count"], 4)
+        self.assertEqual(sum(stats["latency"]["put_file"]["buckets"]
+                             .values()), 4)
+        self.assertTrue(stats["lock_wait"]["count"] >= 8)
+        self.assertTrue("put_file" in events and "lock_wait" in events)
+        # the lock still works as a Condition's
+        self.assertEqual(len(q.get_many(10, True, 0.01)), 3)
+        self.assertRaises(filequeue.Empty, q.get_many, 10, True, 0.01)
+        q.dispose()
+
+    def test_priority(self):
+        q = filequeue.PriorityFileQueue(1, metrics=True)
+        for i in range(6):
+            q.put(i, priority=i % 2)
+        stats = q.stats()
+        self.assertEqual((stats["qsize"], stats["levels"]), (6, 2))
+        self.assertEqual(stats["buffered_items"], 2)
+        self.assertEqual([q.get() for i in range(4)], [0, 2, 4, 1])
+        stats = q.stats()
+        self.assertEqual(stats["levels"], 1)
+        self.assertEqual(stats["items"]["get_memory"] +
+                         stats["items"]["get_file"], 4)
+        self.assertEqual(stats["items"]["put_memory"] +
+                         stats["items"]["put_file"], 6)
+        q.dispose()
+
+
+class BufferBytesTest(unittest.TestCase):
+
+    def test_serialised_size(self):
+        q = filequeue.FileQueue(max_buffer_bytes=100,
+                                serializer=filequeue.BytesSerializer())
+        q.put(b"x" * 60)
+        q.put(b"x" * 60)
+        q.put(b"x" * 40)
+        self.assertEqual(q._buffer_size(), 2)
+        self.assertEqual(q._buffer_bytes, 100)
+        self.assertEqual(q.get(), b"x" * 60)
+        self.assertEqual(q._buffer_bytes, 40)
+        q.put(b"y" * 50)
+        self.assertEqual(q._buffer_size(), 2)
+        self.assertEqual(sorted(q.get_many(10)),
+                         [b"x" * 40, b"x" * 60, b"y" * 50])
+        self.assertEqual(q._buffer_bytes, 0)
+        q.dispose()
+
+    def test_sizer(self):
+        q = filequeue.FileQueue(max_buffer_bytes=10, sizer=len)
+        q.put_many(["abc", "defg", "hijk", "l"])
+        self.assertEqual(q._buffer_size(), 2)
+        q.put("mn")
+        self.assertEqual(q._buffer_size(), 3)
+        self.assertEqual(sorted(q.get_many(10)),
+                         ["abc", "defg", "hijk", "l", "mn"])
+        q.dispose()
+
+    def test_maxsize_still_applies(self):
+        q = filequeue.FileQueue(2, max_buffer_bytes=1000, sizer=len)
+        q.put_many(["a", "b", "c"])
+        q.put("d")
+        self.assertEqual(q._buffer_size(), 2)
+        self.assertEqual(sorted(q.get_many(10)), ["a", "b", "c", "d"])
+        q.dispose()
+
+    def test_priority(self):
+        q = filequeue.PriorityFileQueue(max_buffer_bytes=5, sizer=len)
+        for item in ("aaaa", "bb", "c"):
+            q.put(item, priority=1)
+        q.put("dddddd", priority=0)
+        self.assertEqual(q._levels[1]._buffer_size(), 2)
+        self.assertEqual(q._levels[0]._buffer_size(), 0)
+        self.assertEqual(q.get(), "dddddd")
+        self.assertEqual(sorted(q.get_many(10)), ["aaaa", "bb", "c"])
+        q.dispose()
+
+
+class OrderedTest(unittest.TestCase):
+
+    def test_fifo(self):
+        q = filequeue.FileQueue(10, ordered=True, flush_items=7,
+                                read_ahead=5)
+        expected = []
+        got = []
+        n = 0
+        for round in range(20):
+            for i in range(round % 7 * 5):
+                q.put(n)
+                expected.append(n)
+                n += 1
+            for i in range(round % 5 * 4):
+                if not q.empty():
+                    got.append(q.get())
+        got.extend(q.get_many(n))
+        self.assertEqual(got, expected)
+        self.assertTrue(q.empty())
+        q.dispose()
+
+    def test_refilled_in_bulk(self):
+        q = filequeue.FileQueue(10, ordered=True)
+        q.put_many(range(25))
+        self.assertEqual(q._buffer_size(), 10)
+        self.assertEqual([q.get() for i in range(11)], list(range(11)))
+        self.assertEqual(q._buffer_size(), 9)
+        q.put(25)
+        self.assertEqual(q._buffer_size(), 9)
+        self.assertEqual(q.get_many(100), list(range(11, 26)))
+        q.put(26)
+        self.assertEqual(q._buffer_size(), 1)
+        self.assertEqual(q.get(), 26)
+        q.dispose()
+
+    def test_byte_budget(self):
+        q = filequeue.FileQueue(max_buffer_bytes=10, sizer=len, ordered=True)
+        for item in ("aaaa", "bbbbbbbb", "c", "dd", "eeeee"):
+            q.put(item)
+        self.assertEqual(q._buffer_size(), 1)
+        self.assertEqual([q.get() for i in range(5)],
+                         ["aaaa", "bbbbbbbb", "c", "dd", "eeeee"])
+        self.assertEqual(q._buffer_bytes, 0)
+        q.dispose()
+
+    def test_priority(self):
+        q = filequeue.PriorityFileQueue(2, ordered=True)
+        for i in range(10):
+            q.put(i, priority=i % 2)
+        self.assertEqual([q.get() for i in range(10)],
+                         [0, 2, 4, 6, 8, 1, 3, 5, 7, 9])
+        q.dispose()
+
+    def test_lifo(self):
+        self.assertRaises(ValueError, filequeue.LifoFileQueue, 5,
+                          ordered=True)
+
+
+class DiskQuotaTest(unittest.TestCase, BlockingTestMixin):
+
+    item = b"x" * 10
+
+    def open(self, cls=filequeue.FileQueue, maxsize=0, **kwargs):
+        # 10 byte records, room for 5 in the overflow
+        return cls(maxsize, max_disk_bytes=50, flush_items=3,
+                   serializer=filequeue.BytesSerializer(), **kwargs)
+
+    def test_raise(self):
+        q = self.open(maxsize=2, disk_full="raise")
+        for i in range(7):
+            q.put(self.item)
+        self.assertTrue(q.full())
+        self.assertRaises(filequeue.Full, q.put, self.item)
+        self.assertRaises(filequeue.Full, q.put_many, [self.item] * 2)
+        self.assertEqual(q.qsize(), 7)
+        self.assertEqual(q.stats()["spilled_bytes"], 50)
+        q.get()
+        # room in the buffer again
+        self.assertFalse(q.full())
+        q.put(self.item)
+        self.assertEqual(q.get_many(10), [self.item] * 7)
+        self.assertEqual(q.stats()["spilled_bytes"], 0)
+        q.put_many([self.item] * 7)
+        self.assertEqual(q.qsize(), 7)
+        q.dispose()
+
+    def test_block(self):
+        q = self.open()
+        q.put_many([self.item] * 5)
+        self.assertTrue(q.full())
+        self.assertRaises(filequeue.Full, q.put, self.item, False)
+        self.assertRaises(filequeue.Full, q.put, self.item, True, 0.01)
+        self.do_blocking_test(q.put, (b"y" * 10,), q.get, ())
+        self.do_blocking_test(q.put_many, ([b"z" * 10] * 2, True, 10),
+                              q.get_many, (2,))
+        self.assertEqual(q.get_many(10),
+                         [self.item] * 2 + [b"y" * 10] + [b"z" * 10] * 2)
+        q.dispose()
+
+    def test_full_short_of_limit(self):
+        q = self.open(disk_full="raise")
+        q.put_many([b"x" * 5] + [self.item] * 4)
+        # 5 bytes left, not enough for another item the size of the last
+        self.assertEqual(q.stats()["spilled_bytes"], 45)
+        self.assertTrue(q.full())
+        self.assertRaises(filequeue.Full, q.put, self.item)
+        q.get()
+        self.assertFalse(q.full())
+        q.dispose()
+
+    def test_drop_oldest(self):
+        q = self.open(disk_full="drop_oldest")
+        for i in range(8):
+            q.put(b"%010i" % i)
+        q.put_many([b"%010i" % i for i in range(8, 10)])
+        self.assertEqual(q.get_many(10),
+                         [b"%010i" % i for i in range(5, 10)])
+        self.assertEqual(q.stats()["dropped_items"], 5)
+        for i in range(5):
+            q.task_done()
+        # the dropped items don't hold up a join
+        q.join()
+        q.dispose()
+
+    def test_drop_newest(self):
+        q = self.open(disk_full="drop_newest")
+        q.put_many([b"%010i" % i for i in range(3)])
+        q.put_many([b"%010i" % i for i in range(3, 8)])
+        q.put(self.item)
+        self.assertEqual(q.get_many(10),
+                         [b"%010i" % i for i in range(5)])
+        self.assertEqual(q.stats()["dropped_items"], 4)
+        q.dispose()
+
+    def test_priority(self):
+        q = self.open(filequeue.PriorityFileQueue, disk_full="raise")
+        for i in range(5):
+            q.put(self.item, priority=i)
+        self.assertTrue(q.full())
+        self.assertRaises(filequeue.Full, q.put, self.item, priority=10)
+        self.assertEqual(sorted(q._levels), list(range(5)))
+        self.assertEqual(q.qsize(), 5)
+        q.get()
+        q.put(b"y" * 10, priority=10)
+        self.assertEqual(q.get_many(10), [self.item] * 4 + [b"y" * 10])
+        q.dispose()
+
+        q = self.open(filequeue.PriorityFileQueue)
+        q.put_many([self.item] * 5, priority=2)
+        self.assertRaises(filequeue.Full, q.put, self.item, False, priority=1)
+        self.do_blocking_test(q.put, (b"y" * 10, True, 10, 1), q.get, ())
+        self.assertEqual(q.get(), b"y" * 10)
+        q.dispose()
+
+        q = self.open(filequeue.PriorityFileQueue, disk_full="drop_newest")
+        q.put_many([self.item] * 4, priority=2)
+        q.put_many([b"y" * 10] * 2, priority=1)
+        q.put(b"z" * 10, priority=0)
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual(sorted(q._levels), [1, 2])
+        self.assertEqual(q.stats()["dropped_items"], 2)
+        q.dispose()
+
+    def test_no_quota(self):
+        q = filequeue.FileQueue()
+        q.put_many(range(100))
+        self.assertFalse(q.full())
+        stats = q.stats()
+        self.assertEqual((stats["spilled_bytes"], stats["dropped_items"]),
+                         (None, 0))
+        q.dispose()
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, filequeue.FileQueue, disk_full="wait")
+        self.assertRaises(ValueError, filequeue.LifoFileQueue,
+                          disk_full="drop_oldest")
+        self.assertRaises(ValueError, filequeue.PriorityFileQueue,
+                          disk_full="drop_oldest")
+
+
+class DelayFileQueueTest(unittest.TestCase, BlockingTestMixin):
+
+    def test_order(self):
+        q = filequeue.DelayFileQueue(bucket_seconds=0.05)
+        start = time.time()
+        q.put("c", delay=0.3)
+        q.put("a")
+        q.put("b", not_before=start + 0.15)
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual(q.get(False), "a")
+        self.assertRaises(filequeue.Empty, q.get, False)
+        self.assertRaises(filequeue.Empty, q.get, True, 0.01)
+        self.assertEqual(q.get(timeout=10), "b")
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(q.get_many(10, timeout=10), ["c"])
+        self.assertTrue(time.time() - start >= 0.3)
+        self.assertTrue(q.empty())
+        q.dispose()
+
+    def test_buckets(self):
+        q = filequeue.DelayFileQueue(bucket_seconds=0.1, flush_items=10)
+        due = time.time() + 0.2
+        for i in range(50):
+            q.put(i, not_before=due)
+        q.put_many(range(50, 100), delay=3600)
+        stats = q.stats()
+        self.assertEqual(stats["qsize"], 100)
+        self.assertEqual(stats["spilled_items"], 100)
+        self.assertTrue(stats["levels"] >= 2)
+        self.assertTrue(stats["disk_bytes"] > 0)
+        self.assertEqual(q.get_many(100, timeout=10), list(range(50)))
+        self.assertTrue(time.time() >= due)
+        self.assertEqual(q.qsize(), 50)
+        self.assertRaises(filequeue.Empty, q.get, False)
+        q.dispose()
+
+    def test_wakeup(self):
+        q = filequeue.DelayFileQueue(bucket_seconds=0.01)
+        q.put("later", delay=3600)
+        self.assertEqual(self.do_blocking_test(q.get, (True, 10), q.put,
+                                               ("sooner",)), "sooner")
+        self.assertEqual(self.do_blocking_test(q.get, (True, 10), q.put,
+                                               ("soon", True, None, 0.05)),
+                         "soon")
+        q.dispose()
+
+    def test_serializer(self):
+        q = filequeue.DelayFileQueue(
+            bucket_seconds=0.05, serializer=filequeue.BytesSerializer(),
+            max_buffer_bytes=5, sizer=len)
+        q.put_many([b"abc", b"defgh"], delay=0.1)
+        self.assertEqual(q.get_many(10, timeout=10), [b"abc", b"defgh"])
+        q.dispose()
+
+    def test_join(self):
+        q = filequeue.DelayFileQueue(bucket_seconds=0.05)
+        q.put_many(range(10), delay=0.1)
+        for item in q.get_many(10, timeout=10):
+            q.task_done()
+        q.join()
+        self.assertRaises(ValueError, q.task_done)
+        self.assertRaises(ValueError, filequeue.DelayFileQueue,
+                          bucket_seconds=0)
+        q.dispose()
+
+
+class SpillPlacementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_spill_dir(self):
+        q = filequeue.FileQueue(5, spill_dir=self.path, flush_items=10)
+        q.put_many(range(5))
+        self.assertEqual(os.listdir(self.path), [],
+                         "A file was created before anything overflowed")
+        q.put_many(range(5, 100))
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        self.assertEqual(q.get_many(100), list(range(100)))
+        q.dispose()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_priority_spill_dir(self):
+        for shared_spill in (False, True):
+            q = filequeue.PriorityFileQueue(5, spill_dir=self.path,
+                                            shared_spill=shared_spill)
+            for priority in range(10):
+                q.put(priority, priority=priority)
+            self.assertEqual(os.listdir(self.path), [])
+            q.put_many(range(100), priority=3)
+            q._levels[3]._spill.flush()
+            if shared_spill:
+                q._shared_spill.flush()
+            self.assertEqual(len(os.listdir(self.path)), 1)
+            self.assertEqual(len(q.get_many(200)), 110)
+            q.dispose()
+
+    def test_preallocate(self):
+        for cls in (filequeue.FileQueue, filequeue.LifoFileQueue):
+            q = cls(spill_dir=self.path, preallocate=True,
+                    segment_size=64 * 1024, flush_items=10)
+            q.put_many(range(100))
+            spill = q._spill
+            spill.flush()
+            if filequeue.filequeue._posix_fallocate is not None:
+                size = os.path.getsize(spill._segments[0].file.name)
+                self.assertTrue(size >= 64 * 1024)
+            self.assertEqual(sorted(q.get_many(100)), list(range(100)))
+            q.dispose()
+
+    def test_preallocate_mmap(self):
+        # the mapping covers the whole preallocated segment from the start
+        q = filequeue.FileQueue(spill_dir=self.path, preallocate=True,
+                                use_mmap=True, segment_size=64 * 1024,
+                                flush_items=10)
+        got = []
+        for i in range(0, 30, 10):
+            q.put_many(range(i, i + 10))
+            q._spill.flush()
+            got += q.get_many(100)
+        self.assertEqual(got, list(range(30)))
+        q.dispose()
+
+    def test_fadvise(self):
+        if not hasattr(os, "POSIX_FADV_DONTNEED"):
+            return
+        calls = []
+        fadvise = filequeue.filequeue._posix_fadvise
+        filequeue.filequeue._posix_fadvise = (
+            lambda fd, offset, length, advice: calls.append(advice))
+        try:
+            for cls in (filequeue.FileQueue, filequeue.LifoFileQueue,
+                        filequeue.PriorityFileQueue):
+                q = cls(fadvise=True, flush_items=10, read_ahead=10)
+                q.put_many(range(100))
+                self.assertEqual(sorted(q.get_many(100)), list(range(100)))
+                q.dispose()
+        finally:
+            filequeue.filequeue._posix_fadvise = fadvise
+        self.assertTrue(os.POSIX_FADV_SEQUENTIAL in calls)
+        self.assertTrue(os.POSIX_FADV_DONTNEED in calls)
+
+    def test_durable(self):
+        self.assertRaises(ValueError, filequeue.FileQueue, path=self.path,
+                          durable=True, spill_dir=self.path)
+        self.assertRaises(ValueError, filequeue.FileQueue, path=self.path,
+                          durable=True, preallocate=True)
+
+
+class ShardedFileQueueTest(unittest.TestCase, BlockingTestMixin):
+
+    def test_put_get(self):
+        q = filequeue.ShardedFileQueue(2, shards=3, flush_items=5)
+        for i in range(20):
+            q.put(i)
+        q.put_many(range(20, 100))
+        self.assertEqual(q.qsize(), 100)
+        self.assertEqual([len(shard.queue) for shard in q._shards],
+                         [2, 2, 2])
+        stats = q.stats()
+        self.assertEqual((stats["shards"], stats["qsize"],
+                          stats["buffered_items"], stats["spilled_items"]),
+                         (3, 100, 6, 94))
+        got = [q.get() for i in range(10)]
+        got += q.get_many(200)
+        self.assertEqual(sorted(got), list(range(100)))
+        self.assertTrue(q.empty())
+        self.assertRaises(filequeue.Empty, q.get, False)
+        self.assertRaises(filequeue.Empty, q.get, True, 0.01)
+        self.assertRaises(filequeue.Empty, q.get_many, 10, False)
+        self.assertEqual(self.do_blocking_test(q.get, (True, 10), q.put,
+                                               ("empty",)), "empty")
+        q.dispose()
+
+    def test_steal(self):
+        q = filequeue.ShardedFileQueue(shards=4)
+        # every item in a shard that isn't this thread's home
+        home = q._home()
+        q._shards[(home + 2) % 4].put_many(range(10))
+        q._count.added(10)
+        self.assertEqual(q.get_many(10), list(range(10)))
+        q.dispose()
+
+    def test_threads(self):
+        q = filequeue.ShardedFileQueue(10, shards=4, flush_items=20)
+        results = []
+        lock = threading.Lock()
+
+        def produce(start):
+            for i in range(start, start + 500):
+                q.put(i)
+
+        def consume():
+            while True:
+                item = q.get(timeout=10)
+                if item is None:
+                    q.task_done()
+                    return
+                with lock:
+                    results.append(item)
+                q.task_done()
+
+        consumers = [threading.Thread(target=consume) for i in range(8)]
+        producers = [threading.Thread(target=produce, args=(i * 500,))
+                     for i in range(8)]
+        for thread in consumers + producers:
+            thread.start()
+        for thread in producers:
+            thread.join()
+        q.join()
+        self.assertEqual(sorted(results), list(range(4000)))
+        q.put_many([None] * 8)
+        for thread in consumers:
+            thread.join()
+        self.assertRaises(ValueError, q.task_done)
+        q.dispose()
+
+    def test_lost_items(self):
+        q = filequeue.ShardedFileQueue(shards=2)
+        q.put_many(range(3))
+        # counted, but not in any shard
+        q._count.added(2)
+        self.assertEqual(sorted(q.get_many(10)), [0, 1, 2])
+        self.assertRaises(filequeue.Empty, q.get, True, 0.5)
+        q.dispose()
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, filequeue.ShardedFileQueue, shards=0)
+        for policy in ("drop_oldest", "drop_newest"):
+            self.assertRaises(ValueError, filequeue.ShardedFileQueue,
+                              max_disk_bytes=50, disk_full=policy)
+        self.assertRaises(ValueError, filequeue.ShardedFileQueue,
+                          path=tempfile.gettempdir(), durable=True)
+
+
+class UniqueTest(unittest.TestCase):
+
+    def test_unique(self):
+        q = filequeue.FileQueue(3, unique=True, flush_items=4)
+        for i in range(10):
+            q.put(i)
+            q.put(i)
+        q.put_many([1, 10, 10, 11, 2])
+        self.assertEqual(q.qsize(), 12)
+        self.assertEqual(q.stats()["duplicate_items"], 13)
+        self.assertEqual([q.get() for i in range(5)], list(range(5)))
+        # gone from the queue, so they can be put again
+        q.put_many([0, 4, 5])
+        self.assertEqual(sorted(q.get_many(100)), [0] + list(range(4, 12)))
+        self.assertTrue(q.empty())
+        q.put(1)
+        self.assertEqual(q.get(), 1)
+        q.dispose()
+
+    def test_key(self):
+        q = filequeue.LifoFileQueue(key=lambda item: item["id"],
+                                    flush_items=2)
+        q.put({"id": "a", "n": 1})
+        q.put({"id": u"b", "n": 2})
+        q.put({"id": "a", "n": 3})
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.get(), {"id": "b", "n": 2})
+        q.put({"id": "b", "n": 4})
+        self.assertEqual(q.get_many(10), [{"id": "b", "n": 4},
+                                          {"id": "a", "n": 1}])
+        self.assertRaises(TypeError, q.put, {"id": 1})
+        self.assertTrue(q.empty())
+        q.dispose()
+
+    def test_many_keys(self):
+        # more keys than the Bloom filter is sized for
+        q = filequeue.FileQueue(unique=True, unique_capacity=100,
+                                serializer=filequeue.BytesSerializer())
+        items = [str(i).encode() for i in range(1000)]
+        q.put_many(items)
+        q.put_many(items)
+        self.assertEqual(q.qsize(), 1000)
+        self.assertEqual(q.get_many(1000), items)
+        q.dispose()
+
+    def test_on_disk(self):
+        q = filequeue.FileQueue(unique=True, unique_capacity=1000,
+                                serializer=filequeue.BytesSerializer())
+        for i in range(0, 100000, 1000):
+            q.put_many([("%090i" % j).encode() for j in range(i, i + 1000)])
+        self.assertEqual(q.qsize(), 100000)
+        # the keys are in the sqlite table on disk, not in memory
+        index = q._keys
+        index._db.commit()
+        self.assertEqual(
+            index._db.execute("SELECT COUNT(*) FROM keys").fetchone()[0],
+            100000)
+        size = os.path.getsize(os.path.join(index._path, "keys"))
+        self.assertTrue(size > 100000 * 90, "index is %i bytes" % size)
+        q.dispose()
+
+    def test_buffered_keys(self):
+        for kwargs in ({}, {"max_buffer_bytes": 2, "sizer": lambda item: 1}):
+            serializer = CountingSerializer()
+            q = filequeue.FileQueue(2, unique=True, ordered=True,
+                                    serializer=serializer, **kwargs)
+            q.put(1)
+            q.put_many([2, 3, 4])
+            self.assertEqual(serializer.dumped, 4)
+            # the keys worked out by the puts are kept, not serialised again
+            self.assertEqual([q.get(), q.get()], [1, 2])
+            self.assertEqual(q.get_many(10), [3, 4])
+            self.assertEqual(serializer.dumped, 4)
+            q.put_many([1, 2, 3, 4])
+            self.assertEqual(q.get_many(10), [1, 2, 3, 4])
+            self.assertTrue(q.empty())
+            q.dispose()
+
+    def test_dropped(self):
+        q = filequeue.FileQueue(unique=True, max_disk_bytes=20,
+                                disk_full="drop_oldest", flush_items=1,
+                                serializer=filequeue.BytesSerializer())
+        q.put_many([b"a" * 10, b"b" * 10])
+        q.put(b"c" * 10)
+        # "a" was dropped, so it isn't a duplicate any more
+        q.put(b"a" * 10)
+        self.assertEqual(q.get_many(10), [b"c" * 10, b"a" * 10])
+        q.dispose()
+
+    def test_failed_put(self):
+        q = filequeue.FileQueue(unique=True, max_disk_bytes=10,
+                                disk_full="raise",
+                                serializer=filequeue.BytesSerializer())
+        q.put(b"a" * 10)
+        self.assertRaises(filequeue.Full, q.put, b"b" * 10)
+        self.assertRaises(filequeue.Full, q.put_many, [b"b" * 10])
+        q.get()
+        q.put(b"b" * 10)
+        self.assertEqual(q.stats()["duplicate_items"], 0)
+        q.dispose()
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, filequeue.FileQueue, unique=True,
+                          path=tempfile.gettempdir(), durable=True)
+        for cls in (filequeue.PriorityFileQueue, filequeue.DelayFileQueue,
+                    filequeue.ShardedFileQueue):
+            self.assertRaises(ValueError, cls, unique=True)
+            self.assertRaises(ValueError, cls, key=len)
+
+
+class CountingSerializer(filequeue.PickleSerializer):
+
+    loaded = 0
+    dumped = 0
+
+    def dumps(self, item):
+        self.dumped += 1
+        return filequeue.PickleSerializer.dumps(self, item)
+
+    def loads(self, data):
+        self.loaded += 1
+        return filequeue.PickleSerializer.loads(self, data)
+
+
+class ExpiringTest(unittest.TestCase):
+
+    def test_ttl(self):
+        q = filequeue.FileQueue(2, expiring=True, flush_items=3)
+        q.put_many(range(5), ttl=0.05)
+        q.put_many(range(5, 10))
+        q.put(10, ttl=60)
+        time.sleep(0.1)
+        self.assertEqual(q.qsize(), 11)
+        self.assertEqual(q.get(), 5)
+        self.assertEqual(q.get_many(100), list(range(6, 11)))
+        self.assertEqual(q.stats()["expired_items"], 5)
+        self.assertTrue(q.empty())
+        self.assertRaises(filequeue.Empty, q.get, True, 0.01)
+        for i in range(6):
+            q.task_done()
+        # expired items count as done
+        q.join()
+        q.dispose()
+
+    def test_default_ttl(self):
+        q = filequeue.LifoFileQueue(ttl=0.05, flush_items=2)
+        q.put_many(["a", "b", "c"])
+        q.put("d", ttl=60)
+        time.sleep(0.1)
+        self.assertEqual(q.get_many(10), ["d"])
+        self.assertEqual(q.stats()["expired_items"], 3)
+        q.dispose()
+
+    def test_skip_segments(self):
+        serializer = CountingSerializer()
+        q = filequeue.FileQueue(expiring=True, serializer=serializer,
+                                flush_items=10, segment_size=100)
+        read = []
+        loads = q._loads
+        q._loads = lambda record: read.append(record) or loads(record)
+        for i in range(200):
+            q.put(i, ttl=0.05)
+        q.put_many(range(200, 205))
+        q.put_many(range(205, 210), ttl=0.05)
+        self.assertTrue(len(q._spill._segments) > 2)
+        time.sleep(0.1)
+        self.assertEqual(q.get(), 200)
+        self.assertEqual(q.get_many(100), list(range(201, 205)))
+        self.assertEqual(q.stats()["expired_items"], 205)
+        self.assertTrue(q.empty())
+        # only the items still live were loaded, and the segments holding
+        # nothing else weren't read
+        self.assertEqual(serializer.loaded, 5)
+        self.assertTrue(len(read) < 50)
+        q.dispose()
+
+    def test_ordered(self):
+        q = filequeue.FileQueue(3, ordered=True, ttl=0.05, flush_items=2)
+        q.put_many(range(3))
+        q.put_many(range(3, 8), ttl=60)
+        q.put_many(range(8, 10))
+        time.sleep(0.1)
+        self.assertEqual([q.get() for i in range(5)], list(range(3, 8)))
+        self.assertRaises(filequeue.Empty, q.get, False)
+        q.dispose()
+
+    def test_bad_arguments(self):
+        q = filequeue.FileQueue()
+        self.assertRaises(ValueError, q.put, 1, ttl=10)
+        self.assertRaises(ValueError, q.put_many, [1], ttl=10)
+        q.dispose()
+        self.assertRaises(ValueError, filequeue.FileQueue, unique=True,
+                          ttl=10)
+        for cls in (filequeue.PriorityFileQueue, filequeue.DelayFileQueue,
+                    filequeue.ShardedFileQueue):
+            self.assertRaises(ValueError, cls, expiring=True)
+            self.assertRaises(ValueError, cls, ttl=10)
+
+
+class PriorityLevelTest(unittest.TestCase):
+
+    def test_many_priorities(self):
+        q = filequeue.PriorityFileQueue(flush_items=3)
+        priorities = [(i * 7919) % 1000 for i in range(3000)]
+        for i, priority in enumerate(priorities):
+            q.put((priority, i), priority=priority)
+        self.assertEqual(len(q._levels), 1000)
+        got = [q.get() for i in range(1500)]
+        self.assertEqual(len(q._levels), 500,
+                         "Drained priorities should have been dropped")
+        got += q.get_many(2000)
+        self.assertEqual(got, sorted(got), "Items out of priority order")
+        self.assertEqual(len(got), 3000)
+        self.assertFalse(q._levels or q._heap)
+        q.dispose()
+
+    def test_shared_spill(self):
+        q = filequeue.PriorityFileQueue(shared_spill=True, flush_items=50,
+                                        segment_size=4096, read_ahead=7)
+        shared = q._shared_spill
+        for i in range(3000):
+            q.put(i, priority=i % 300)
+        self.assertEqual(len(q._levels), 300)
+        segments = len(shared._segments)
+        self.assertTrue(1 < segments < 300,
+                        "Levels should write to the same segments")
+        got = [q.get() for i in range(1500)]
+        for i in range(3000, 3100):
+            q.put(i, priority=i % 300)
+        got += q.get_many(2000)
+        order = lambda i: (i % 300, i)
+        expected = sorted(range(3000), key=order)
+        expected[1500:] = sorted(expected[1500:] + list(range(3000, 3100)),
+                                 key=order)
+        self.assertEqual(got, expected)
+        self.assertTrue(q.empty())
+        self.assertFalse(shared._dirty)
+        self.assertTrue(len(shared._segments) <= 1)
+        q.dispose()
+
+    def test_shared_spill_compressed(self):
+        q = filequeue.PriorityFileQueue(shared_spill=True, flush_items=50,
+                                        compression="zlib")
+        for i in range(1000):
+            q.put("item %i" % (i // 2), priority=i % 3)
+        expected = ["item %i" % (i // 2)
+                    for i in sorted(range(1000), key=lambda i: (i % 3, i))]
+        self.assertEqual([q.get() for i in range(1000)], expected)
+        self.assertTrue(q.compression_ratio() > 1)
+        q.dispose()
+
+    def test_drained_level_dropped(self):
+        q = filequeue.PriorityFileQueue()
+        for i in range(5):
+            q.put(i, priority=1)
+            self.assertEqual(q.get(), i)
+            self.assertFalse(q._levels)
+        q.dispose()
+
+
+class DurableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs):
+        return filequeue.FileQueue(path=self.path, durable=True,
+                                   segment_size=512, flush_items=10,
+                                   read_ahead=7, **kwargs)
+
+    def crash(self, q):
+        # drop the queue without letting it write anything more
+        spill = q._spill
+        spill._closed = True
+        for segment in spill._segments:
+            segment.file.close()
+        spill._lock_file.close()
+
+    def test_reopen(self):
+        q = self.open()
+        q.put_many(range(100))
+        self.assertEqual([q.get() for i in range(25)], list(range(25)))
+        q.dispose()
+        q = self.open()
+        self.assertEqual(q.qsize(), 75)
+        self.assertEqual(q.get_many(30), list(range(25, 55)))
+        q.put(100)
+        q.dispose()
+        q = self.open()
+        self.assertEqual(q.get_many(100), list(range(55, 101)))
+        self.assertTrue(q.empty())
+        q.dispose()
+        segments = [name for name in os.listdir(self.path)
+                    if name.endswith(".seg")]
+        self.assertTrue(len(segments) <= 1, "Read segments weren't deleted")
+
+    def test_reopen_unwritten(self):
+        # gets that catch up with items not yet written out
+        q = self.open()
+        q.put_many(range(5))
+        self.assertEqual(q.get(), 0)
+        q.put(5)
+        self.assertEqual(q.get_many(2), [1, 2])
+        q.dispose()
+        q = self.open()
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual(q.get_many(10), [3, 4, 5])
+        q.dispose()
+
+    def test_crash_fsync_every_item(self):
+        q = self.open(fsync_items=1)
+        for i in range(50):
+            q.put(i)
+        self.assertEqual([q.get() for i in range(20)], list(range(20)))
+        self.crash(q)
+        q = self.open(fsync_items=1)
+        self.assertEqual(q.qsize(), 30)
+        self.assertEqual(q.get_many(100), list(range(20, 50)))
+        q.dispose()
+
+    def test_torn_write(self):
+        q = self.open(fsync_items=1)
+        q.put_many(range(5))
+        name = q._spill._segments[-1].name
+        self.crash(q)
+        with open(name, "ab") as segment_file:
+            segment_file.write(b"\x05\x00\x00\x00\x10")
+        q = self.open()
+        self.assertEqual(q.get_many(10), list(range(5)))
+        q.put(5)
+        self.assertEqual(q.get(), 5)
+        q.dispose()
+
+    def test_index(self):
+        q = self.open()
+        for i in range(300):
+            q.put(i)
+        self.assertEqual(q.get_many(25), list(range(25)))
+        segments = list(q._spill._segments)
+        self.assertTrue(len(segments) > 3)
+        q.dispose()
+        indexes = sorted(name for name in os.listdir(self.path)
+                         if name.endswith(".idx"))
+        self.assertEqual(len(indexes), len(segments) - 1)
+        scanned = []
+        scan = filequeue.filequeue._DurableSpill._scan
+        filequeue.filequeue._DurableSpill._scan = (
+            lambda spill, segment, last: scanned.append(segment.segment_id) or
+            scan(spill, segment, last))
+        try:
+            q = self.open()
+        finally:
+            filequeue.filequeue._DurableSpill._scan = scan
+        # only the segment that was still being written to
+        self.assertEqual(scanned, [segments[-1].segment_id])
+        self.assertEqual(q.qsize(), 275)
+        reopened = list(q._spill._segments)
+        self.assertEqual([s.first_seq for s in reopened],
+                         [s.first_seq for s in segments])
+        self.assertEqual(reopened[0].first_seq, 0)
+        self.assertTrue(all(s._file is None for s in reopened[2:-1]),
+                        "Indexed segments were opened")
+        self.assertEqual(q.get_many(300), list(range(25, 300)))
+        q.put(300)
+        q.sync()
+        self.assertEqual(q._spill._next_seq, 301)
+        q.dispose()
+
+    def test_bad_index(self):
+        q = self.open()
+        for i in range(300):
+            q.put(i)
+        q.dispose()
+        indexes = sorted(name for name in os.listdir(self.path)
+                         if name.endswith(".idx"))
+        with open(os.path.join(self.path, indexes[0]), "r+b") as index_file:
+            index_file.seek(-3, 2)
+            index_file.write(b"\xff\xff\xff")
+        os.remove(os.path.join(self.path, indexes[1]))
+        q = self.open()
+        self.assertEqual(q.qsize(), 300)
+        self.assertEqual(q.get_many(300), list(range(300)))
+        q.dispose()
+
+    def test_old_cursor(self):
+        q = self.open()
+        q.put_many(range(100))
+        self.assertEqual(q.get_many(15), list(range(15)))
+        q.dispose()
+        cursor_name = os.path.join(self.path, "cursor")
+        with open(cursor_name) as cursor_file:
+            cursor = cursor_file.read().split()
+        with open(cursor_name, "w") as cursor_file:
+            cursor_file.write(" ".join(cursor[:3]))
+        q = self.open()
+        self.assertEqual(q.get_many(100), list(range(15, 100)))
+        q.dispose()
+
+    def test_already_open(self):
+        q = self.open()
+        if filequeue.filequeue.fcntl is not None:
+            self.assertRaises(IOError, self.open)
+        q.dispose()
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, filequeue.FileQueue, durable=True)
+        self.assertRaises(ValueError, filequeue.FileQueue, 5, path=self.path,
+                          durable=True)
+        self.assertRaises(ValueError, filequeue.LifoFileQueue,
+                          path=self.path, durable=True)
+        self.assertRaises(ValueError, filequeue.FileQueue, path=self.path)
+
+
+def process_worker(q, results):
+    while True:
+        item = q.get(timeout=10)
+        q.task_done()
+        if item is None:
+            return
+        results.put(item * 2)
+
+
+class ProcessFileQueueTest(unittest.TestCase, BlockingTestMixin):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self, name="q", **kwargs):
+        return filequeue.ProcessFileQueue(os.path.join(self.path, name),
+                                          segment_size=256, **kwargs)
+
+    def test_simple(self):
+        q = self.open()
+        for i in range(50):
+            q.put(i)
+        q.put_many(range(50, 100))
+        other = self.open()
+        self.assertEqual(other.qsize(), 100)
+        self.assertEqual([q.get() for i in range(10)], list(range(10)))
+        self.assertEqual(other.get_many(20), list(range(10, 30)))
+        self.assertEqual(q.get(), 30)
+        self.assertEqual(other.get_many(100), list(range(31, 100)))
+        self.assertTrue(q.empty())
+        self.assertRaises(filequeue.Empty, q.get, False)
+        self.assertRaises(filequeue.Empty, q.get, True, 0.01)
+        segments = [name for name in os.listdir(os.path.join(self.path, "q"))
+                    if name.endswith(".seg")]
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(q.stats()["qsize"], 0)
+        self.assertEqual(q.stats()["unfinished_tasks"], 100)
+        for i in range(100):
+            other.task_done()
+        q.join()
+        self.assertRaises(ValueError, q.task_done)
+        q.dispose()
+        other.dispose()
+
+    def test_compressed(self):
+        q = self.open(compression="zlib")
+        q.put_many(["x" * 1000] * 10)
+        self.assertEqual(q.get_many(10), ["x" * 1000] * 10)
+        q.dispose()
+
+    def test_blocking_get(self):
+        q = self.open()
+        other = self.open()
+        self.assertEqual(self.do_blocking_test(q.get, (), other.put, (1,)), 1)
+        self.assertEqual(self.do_blocking_test(q.get_many, (5, True, 10),
+                                               other.put_many, ([2, 3],)),
+                         [2, 3])
+        q.dispose()
+        other.dispose()
+
+    def test_pickle(self):
+        q = self.open()
+        q.put(1)
+        copy = pickle.loads(pickle.dumps(q))
+        self.assertEqual(copy.get(), 1)
+        q.dispose()
+        copy.dispose()
+
+    def test_processes(self):
+        q = self.open()
+        results = self.open("results")
+        workers = [multiprocessing.Process(target=process_worker,
+                                           args=(q, results))
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for i in range(300):
+            q.put(i)
+        q.join()
+        for worker in workers:
+            q.put(None)
+        for worker in workers:
+            worker.join(10)
+        self.assertEqual(sorted(results.get_many(1000)),
+                         list(range(0, 600, 2)))
+        q.dispose()
+        results.dispose()
+
+
+class MmapTest(unittest.TestCase):
+
+    def test_bytes_views(self):
+        q = filequeue.FileQueue(serializer=filequeue.BytesSerializer(),
+                                use_mmap=True, flush_items=2,
+                                segment_size=4096)
+        payloads = [os.urandom(1500) for i in range(20)]
+        q.put_many(payloads)
+        got = [q.get() for i in range(20)]
+        self.assertEqual([bytes(item) for item in got], payloads)
+        # read back from disk, so zero-copy views of the mapped segments
+        # that stay readable after their segments are dropped (python 2
+        # mmaps don't export buffers, so there they're copies)
+        if sys.version_info[0] >= 3:
+            self.assertTrue(isinstance(got[0], memoryview))
+        self.assertTrue(len(q._spill._segments) <= 1)
+        self.assertEqual(bytes(got[0]), payloads[0])
+        q.dispose()
+        self.assertEqual(bytes(got[-2]), payloads[-2])
+
+    def test_regrow(self):
+        # drained, then grown past the end of the segment that was read
+        q = filequeue.FileQueue(use_mmap=True, segment_size=100,
+                                flush_items=2)
+        q.put_many(range(10))
+        self.assertEqual(q.get_many(100), list(range(10)))
+        q.put_many(range(10, 20))
+        self.assertEqual([q.get(timeout=2) for i in range(5)],
+                         list(range(10, 15)))
+        q.put_many(range(20, 40))
+        self.assertEqual(q.get_many(100), list(range(15, 40)))
+        q.dispose()
+
+    def test_lost_items(self):
+        q = filequeue.FileQueue(flush_items=2)
+        q.put_many(range(4))
+        # counted, but not in the overflow
+        q._contains += 2
+        self.assertEqual(q.get_many(4), list(range(4)))
+        self.assertRaises(RuntimeError, q.get, True, 1)
+        self.assertRaises(RuntimeError, q.get_many, 10, True, 1)
+        q.dispose()
+
+    def test_pickled(self):
+        for kwargs in ({}, {"prefetch": True}, {"compression": "zlib"}):
+            q = filequeue.FileQueue(use_mmap=True, flush_items=10,
+                                    segment_size=1024, read_ahead=15,
+                                    **kwargs)
+            for i in range(1000):
+                q.put(i)
+                if i % 3 == 0:
+                    self.assertEqual(q.get(), i // 3)
+            self.assertEqual(q.get_many(1000), list(range(334, 1000)))
+            q.dispose()
+
+    def test_durable(self):
+        path = tempfile.mkdtemp()
+        try:
+            q = filequeue.FileQueue(path=path, durable=True, use_mmap=True,
+                                    flush_items=10, segment_size=512)
+            q.put_many(range(100))
+            self.assertEqual(q.get_many(50), list(range(50)))
+            q.dispose()
+            q = filequeue.FileQueue(path=path, durable=True, use_mmap=True)
+            self.assertEqual(q.get_many(100), list(range(50, 100)))
+            q.dispose()
+        finally:
+            shutil.rmtree(path)
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def test_reader_catches_up_in_memory(self):
+        q = filequeue.FileQueue()
+        for i in range(10):
+            q.put(i)
+        self.assertEqual([q.get() for i in range(10)], list(range(10)))
+        self.assertFalse(q._spill._segments,
+                         "Nothing should have been written to disk")
+        q.dispose()
+
+    def block_test(self, q, expected_order):
+        for i in range(95):
+            q.put(i)
+        q.put(95)
+        q.put(96, block=0)
+        for i in range(97, 100):
+            q.put(i)
+        segment = q._spill._segments[0]
+        self.assertTrue(segment.write_pos > 0, "Blocks weren't written")
+        self.assertEqual([q.get() for i in range(100)], expected_order)
+        self.assertTrue(q.empty())
+        q.dispose()
+
+    def test_fifo_blocks(self):
+        self.block_test(filequeue.FileQueue(flush_items=10), list(range(100)))
+
+    def test_lifo_blocks(self):
+        self.block_test(filequeue.LifoFileQueue(flush_items=10),
+                        list(reversed(range(100))))
+
+    def test_lifo_interleaved(self):
+        q = filequeue.LifoFileQueue(flush_items=4)
+        stack = []
+        for i in range(200):
+            q.put(i)
+            stack.append(i)
+            if i % 3 == 2:
+                self.assertEqual(q.get(), stack.pop())
+        while stack:
+            self.assertEqual(q.get(), stack.pop())
+        q.dispose()
+
+    def test_lifo_lazy_truncate(self):
+        q = filequeue.LifoFileQueue(flush_items=10, segment_size=1 << 20)
+        for i in range(100):
+            q.put(i)
+        segment = q._spill._segments[0]
+        size = segment.size
+        self.assertEqual(q.get(), 99)
+        for i in range(20):
+            q.get()
+        self.assertTrue(segment.write_pos < size)
+        self.assertEqual(segment.size, size,
+                         "File shouldn't be truncated on every pop")
+        q.put(100)
+        self.assertEqual(q.get_many(100), [100] + list(range(78, -1, -1)))
+        q.dispose()
+
+    def test_lifo_read_back(self):
+        # a block read back into memory isn't written out again straight
+        # away by the flush interval
+        q = filequeue.LifoFileQueue(flush_items=10, flush_interval=0.05)
+        q.put_many(range(30))
+        q._spill.flush()
+        time.sleep(0.1)
+        self.assertEqual(q.get(), 29)
+        written = q._spill._raw_bytes
+        q.put(30)
+        self.assertEqual(q._spill._raw_bytes, written)
+        self.assertEqual(q.get_many(100), [30] + list(range(28, -1, -1)))
+        q.dispose()
+
+    def test_lifo_bad_trailer(self):
+        q = filequeue.LifoFileQueue(flush_items=10)
+        for i in range(30):
+            q.put(i)
+        segment = q._spill._segments[0]
+        segment.file.seek(segment.write_pos - 1)
+        segment.file.write(b"\xff")
+        segment.file.flush()
+        self.assertRaises(IOError, q.get_many, 30)
+        q.dispose()
+
+    def test_flush_bytes(self):
+        q = filequeue.FileQueue(flush_bytes=1024)
+        q.put(b"x" * 2048)
+        self.assertTrue(q._spill._segments[0].write_pos > 2048)
+        self.assertEqual(q.get(), b"x" * 2048)
+        q.dispose()
+
+
 # A FileQueue subclass that can provoke failure at a moment's notice :)
 class FailingFileQueueException(Exception):
     pass
@@ -332,6 +1912,26 @@ def test_main():
     test_support.run_unittest(FileQueueTest,
                               LifoFileQueueTest,
                               PriorityFileQueueTest,
+                              SegmentTest,
+                              WriteBehindTest,
+                              ReadAheadTest,
+                              CompressionTest,
+                              SerializerTest,
+                              BatchTest,
+                              LockSplitTest,
+                              StatsTest,
+                              BufferBytesTest,
+                              OrderedTest,
+                              DiskQuotaTest,
+                              DelayFileQueueTest,
+                              SpillPlacementTest,
+                              ShardedFileQueueTest,
+                              UniqueTest,
+                              ExpiringTest,
+                              PriorityLevelTest,
+                              DurableTest,
+                              ProcessFileQueueTest,
+                              MmapTest,
                               FailingFileQueueTest)
 
 